@@ -1,15 +1,23 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
-import requests
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import google.generativeai as genai
-from openai import OpenAI
-from anthropic import Anthropic
 from dotenv import load_dotenv
 
 # 環境変数のロード
 load_dotenv()
 
+# リポジトリ直下の共通ユーティリティ（レスポンスキャッシュ・プロバイダーアダプターなど）を利用する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import Config
+from utils.ai_utils import generate_text, ProviderCallError
+from utils.response_cache import get_response_cache, get_cache_stats, make_cache_key
+
 app = Flask(__name__)
 CORS(app)  # GitHub Pagesからのリクエストを許可
 
@@ -25,15 +33,32 @@ openrouter_api_key = os.getenv('OPENROUTER_API_KEY')
 if gemini_api_key:
     genai.configure(api_key=gemini_api_key)
 
-# OpenAIクライアントの初期化
-openai_client = None
-if openai_api_key:
-    openai_client = OpenAI(api_key=openai_api_key)
-
-# Anthropicクライアントの初期化
-anthropic_client = None
-if anthropic_api_key:
-    anthropic_client = Anthropic(api_key=anthropic_api_key)
+# フロントエンドのモデル選択 → AIModels のモデル識別子（Gemini 以外はプロバイダーアダプター経由で呼び出す）
+API_MODEL_CHOICES = {
+    'xai': 'grok-3-beta',
+    'anthropic': 'claude-3-5-sonnet',
+    'openai': 'gpt-4-turbo',
+}
+GEMINI_MODEL_NAME = "gemini-2.5-pro-preview-03-25"
+
+# アイデア生成で使うGeminiの安全性設定
+GEMINI_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
+]
+
+# 設定済みの GenerativeModel を (モデル名, 生成設定, 安全性設定) ごとに使い回す
+_gemini_models = {}
+_gemini_models_lock = threading.Lock()
+
+# エピソードの要約は応答の後ろで生成し、/api/summary/<summary_id> で受け取る
+SUMMARY_STORE_SIZE = 512  # 保持する要約（生成中を含む）の件数
+SUMMARY_MAX_WAIT = 30  # /api/summary の wait で待てる最大秒数
+_summary_executor = ThreadPoolExecutor(max_workers=Config.SUMMARY_WORKERS, thread_name_prefix='summary')
+_summaries = OrderedDict()
+_summaries_lock = threading.Lock()
 
 # レート制限のための簡易カウンター（本番環境ではRedisなどを使用）
 request_counter = {
@@ -41,6 +66,88 @@ request_counter = {
     'limit': 100  # 1時間あたりの最大リクエスト数
 }
 
+def get_gemini_model(max_tokens, temperature, safety_settings=None):
+    """
+    生成設定ごとの GenerativeModel を取得する（初回に作成し、以降はスレッド間で共有する）
+
+    本文・要約・アイデア生成の設定の組み合わせは限られるため、上限は設けない。
+    """
+    safety_key = tuple(tuple(sorted(setting.items())) for setting in safety_settings or ())
+    key = (GEMINI_MODEL_NAME, max_tokens, temperature, safety_key)
+    model = _gemini_models.get(key)
+    if model is not None:
+        return model
+    
+    with _gemini_models_lock:
+        model = _gemini_models.get(key)
+        if model is None:
+            model = genai.GenerativeModel(model_name=GEMINI_MODEL_NAME,
+                                          generation_config={"temperature": temperature, "max_output_tokens": max_tokens},
+                                          safety_settings=safety_settings)
+            _gemini_models[key] = model
+    return model
+
+def generate(model_choice, prompt, max_tokens, temperature, safety_settings=None):
+    """
+    選択されたモデルでテキストを生成する
+
+    Raises:
+        ProviderCallError: 呼び出しに失敗した場合、またはサポートされていないモデルの場合
+    """
+    if model_choice == 'gemini':
+        # Google Gemini 2.5 Pro（SDK経由）
+        model = get_gemini_model(max_tokens, temperature, safety_settings)
+        return model.generate_content(prompt).text
+    if model_choice not in API_MODEL_CHOICES:
+        raise ProviderCallError("サポートされていないモデルが選択されました")
+    # 利用者が選んだモデルで応答するため、別プロバイダーへのフェイルオーバーはしない
+    return generate_text(API_MODEL_CHOICES[model_choice], prompt, max_tokens=max_tokens,
+                         temperature=temperature, allow_failover=False)
+
+def summarize(model_choice, text):
+    """エピソードの100文字要約を生成する（失敗した場合は「要約失敗」）"""
+    summary_prompt = f"以下のストーリーの要約を100文字以内で作成してください。\n\n{text}"
+    try:
+        return generate(model_choice, summary_prompt, 100, 0.3)
+    except ProviderCallError:
+        return "要約失敗"
+
+def schedule_summary(model_choice, text):
+    """
+    エピソードの要約をバックグラウンドで生成し、受け取り用のIDを返す
+
+    IDはモデルと本文のハッシュなので、同じ本文の要約は一度だけ生成する。
+    """
+    summary_id = hashlib.sha256(f"{model_choice}:{text}".encode('utf-8')).hexdigest()[:32]
+    with _summaries_lock:
+        if summary_id in _summaries:
+            _summaries.move_to_end(summary_id)
+        else:
+            _summaries[summary_id] = _summary_executor.submit(summarize, model_choice, text)
+            while len(_summaries) > SUMMARY_STORE_SIZE:
+                _summaries.popitem(last=False)
+    return summary_id
+
+def wait_summary(summary_id, timeout):
+    """
+    要約の生成を最大 timeout 秒待って返す
+
+    Returns:
+        str: 要約（timeout までに完成しなかった場合は None）
+
+    Raises:
+        KeyError: IDが見つからない場合（期限切れ・別のサーバープロセス）
+    """
+    with _summaries_lock:
+        future = _summaries[summary_id]
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        return None
+    except Exception:
+        # summarize が処理しない例外（Gemini SDK のエラーなど）
+        return "要約失敗"
+
 @app.route('/')
 def home():
     return jsonify({'status': 'active', 'message': '小説生成APIサーバー稼働中'})
@@ -60,62 +167,31 @@ def generate_ideas():
     # ジャンル別のプロットアイデア生成
     prompt = f"以下のジャンル「{genre}」に合った面白い小説のプロットアイデアを3つ提案してください。各アイデアには、簡単な概要、主要登場人物案、物語の舞台を含めてください。"
     
+    # 同じジャンル・モデルの提案はレスポンスキャッシュから返す（use_cache=false で無効化）
+    use_cache = Config.RESPONSE_CACHE_ENABLED and request.json.get('use_cache', True)
+    cache_key = make_cache_key(f"ideas:{model_choice}", prompt, 1000, 0.7)
+    if use_cache:
+        cached = get_response_cache().get(cache_key)
+        if cached is not None:
+            return jsonify({"success": True, "ideas": cached, "cached": True})
+    
     try:
-        if model_choice == 'xai':
-            # xAI (Grok-3) APIリクエスト
-            headers = {"Authorization": f"Bearer {xai_api_key}", "Content-Type": "application/json"}
-            data = {"model": "grok-3-beta", "messages": [{"role": "user", "content": prompt}], "max_tokens": 1000}
-            response = requests.post("https://api.x.ai/v1/chat/completions", headers=headers, json=data)
-            
-            if response.status_code == 200:
-                ideas = response.json().get("choices", [{}])[0].get("message", {}).get("content", "アイデアを生成できませんでした")
-                return jsonify({"success": True, "ideas": ideas})
-            else:
-                return jsonify({"success": False, "error": f"エラー: {response.status_code}"})
-                
-        elif model_choice == 'gemini':
-            # Google Gemini 2.5 Pro
-            safety_settings = [
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_MEDIUM_AND_ABOVE"}
-            ]
-            
-            model = genai.GenerativeModel(model_name="gemini-2.5-pro-preview-03-25", 
-                                         generation_config={"temperature": 0.7, "max_output_tokens": 1000},
-                                         safety_settings=safety_settings)
-            response = model.generate_content(prompt)
-            return jsonify({"success": True, "ideas": response.text})
-                
-        elif model_choice == 'anthropic':
-            # Anthropic Claude
-            message = anthropic_client.messages.create(
-                model="claude-3-5-sonnet-20240620",
-                max_tokens=1000,
-                temperature=0.7,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            return jsonify({"success": True, "ideas": message.content[0].text})
-                
-        elif model_choice == 'openai':
-            # OpenAI GPT-4
-            response = openai_client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=1000,
-                temperature=0.7
-            )
-            return jsonify({"success": True, "ideas": response.choices[0].message.content})
-                
-        else:
-            return jsonify({"success": False, "error": "サポートされていないモデルが選択されました"})
+        ideas = generate(model_choice, prompt, 1000, 0.7, safety_settings=GEMINI_SAFETY_SETTINGS)
+        
+        if use_cache:
+            get_response_cache().set(cache_key, ideas, model=model_choice)
+        return jsonify({"success": True, "ideas": ideas})
     
+    except ProviderCallError as e:
+        return jsonify({"success": False, "error": str(e)})
     except Exception as e:
         return jsonify({"success": False, "error": f"エラーが発生しました: {str(e)}"}), 500
 
+@app.route('/api/cache_stats')
+def cache_stats():
+    """レスポンスキャッシュのヒット/ミス数を返す"""
+    return jsonify(get_cache_stats())
+
 @app.route('/api/generate', methods=['POST'])
 def generate_story():
     # レート制限チェック
@@ -143,88 +219,23 @@ def generate_story():
     full_prompt += "\n\n約700文字で第1話を生成してください。プロットではなく、実際の物語として書いてください。各段落の最初は全角スペースで字下げし、会話文は「」で囲み、適切に改行してください。"
     
     try:
-        novel_text = None
-        
         # 選択されたモデルに基づいて小説を生成
-        if model_choice == 'xai':
-            # xAI (Grok-3) APIリクエスト
-            headers = {"Authorization": f"Bearer {xai_api_key}", "Content-Type": "application/json"}
-            data = {"model": "grok-3-beta", "messages": [{"role": "user", "content": full_prompt}], "max_tokens": 1500}
-            response = requests.post("https://api.x.ai/v1/chat/completions", headers=headers, json=data)
-            
-            if response.status_code == 200:
-                novel_text = response.json().get("choices", [{}])[0].get("message", {}).get("content", "テキストが見つかりませんでした")
-            else:
-                return jsonify({"success": False, "error": f"エラー: {response.status_code}"})
-                
-        elif model_choice == 'gemini':
-            model = genai.GenerativeModel(model_name="gemini-2.5-pro-preview-03-25", 
-                                         generation_config={"temperature": 0.7, "max_output_tokens": 1500})
-            response = model.generate_content(full_prompt)
-            novel_text = response.text
-                
-        elif model_choice == 'anthropic':
-            message = anthropic_client.messages.create(
-                model="claude-3-5-sonnet-20240620",
-                max_tokens=1500,
-                temperature=0.7,
-                messages=[
-                    {"role": "user", "content": full_prompt}
-                ]
-            )
-            novel_text = message.content[0].text
-                
-        elif model_choice == 'openai':
-            response = openai_client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[{"role": "user", "content": full_prompt}],
-                max_tokens=1500,
-                temperature=0.7
-            )
-            novel_text = response.choices[0].message.content
+        novel_text = generate(model_choice, full_prompt, 1500, 0.7)
         
-        # 要約生成
-        summary = "要約失敗"
-        if novel_text:
-            summary_prompt = f"以下のストーリーの要約を100文字以内で作成してください。\n\n{novel_text}"
-            
-            if model_choice == 'xai':
-                data = {"model": "grok-3-beta", "messages": [{"role": "user", "content": summary_prompt}], "max_tokens": 100}
-                response = requests.post("https://api.x.ai/v1/chat/completions", headers=headers, json=data)
-                if response.status_code == 200:
-                    summary = response.json().get("choices", [{}])[0].get("message", {}).get("content", "要約失敗")
-            elif model_choice == 'gemini':
-                model = genai.GenerativeModel(model_name="gemini-2.5-pro-preview-03-25", 
-                                            generation_config={"temperature": 0.3, "max_output_tokens": 100})
-                response = model.generate_content(summary_prompt)
-                summary = response.text
-            elif model_choice == 'anthropic':
-                message = anthropic_client.messages.create(
-                    model="claude-3-5-sonnet-20240620",
-                    max_tokens=100,
-                    temperature=0.3,
-                    messages=[
-                        {"role": "user", "content": summary_prompt}
-                    ]
-                )
-                summary = message.content[0].text
-            elif model_choice == 'openai':
-                response = openai_client.chat.completions.create(
-                    model="gpt-4-turbo",
-                    messages=[{"role": "user", "content": summary_prompt}],
-                    max_tokens=100,
-                    temperature=0.3
-                )
-                summary = response.choices[0].message.content
+        # 要約は次話の執筆まで不要なので、本文を先に返してバックグラウンドで生成する
+        summary_id = schedule_summary(model_choice, novel_text) if novel_text else None
         
         return jsonify({
             "success": True,
             "novel_text": novel_text,
-            "summary": summary,
+            "summary": None if summary_id else "要約失敗",
+            "summary_id": summary_id,
             "title": "第1話",
             "model": model_choice
         })
     
+    except ProviderCallError as e:
+        return jsonify({"success": False, "error": str(e)})
     except Exception as e:
         return jsonify({"success": False, "error": f"エラーが発生しました: {str(e)}"}), 500
 
@@ -243,9 +254,17 @@ def continue_story():
     story_request = data.get('story_request', '')
     model_choice = data.get('model_choice', 'xai')
     previous_summary = data.get('previous_summary', '')
+    previous_summary_id = data.get('previous_summary_id')
     episode_number = data.get('episode_number', 2)
     characters = data.get('characters', [])
     
+    # 前話の要約がまだ手元にない場合は、生成中の要約の完成を待つ
+    if not previous_summary and previous_summary_id:
+        try:
+            previous_summary = wait_summary(previous_summary_id, SUMMARY_MAX_WAIT) or ''
+        except KeyError:
+            return jsonify({"success": False, "error": "前話の要約が見つかりません。前話の要約を付けて再送してください。"}), 409
+    
     # 続きのプロンプト
     full_prompt = f"""あなたは小説の設定を考案するプロフェッショナルです。
 
@@ -268,96 +287,43 @@ def continue_story():
         full_prompt += "\n\n### 登場キャラクター:\n" + "\n".join([f"{c['name']}: {c['description']}" for c in characters])
     
     try:
-        new_text = None
-        
         # 選択されたモデルに基づいて続きを生成
-        if model_choice == 'xai':
-            # xAI (Grok-3) APIリクエスト
-            headers = {"Authorization": f"Bearer {xai_api_key}", "Content-Type": "application/json"}
-            data = {
-                "model": "grok-3-beta", 
-                "messages": [{"role": "user", "content": full_prompt}], 
-                "max_tokens": 1500,
-                "temperature": 0.7
-            }
-            response = requests.post("https://api.x.ai/v1/chat/completions", headers=headers, json=data)
-            
-            if response.status_code == 200:
-                new_text = response.json().get("choices", [{}])[0].get("message", {}).get("content", "テキストが見つかりませんでした")
-            else:
-                return jsonify({"success": False, "error": f"エラー: {response.status_code}"})
-                
-        elif model_choice == 'gemini':
-            model = genai.GenerativeModel(model_name="gemini-2.5-pro-preview-03-25", 
-                                       generation_config={"temperature": 0.7, "max_output_tokens": 1500})
-            response = model.generate_content(full_prompt)
-            new_text = response.text
-                
-        elif model_choice == 'anthropic':
-            message = anthropic_client.messages.create(
-                model="claude-3-5-sonnet-20240620",
-                max_tokens=1500,
-                temperature=0.7,
-                messages=[
-                    {"role": "user", "content": full_prompt}
-                ]
-            )
-            new_text = message.content[0].text
-                
-        elif model_choice == 'openai':
-            response = openai_client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[{"role": "user", "content": full_prompt}],
-                max_tokens=1500,
-                temperature=0.7
-            )
-            new_text = response.choices[0].message.content
+        new_text = generate(model_choice, full_prompt, 1500, 0.7)
         
-        # 要約生成
-        summary = "要約失敗"
-        if new_text:
-            summary_prompt = f"以下のストーリーの要約を100文字以内で作成してください。\n\n{new_text}"
-            
-            if model_choice == 'xai':
-                data = {"model": "grok-3-beta", "messages": [{"role": "user", "content": summary_prompt}], "max_tokens": 100}
-                response = requests.post("https://api.x.ai/v1/chat/completions", headers=headers, json=data)
-                if response.status_code == 200:
-                    summary = response.json().get("choices", [{}])[0].get("message", {}).get("content", "要約失敗")
-            elif model_choice == 'gemini':
-                model = genai.GenerativeModel(model_name="gemini-2.5-pro-preview-03-25", 
-                                            generation_config={"temperature": 0.3, "max_output_tokens": 100})
-                response = model.generate_content(summary_prompt)
-                summary = response.text
-            elif model_choice == 'anthropic':
-                message = anthropic_client.messages.create(
-                    model="claude-3-5-sonnet-20240620",
-                    max_tokens=100,
-                    temperature=0.3,
-                    messages=[
-                        {"role": "user", "content": summary_prompt}
-                    ]
-                )
-                summary = message.content[0].text
-            elif model_choice == 'openai':
-                response = openai_client.chat.completions.create(
-                    model="gpt-4-turbo",
-                    messages=[{"role": "user", "content": summary_prompt}],
-                    max_tokens=100,
-                    temperature=0.3
-                )
-                summary = response.choices[0].message.content
+        # 要約は次話の執筆まで不要なので、本文を先に返してバックグラウンドで生成する
+        summary_id = schedule_summary(model_choice, new_text) if new_text else None
         
         return jsonify({
             "success": True,
             "novel_text": new_text,
-            "summary": summary,
+            "summary": None if summary_id else "要約失敗",
+            "summary_id": summary_id,
             "title": f"第{episode_number}話",
             "model": model_choice
         })
     
+    except ProviderCallError as e:
+        return jsonify({"success": False, "error": str(e)})
     except Exception as e:
         return jsonify({"success": False, "error": f"エラーが発生しました: {str(e)}"}), 500
 
+@app.route('/api/summary/<summary_id>')
+def get_summary(summary_id):
+    """
+    バックグラウンドで生成した要約を返す
+
+    クエリ wait=秒数 を付けると、完成するまで最大その秒数（上限30秒）待つ。
+    生成中なら202、IDが見つからない場合は404を返す。
+    """
+    wait = min(max(request.args.get('wait', 0, type=float), 0), SUMMARY_MAX_WAIT)
+    try:
+        summary = wait_summary(summary_id, wait)
+    except KeyError:
+        return jsonify({"success": False, "error": "要約が見つかりません"}), 404
+    if summary is None:
+        return jsonify({"success": True, "status": "pending", "summary_id": summary_id}), 202
+    return jsonify({"success": True, "status": "done", "summary_id": summary_id, "summary": summary})
+
 # デモモード用（実際のAPIキーが不要）
 @app.route('/api/demo/generate', methods=['POST'])
 def demo_generate():
@@ -16,6 +16,7 @@ from dotenv import load_dotenv
 from config import Config
 from models import db, init_db
 from routes import register_blueprints
+from utils import tracing, cost_ledger
 
 # .env ファイルがあれば自動で読み込む
 load_dotenv()
@@ -62,6 +63,12 @@ def create_app(config_class=Config):
     # ルートを登録
     register_blueprints(app)
     
+    # リクエストごとのトレース（X-Trace-Id ヘッダーを返す）
+    tracing.init_app(app)
+    
+    # プロバイダー呼び出しにルート・セッション・作品のタグを付けてコスト台帳に記録する
+    cost_ledger.init_app(app)
+    
     # エラーハンドラーの登録
     @app.errorhandler(500)
     def server_error(e):
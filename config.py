@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
 import typing as t
 from dotenv import load_dotenv
 
@@ -40,8 +41,135 @@ class Config:
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
     ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY', '')
     DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY', '')
+    # ベースURL（services/mock_llm_server などのローカル互換サーバーに向ける場合に上書きする）
+    XAI_API_BASE = os.getenv('XAI_API_BASE', 'https://api.x.ai/v1')
+    OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+    ANTHROPIC_API_BASE = os.getenv('ANTHROPIC_API_BASE', 'https://api.anthropic.com/v1')
     DEEPSEEK_API_BASE = os.getenv('DEEPSEEK_API_BASE', 'https://api.deepseek.com/v1')
     
+    # プロバイダーごとの同時実行数とレート制限（utils.providers のアダプターが参照。0は無制限）
+    PROVIDER_MAX_CONCURRENCY = {
+        p: int(os.getenv(f'{p.upper()}_MAX_CONCURRENCY', '8')) for p in ('xai', 'openai', 'anthropic', 'deepseek')
+    }
+    PROVIDER_RPM_LIMITS = {
+        p: int(os.getenv(f'{p.upper()}_RPM_LIMIT', '0')) for p in ('xai', 'openai', 'anthropic', 'deepseek')
+    }
+    PROVIDER_TPM_LIMITS = {
+        p: int(os.getenv(f'{p.upper()}_TPM_LIMIT', '0')) for p in ('xai', 'openai', 'anthropic', 'deepseek')
+    }
+    
+    # クライアント側レート制限（上の RPM/TPM を初期値とし、x-ratelimit-* ヘッダーで補正する）
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '120'))  # これより長く待つ必要がある場合は送信せずに失敗させる
+    
+    # 一括生成（python -m services.batch_generator）のプロバイダーごとの同時呼び出し数
+    BATCH_CONCURRENCY_PER_PROVIDER = int(os.getenv('BATCH_CONCURRENCY_PER_PROVIDER', '4'))
+    
+    # AIプロバイダーHTTP接続設定（プールサイズはワーカーあたりのスレッド数に合わせる）
+    HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', '10'))
+    HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '60'))
+    
+    # プロバイダー呼び出しのリトライ方針（utils.retry_policy）
+    RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', '3'))
+    RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '1.0'))
+    RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '20'))
+    RETRY_BUDGET_RATIO = float(os.getenv('RETRY_BUDGET_RATIO', '0.2'))  # リトライはリクエストの20%まで
+    RETRY_BUDGET_MIN_RETRIES = int(os.getenv('RETRY_BUDGET_MIN_RETRIES', '5'))  # 1分あたりの最低許可数
+    
+    # プロバイダーごとのサーキットブレーカー（utils.circuit_breaker）
+    CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))  # 連続失敗でopen
+    # これより遅い応答は失敗扱い（秒）。0で無効（既定）。エピソード執筆は60秒以上かかることがあるため、
+    # 有効にする場合は最も遅い正常な呼び出し（HTTP_TIMEOUT 程度）より大きくする
+    CIRCUIT_LATENCY_THRESHOLD = float(os.getenv('CIRCUIT_LATENCY_THRESHOLD', '0'))
+    CIRCUIT_OPEN_SECONDS = float(os.getenv('CIRCUIT_OPEN_SECONDS', '30'))
+    CIRCUIT_HALF_OPEN_MAX_CALLS = int(os.getenv('CIRCUIT_HALF_OPEN_MAX_CALLS', '1'))
+    # open中のプロバイダー・一時的な障害で失敗したプロバイダーを AIModels.FALLBACK_CHAINS に従って別モデルに切り替えるか
+    AI_FAILOVER_ENABLED = os.getenv('AI_FAILOVER_ENABLED', 'true').lower() == 'true'
+    
+    # ヘッジ付きリクエスト（utils.hedging）。既定では無効
+    HEDGING_ENABLED = os.getenv('HEDGING_ENABLED', 'false').lower() == 'true'
+    HEDGE_TARGET = os.getenv('HEDGE_TARGET', 'same')  # 'same': 同じモデル, 'fallback': フォールバック先の最初のモデル
+    HEDGE_MAX_RATE = float(os.getenv('HEDGE_MAX_RATE', '0.1'))  # バックアップはリクエストの10%まで
+    HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '0.95'))  # 最初の応答時間のこの分位を超えたらヘッジ
+    HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))  # 学習に必要なサンプル数
+    HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '15'))  # サンプル不足時の待機秒数
+    HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '2'))
+    HEDGE_MAX_WORKERS = int(os.getenv('HEDGE_MAX_WORKERS', '16'))
+    
+    # 決定的なLLM呼び出しのレスポンスキャッシュ（utils.response_cache）
+    RESPONSE_CACHE_ENABLED = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+    RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', os.path.join(DATA_DIR, 'response_cache.db'))
+    RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', str(7 * 24 * 3600)))  # 秒
+    RESPONSE_CACHE_MEMORY_ENTRIES = int(os.getenv('RESPONSE_CACHE_MEMORY_ENTRIES', '256'))
+    RESPONSE_CACHE_MAX_DISK_MB = int(os.getenv('RESPONSE_CACHE_MAX_DISK_MB', '50'))
+    
+    # エピソード要約をバックグラウンドで生成するワーカー数（services.summary_service）
+    SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', '2'))
+    
+    # 長期連載の物語メモリ（services.story_memory）
+    STORY_ARC_SIZE = int(os.getenv('STORY_ARC_SIZE', '5'))  # この話数ごとにまとめ要約を作る
+    STORY_ARC_SUMMARY_CHARS = int(os.getenv('STORY_ARC_SUMMARY_CHARS', '300'))
+    STORY_CONTEXT_MAX_TOKENS = int(os.getenv('STORY_CONTEXT_MAX_TOKENS', '1500'))  # 次話プロンプトに入れる物語の予算
+    
+    # 第1〜3話の一括執筆（services.draft_service）
+    DRAFT_WORKERS = int(os.getenv('DRAFT_WORKERS', '6'))  # 各話の執筆・つなぎ目の調整を並行して行うスレッド数
+    DRAFT_SMOOTHING_ENABLED = os.getenv('DRAFT_SMOOTHING_ENABLED', 'true').lower() == 'true'
+    DRAFT_SMOOTHING_CHARS = int(os.getenv('DRAFT_SMOOTHING_CHARS', '400'))  # 書き直す冒頭・参照する前話の結末の文字数
+    
+    # 長編モード: 構成案を作ってから場面ごとに並行して執筆する（services.draft_service）
+    LONG_EPISODE_TARGET_CHARS = int(os.getenv('LONG_EPISODE_TARGET_CHARS', '5000'))  # 1話全体の目標文字数
+    LONG_EPISODE_SCENE_CHARS = int(os.getenv('LONG_EPISODE_SCENE_CHARS', '1000'))  # 1場面（1回の呼び出し）の目標文字数
+    LONG_EPISODE_MAX_SCENES = int(os.getenv('LONG_EPISODE_MAX_SCENES', '8'))
+    
+    # 同一リクエストの同時呼び出しをまとめるシングルフライト（utils.single_flight）
+    SINGLE_FLIGHT_ENABLED = os.getenv('SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
+    SINGLE_FLIGHT_SHARED = os.getenv('SINGLE_FLIGHT_SHARED', 'false').lower() == 'true'  # 複数ワーカープロセス間でもまとめる
+    SINGLE_FLIGHT_DB_PATH = os.getenv('SINGLE_FLIGHT_DB_PATH', os.path.join(DATA_DIR, 'single_flight.db'))
+    SINGLE_FLIGHT_LOCK_TTL = float(os.getenv('SINGLE_FLIGHT_LOCK_TTL', '300'))  # 実行中プロセスが応答しない場合に引き継ぐまでの秒数
+    SINGLE_FLIGHT_POLL_INTERVAL = float(os.getenv('SINGLE_FLIGHT_POLL_INTERVAL', '0.5'))
+    SINGLE_FLIGHT_RESULT_TTL = float(os.getenv('SINGLE_FLIGHT_RESULT_TTL', '10'))  # 待機中のプロセスが結果を読むための保持秒数
+    
+    # トークン予算（utils.token_budget）
+    TOKEN_CALIBRATION_ALPHA = float(os.getenv('TOKEN_CALIBRATION_ALPHA', '0.2'))  # usage による文字数/トークン比の補正の強さ
+    MAX_TOKENS_HEADROOM = float(os.getenv('MAX_TOKENS_HEADROOM', '1.3'))  # 目標文字数に対する max_tokens の余裕
+    MIN_OUTPUT_TOKENS = int(os.getenv('MIN_OUTPUT_TOKENS', '128'))
+    MAX_OUTPUT_TOKENS = int(os.getenv('MAX_OUTPUT_TOKENS', '4096'))
+    PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '6000'))  # 超える場合は任意セクションを縮める
+    # 作品ごとに変わらないセクションを先頭のシステムメッセージにまとめ、プロバイダーのプロンプトキャッシュに載せる
+    PROMPT_CACHE_LAYOUT = os.getenv('PROMPT_CACHE_LAYOUT', 'true').lower() == 'true'
+    EPISODE_TARGET_CHARS = int(os.getenv('EPISODE_TARGET_CHARS', '1000'))  # 「800〜1000文字程度」の上限
+    SYNOPSIS_TARGET_CHARS = int(os.getenv('SYNOPSIS_TARGET_CHARS', '1000'))  # 3話 × 300文字程度
+    
+    # 生成ジョブキュー（services.job_queue）
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+    JOB_MAX_QUEUE_DEPTH = int(os.getenv('JOB_MAX_QUEUE_DEPTH', '20'))  # これを超える待機ジョブは503で拒否
+    JOB_RESULT_TTL = float(os.getenv('JOB_RESULT_TTL', '1800'))  # 完了したジョブを保持する秒数
+    
+    # /metrics エンドポイントと計測（utils.metrics）
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    
+    # プロバイダー呼び出しのコスト台帳（utils.cost_ledger）
+    COST_LEDGER_ENABLED = os.getenv('COST_LEDGER_ENABLED', 'true').lower() == 'true'
+    COST_LEDGER_PATH = os.getenv('COST_LEDGER_PATH', os.path.join(DATA_DIR, 'cost_ledger.db'))
+    # 価格の上書き（JSON: {"gpt-4o": [入力, 出力]}。100万トークンあたりのUSD）
+    MODEL_PRICE_OVERRIDES = json.loads(os.getenv('MODEL_PRICES_JSON', '{}'))
+    
+    # 管理用エンドポイント（/admin/*）の認証キー（X-Admin-Key ヘッダー。未設定の場合は無効）
+    ADMIN_SECRET_KEY = os.getenv('ADMIN_SECRET_KEY', '')
+    
+    # リクエストごとのトレース（utils.tracing）
+    TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'true').lower() == 'true'
+    TRACE_EXPORT_FORMAT = os.getenv('TRACE_EXPORT_FORMAT', 'jsonl')  # 'jsonl' / 'otlp' / 'none'
+    TRACE_EXPORT_PATH = os.getenv('TRACE_EXPORT_PATH', os.path.join(DATA_DIR, 'traces', 'spans.jsonl'))
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0.05'))  # ファイルに出力するトレースの割合
+    TRACE_SLOW_THRESHOLD = float(os.getenv('TRACE_SLOW_THRESHOLD', '30'))  # これより遅いトレースは標本に関わらず木全体を出力（0で無効）
+    TRACE_SLOW_PATH = os.getenv('TRACE_SLOW_PATH', os.path.join(DATA_DIR, 'traces', 'slow_traces.jsonl'))
+    TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', '500'))  # 1トレースあたりのスパン数の上限
+    
+    # 非同期ランタイム（services.async_runtime）の共有セッション接続数上限
+    ASYNC_HTTP_LIMIT = int(os.getenv('ASYNC_HTTP_LIMIT', '100'))
+    ASYNC_HTTP_LIMIT_PER_HOST = int(os.getenv('ASYNC_HTTP_LIMIT_PER_HOST', '10'))
+    
     @classmethod
     def init_directories(cls) -> None:
         """必要なディレクトリ構造を作成
@@ -71,7 +199,11 @@ class AIModels:
         'grok-3': 'xAI (Grok-3)',
         'gpt-4o': 'OpenAI (GPT-4o)',
         'claude-3-opus': 'Anthropic (Claude 3 Opus)',
-        'deepseek-v3': 'DeepSeek (V3-0324)'
+        'deepseek-v3': 'DeepSeek (V3-0324)',
+        # 以下は api/app.py（GitHub Pages版のAPIサーバー）が使うモデル
+        'grok-3-beta': 'xAI (Grok-3 Beta)',
+        'gpt-4-turbo': 'OpenAI (GPT-4 Turbo)',
+        'claude-3-5-sonnet': 'Anthropic (Claude 3.5 Sonnet)'
     }
     
     # モデルのAPI識別子
@@ -80,7 +212,57 @@ class AIModels:
         'grok-3': 'grok-3-1212',
         'gpt-4o': 'gpt-4o',
         'claude-3-opus': 'claude-3-opus-20240229',
-        'deepseek-v3': 'deepseek-chat'  # DeepSeek APIでは'deepseek-chat'を使用
+        'deepseek-v3': 'deepseek-chat',  # DeepSeek APIでは'deepseek-chat'を使用
+        'grok-3-beta': 'grok-3-beta',
+        'gpt-4-turbo': 'gpt-4-turbo',
+        'claude-3-5-sonnet': 'claude-3-5-sonnet-20240620'
+    }
+    
+    # 100万トークンあたりの価格（USD, (入力, 出力)）。改定時は MODEL_PRICES_JSON で上書きする
+    MODEL_PRICES = {
+        'xai': (2.0, 10.0),
+        'grok-3': (3.0, 15.0),
+        'gpt-4o': (2.5, 10.0),
+        'claude-3-opus': (15.0, 75.0),
+        'deepseek-v3': (0.27, 1.10),
+        'grok-3-beta': (3.0, 15.0),
+        'gpt-4-turbo': (10.0, 30.0),
+        'claude-3-5-sonnet': (3.0, 15.0)
+    }
+    
+    # プロンプトキャッシュから読まれた入力トークンの価格（通常の入力価格に対する比率, プロバイダーごと）
+    CACHED_INPUT_PRICE_RATIO = {
+        'xai': 0.25,
+        'openai': 0.5,
+        'anthropic': 0.1,
+        'deepseek': 0.26
+    }
+    
+    # モデルごとの既定の温度
+    MODEL_TEMPERATURES = {
+        'gpt-4o': 0.8
+    }
+    DEFAULT_TEMPERATURE = 0.7
+    
+    # モデルの提供元（サーキットブレーカーはプロバイダー単位）
+    MODEL_PROVIDERS = {
+        'xai': 'xai',
+        'grok-3': 'xai',
+        'gpt-4o': 'openai',
+        'claude-3-opus': 'anthropic',
+        'deepseek-v3': 'deepseek',
+        'grok-3-beta': 'xai',
+        'gpt-4-turbo': 'openai',
+        'claude-3-5-sonnet': 'anthropic'
+    }
+    
+    # プロバイダー障害時のフェイルオーバー先（先頭から順に試す）
+    FALLBACK_CHAINS = {
+        'xai': ['deepseek-v3', 'gpt-4o'],
+        'grok-3': ['deepseek-v3', 'gpt-4o'],
+        'gpt-4o': ['deepseek-v3', 'claude-3-opus'],
+        'claude-3-opus': ['gpt-4o', 'deepseek-v3'],
+        'deepseek-v3': ['grok-3', 'gpt-4o']
     }
     
     @classmethod
@@ -96,4 +278,24 @@ class AIModels:
     @classmethod
     def is_supported(cls, model_id: str) -> bool:
         """モデルがサポートされているかを確認"""
-        return model_id in cls.SUPPORTED_MODELS
\ No newline at end of file
+        return model_id in cls.SUPPORTED_MODELS
+    
+    @classmethod
+    def is_known(cls, model_id: str) -> bool:
+        """モデルが呼び出し可能か（画面の選択肢にないAPIサーバー用のモデルも含む）を確認"""
+        return model_id in cls.MODEL_API_IDS
+    
+    @classmethod
+    def get_temperature(cls, model_id: str) -> float:
+        """モデル識別子から既定の温度を取得"""
+        return cls.MODEL_TEMPERATURES.get(model_id, cls.DEFAULT_TEMPERATURE)
+    
+    @classmethod
+    def get_provider(cls, model_id: str) -> str:
+        """モデル識別子から提供元プロバイダー名を取得"""
+        return cls.MODEL_PROVIDERS.get(model_id, model_id)
+    
+    @classmethod
+    def get_fallback_chain(cls, model_id: str) -> t.List[str]:
+        """モデル識別子からフェイルオーバー先のモデル一覧を取得"""
+        return list(cls.FALLBACK_CHAINS.get(model_id, []))
\ No newline at end of file
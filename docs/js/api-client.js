@@ -110,6 +110,32 @@ class AINovelAPI {
       return this.sendRequest('/api/continue', storyContext);
     }
   
+    /**
+     * 要約取得API（要約は本文の応答後にバックグラウンドで生成される）
+     * @param {string} summaryId - 小説生成APIが返した summary_id
+     * @param {number} waitSeconds - 生成中の場合にサーバーで完成を待つ最大秒数
+     * @returns {Promise<Object>} status が 'done' なら summary を含むデータ、生成中なら 'pending'
+     */
+    async getSummary(summaryId, waitSeconds = 0) {
+      try {
+        const response = await fetch(`${this.baseUrl}/api/summary/${encodeURIComponent(summaryId)}?wait=${waitSeconds}`);
+        const responseData = await response.json();
+        
+        // 202（生成中）以外のエラーレスポンスの処理
+        if (!response.ok) {
+          throw new Error(responseData.error || `APIエラー: ${response.status}`);
+        }
+        
+        return responseData;
+      } catch (error) {
+        console.error('要約の取得エラー:', error);
+        return {
+          success: false,
+          error: error.message || '要約の取得中に不明なエラーが発生しました'
+        };
+      }
+    }
+  
     /**
      * モックAPIレスポンス（開発用）
      * @param {string} type - レスポンスタイプ
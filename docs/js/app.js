@@ -64,6 +64,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 const episode = {
                     text: response.novel_text,
                     summary: response.summary,
+                    summary_id: response.summary_id,  // 要約は結果ページで受け取る
                     title: response.title,
                     model: formDataObj.model_choice
                 };
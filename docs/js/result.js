@@ -30,10 +30,22 @@ document.addEventListener('DOMContentLoaded', function() {
         // エピソードリストを表示
         updateEpisodeList(storyList);
         
+        // バックグラウンドで生成中の要約を受け取る
+        resolveLatestSummary();
+        
         // 続き生成ボタンのイベント設定
         continueButton.addEventListener('click', handleContinueStory);
     }
     
+    // 最新エピソードの要約がまだ届いていなければ受け取り、エピソードリストに反映
+    async function resolveLatestSummary() {
+        const index = storyManager.getStoryList().length - 1;
+        const summary = await storyManager.fetchEpisodeSummary(index, apiClient, 25);
+        if (summary) {
+            updateEpisodeList(storyManager.getStoryList());
+        }
+    }
+    
     // 現在のエピソードを表示
     function showCurrentEpisode(storyList, sessionData) {
         const currentEpisode = storyList[storyList.length - 1];
@@ -88,7 +100,7 @@ document.addEventListener('DOMContentLoaded', function() {
             // エピソードリンクの作成
             const episodeLink = document.createElement('a');
             episodeLink.href = '#';
-            episodeLink.textContent = `${episode.title}: ${episode.summary}`;
+            episodeLink.textContent = `${episode.title}: ${episode.summary || '要約を生成中...'}`;
             
             // モデルバッジの作成
             const badgeSpan = document.createElement('span');
@@ -192,10 +204,13 @@ document.addEventListener('DOMContentLoaded', function() {
         loadingModal.style.display = 'flex';
         
         // 続き生成に必要なデータの準備
-        const previousSummary = storyList[storyList.length - 1].summary;
+        const previousEpisode = storyList[storyList.length - 1];
         const episodeNumber = storyList.length + 1;
         
         try {
+            // 前話の要約がまだ届いていなければ受け取る（生成中ならサーバーが previous_summary_id で完成を待つ）
+            const previousSummary = await storyManager.fetchEpisodeSummary(storyList.length - 1, apiClient) || '';
+            
             // APIリクエスト
             const response = await apiClient.continueStory({
                 prompt: sessionData.prompt,
@@ -204,6 +219,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 story_request: sessionData.story_request,
                 model_choice: sessionData.model_choice,
                 previous_summary: previousSummary,
+                previous_summary_id: previousEpisode.summary_id,
                 episode_number: episodeNumber,
                 characters: sessionData.characters || []
             });
@@ -216,6 +232,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 const newEpisode = {
                     text: response.novel_text,
                     summary: response.summary,
+                    summary_id: response.summary_id,
                     title: response.title,
                     model: sessionData.model_choice
                 };
@@ -227,6 +244,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 const updatedStoryList = storyManager.getStoryList();
                 showCurrentEpisode(updatedStoryList, sessionData);
                 updateEpisodeList(updatedStoryList);
+                resolveLatestSummary();
             } else {
                 alert('続き生成中にエラーが発生しました: ' + response.error);
             }
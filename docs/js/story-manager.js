@@ -35,6 +35,43 @@ class StoryManager {
       return storyList;
     }
   
+    /**
+     * エピソードの要約を保存
+     * @param {number} index - エピソードの位置（0始まり）
+     * @param {string} summary - 要約
+     */
+    setEpisodeSummary(index, summary) {
+      const storyList = this.getStoryList();
+      if (storyList[index]) {
+        storyList[index].summary = summary;
+        this.saveStoryList(storyList);
+      }
+    }
+  
+    /**
+     * エピソードの要約を取得（まだ届いていなければAPIサーバーから受け取って保存）
+     * @param {number} index - エピソードの位置（0始まり）
+     * @param {AINovelAPI} api - APIクライアント
+     * @param {number} waitSeconds - 生成中の場合にサーバーで完成を待つ最大秒数
+     * @returns {Promise<string|null>} 要約（生成中または取得できない場合は null）
+     */
+    async fetchEpisodeSummary(index, api, waitSeconds = 0) {
+      const episode = this.getStoryList()[index];
+      if (!episode) {
+        return null;
+      }
+      if (episode.summary || !episode.summary_id) {
+        return episode.summary || null;
+      }
+      
+      const response = await api.getSummary(episode.summary_id, waitSeconds);
+      if (response.success && response.status === 'done') {
+        this.setEpisodeSummary(index, response.summary);
+        return response.summary;
+      }
+      return null;
+    }
+  
     /**
      * セッションデータを取得
      * @returns {Object} セッションデータ
@@ -68,6 +105,7 @@ class StoryManager {
       
       return {
         summary: latestEpisode.summary,
+        summary_id: latestEpisode.summary_id,
         episode_number: storyList.length,
         title: latestEpisode.title,
         model: latestEpisode.model,
@@ -12,12 +12,20 @@ from flask import Blueprint
 from .character import character_bp
 from .location import location_bp
 from .novel import novel_bp
+from .status import status_bp
+from .jobs import jobs_bp
+from .metrics import metrics_bp
+from .admin import admin_bp
 
 # List of all blueprints to register with the app
 all_blueprints = [
     character_bp,
     location_bp,
-    novel_bp
+    novel_bp,
+    status_bp,
+    jobs_bp,
+    metrics_bp,
+    admin_bp
 ]
 
 # Function to register all blueprints with the app
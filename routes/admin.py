@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Admin routes for the novel generator application.
+Exposes cost ledger aggregates behind the admin key (X-Admin-Key header).
+"""
+
+import hmac
+import time
+import logging
+from typing import Dict, Optional
+from flask import Blueprint, request, jsonify
+
+from config import Config
+from utils.cost_ledger import get_cost_ledger, GROUP_COLUMNS
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# Blueprint definition
+admin_bp = Blueprint('admin', __name__)
+
+# 集計の既定の期間（時間）
+DEFAULT_WINDOW_HOURS = 24
+
+# 一度に返す行数の上限
+MAX_ROWS = 500
+
+
+@admin_bp.before_request
+def _require_admin_key():
+    """X-Admin-Key が ADMIN_SECRET_KEY と一致しない場合は拒否する（未設定なら管理APIは無効）"""
+    if not Config.ADMIN_SECRET_KEY:
+        return jsonify({'success': False, 'error': '管理APIは無効です（ADMIN_SECRET_KEY が未設定）'}), 403
+    supplied = request.headers.get('X-Admin-Key', '')
+    if not hmac.compare_digest(supplied.encode('utf-8'), Config.ADMIN_SECRET_KEY.encode('utf-8')):
+        logger.warning(f"管理APIへの認証失敗: {request.remote_addr} {request.path}")
+        return jsonify({'success': False, 'error': '認証に失敗しました'}), 401
+    return None
+
+
+def _time_arg(name: str, default: Optional[float]) -> Optional[float]:
+    """
+    期間の指定を UNIX 秒にする
+
+    10万より小さい値は「何時間前から」、それ以上は UNIX 秒として扱います。
+
+    Raises:
+        ValueError: 数値でない場合
+    """
+    value = request.args.get(name)
+    if value in (None, ''):
+        return default
+    number = float(value)
+    return time.time() - number * 3600 if number < 100000 else number
+
+
+def _filters() -> Dict[str, str]:
+    """クエリ文字列のうち集計できる列の指定を絞り込み条件にする"""
+    return {column: request.args[column] for column in GROUP_COLUMNS if request.args.get(column)}
+
+
+def _limit(default: int) -> int:
+    return max(1, min(request.args.get('limit', default, type=int), MAX_ROWS))
+
+########################################
+# コスト集計: /admin/costs
+########################################
+@admin_bp.route('/admin/costs')
+def costs():
+    """
+    コスト台帳を group_by（route, purpose, session_id, novel_id, provider, model, model_id, status）ごとに集計する
+
+    クエリ: group_by, since / until（時間前 または UNIX 秒、既定は直近24時間）, limit, 列名=値 の絞り込み
+    """
+    group_by = request.args.get('group_by', 'model')
+    try:
+        since = _time_arg('since', time.time() - DEFAULT_WINDOW_HOURS * 3600)
+        until = _time_arg('until', None)
+        rows = get_cost_ledger().summary(group_by, since, until, _filters(), _limit(50))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e), 'group_by_choices': list(GROUP_COLUMNS)}), 400
+    return jsonify({
+        'success': True,
+        'group_by': group_by,
+        'since': since,
+        'until': until,
+        'rows': rows,
+    })
+
+########################################
+# プロンプトのセクション別コスト: /admin/costs/sections
+########################################
+@admin_bp.route('/admin/costs/sections')
+def section_costs():
+    """入力コストをプロンプトのセクション（あらすじ・前話の要約など）ごとに按分して集計する"""
+    try:
+        since = _time_arg('since', time.time() - DEFAULT_WINDOW_HOURS * 3600)
+        until = _time_arg('until', None)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    return jsonify({
+        'success': True,
+        'since': since,
+        'until': until,
+        'sections': get_cost_ledger().section_costs(since, until, _filters()),
+    })
+
+########################################
+# 最近の呼び出し: /admin/costs/calls
+########################################
+@admin_bp.route('/admin/costs/calls')
+def recent_calls():
+    """最近のプロバイダー呼び出しを新しい順に返す（列名=値 で絞り込み可）"""
+    return jsonify({
+        'success': True,
+        'calls': get_cost_ledger().recent(_limit(50), _filters()),
+        'stats': get_cost_ledger().get_stats(),
+    })
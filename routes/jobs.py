@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Job routes for the novel generator application.
+Submits generation jobs and exposes their state, events and results.
+"""
+
+import datetime
+import logging
+from typing import Any, Callable
+from flask import (
+    Blueprint, request, render_template, session, url_for, jsonify,
+    Response, stream_with_context
+)
+
+from services.job_queue import get_job_queue, JobQueueFullError, SUCCEEDED
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# Blueprint definition
+jobs_bp = Blueprint('jobs', __name__)
+
+def wants_job() -> bool:
+    """リクエストがジョブとしての非同期実行を求めているか（async=1 / {"async": true}）"""
+    if request.is_json:
+        return bool((request.get_json(silent=True) or {}).get('async'))
+    return request.values.get('async') == '1'
+
+def _wants_json() -> bool:
+    """HTMLではなくJSONで応答すべきリクエストか"""
+    return request.is_json or request.accept_mimetypes.best == 'application/json'
+
+def submit_generation_job(owner: str, kind: str, title: str,
+                          work: Callable[[], Any], finish: Callable[[Any], Any]) -> Any:
+    """
+    生成処理をジョブとして投入し、ジョブIDを含む応答を返す
+
+    work はワーカースレッドで実行されるため、request / session を参照しないこと。
+    finish は /jobs/<id>/finish のリクエスト内で work の戻り値を受け取って呼ばれ、
+    セッションへの保存と結果ページ（またはJSON）の生成を行います。
+
+    Args:
+        owner: クライアントID
+        kind: ジョブの種類（ルート名）
+        title: 待機画面に表示する処理名
+        work: プロバイダー呼び出しなどの重い処理
+        finish: 結果を反映して応答を返す関数
+
+    Returns:
+        Any: 202（JSON）または待機画面、キューが満杯の場合は503
+    """
+    try:
+        job_id = get_job_queue().submit(owner, kind, work, {'finish': finish, 'title': title})
+    except JobQueueFullError as e:
+        logger.warning(f"ジョブキューが満杯のため拒否: {kind}")
+        if _wants_json():
+            response = jsonify({'error': str(e), 'retry_after': e.retry_after})
+        else:
+            response = Response(render_template('error.html',
+                                                error_title='混雑中',
+                                                error_message=f'{str(e)}（約{e.retry_after}秒後）',
+                                                back_link='/',
+                                                datetime=datetime))
+        response.status_code = 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    urls = {
+        'status_url': url_for('jobs.job_status', job_id=job_id),
+        'events_url': url_for('jobs.job_events', job_id=job_id),
+        'cancel_url': url_for('jobs.cancel_job', job_id=job_id),
+        'finish_url': url_for('jobs.finish_job', job_id=job_id),
+    }
+    if _wants_json():
+        return jsonify({'job_id': job_id, 'state': 'queued', **urls}), 202
+    return render_template('job.html', job_id=job_id, title=title, **urls)
+
+########################################
+# ジョブ状態: /jobs/<job_id>
+########################################
+@jobs_bp.route('/jobs/<job_id>')
+def job_status(job_id):
+    """ジョブの状態（成功していれば結果も）をJSON形式で返す"""
+    queue = get_job_queue()
+    job = queue.get(job_id, session.get('client_id', ''))
+    if not job:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return jsonify(queue.describe(job))
+
+########################################
+# ジョブ状態の通知: /jobs/<job_id>/events
+########################################
+@jobs_bp.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """ジョブの状態変化を Server-Sent Events で配信する"""
+    queue = get_job_queue()
+    job = queue.get(job_id, session.get('client_id', ''))
+    if not job:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return Response(stream_with_context(queue.events(job)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+########################################
+# ジョブキャンセル: /jobs/<job_id>/cancel
+########################################
+@jobs_bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """待機中・実行中のジョブをキャンセルする"""
+    queue = get_job_queue()
+    if not queue.cancel(job_id, session.get('client_id', '')):
+        return jsonify({'error': 'キャンセルできるジョブが見つかりません'}), 404
+    return jsonify({'success': True, 'state': 'cancelled'})
+
+########################################
+# ジョブ結果の反映: /jobs/<job_id>/finish
+########################################
+@jobs_bp.route('/jobs/<job_id>/finish')
+def finish_job(job_id):
+    """成功したジョブの結果をセッションに反映し、通常の結果画面（またはJSON）を返す"""
+    owner = session.get('client_id', '')
+    queue = get_job_queue()
+    job = queue.pop_succeeded(job_id, owner)
+    if not job:
+        current = queue.get(job_id, owner)
+        if current and current['state'] != SUCCEEDED:
+            message = current['error'] or f"ジョブは {current['state']} 状態です"
+        else:
+            message = 'ジョブが見つからないか、既に結果を反映済みです。'
+        logger.warning(f"ジョブ結果反映エラー: {job_id}: {message}")
+        if _wants_json():
+            return jsonify({'error': message}), 409
+        return render_template('error.html',
+                              error_title='生成エラー',
+                              error_message=message,
+                              back_link='/',
+                              datetime=datetime)
+
+    try:
+        return job['meta']['finish'](job['result'])
+    except Exception as e:
+        logger.error(f"ジョブ結果反映エラー: {job['kind']} ({job_id}): {e}", exc_info=True)
+        if _wants_json():
+            return jsonify({'error': str(e)}), 500
+        return render_template('error.html',
+                              error_title='生成エラー',
+                              error_message=f"{job['meta']['title']}の結果を反映中にエラーが発生しました: {str(e)}",
+                              back_link='/',
+                              datetime=datetime)
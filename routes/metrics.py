@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Metrics routes for the novel generator application.
+Times every request and exposes all metrics at /metrics in the Prometheus text format.
+"""
+
+import time
+import logging
+from flask import Blueprint, Response, request, g
+
+from config import Config
+from utils.metrics import get_registry, instrument_session_interface, stats_collector, HTTP_REQUEST_SECONDS
+from utils.response_cache import get_cache_stats
+from utils.single_flight import get_single_flight_stats
+from utils.rate_limiter import get_rate_limit_stats
+from services.job_queue import get_job_stats
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# Blueprint definition
+metrics_bp = Blueprint('metrics', __name__)
+
+
+def _rate_limit_stats() -> dict:
+    """レート制限の待ち時間をプロバイダー・APIキーの組ごとに並べ替える"""
+    limiters = get_rate_limit_stats()['limiters']
+    keys = ('waited', 'wait_seconds_total', 'refused', 'rejected_by_provider')
+    return {key: {name: snapshot[key] for name, snapshot in limiters.items()} for key in keys}
+
+
+# スクレイプ時に各モジュールの統計を読む（既存の /status/* と同じ値）
+_registry = get_registry()
+_registry.register_collector(stats_collector(
+    'novel_response_cache', '応答キャッシュ', get_cache_stats,
+    {k: 'counter' for k in ('hits_memory', 'hits_disk', 'misses', 'stores', 'evictions_memory', 'evictions_disk',
+                            'disk_errors')}))
+_registry.register_collector(stats_collector(
+    'novel_single_flight', 'シングルフライト', get_single_flight_stats,
+    {k: 'counter' for k in ('calls', 'executed', 'coalesced', 'coalesced_cross_process')}))
+_registry.register_collector(stats_collector(
+    'novel_jobs', '生成ジョブキュー', get_job_stats, {'totals': 'counter'}))
+_registry.register_collector(stats_collector(
+    'novel_rate_limit', 'クライアント側レート制限', _rate_limit_stats,
+    {k: 'counter' for k in ('waited', 'wait_seconds_total', 'refused', 'rejected_by_provider')}))
+
+
+@metrics_bp.record_once
+def _instrument_app(state) -> None:
+    """アプリ登録時にセッションストアの読み書きを計測対象にする"""
+    if Config.METRICS_ENABLED:
+        instrument_session_interface(state.app.session_interface)
+
+
+@metrics_bp.before_app_request
+def _start_timer() -> None:
+    g.metrics_start = time.perf_counter()
+
+
+@metrics_bp.after_app_request
+def _observe_request(response: Response) -> Response:
+    """ルート（URLルール）単位で処理時間を記録する（未定義のURLは 'unmatched' にまとめる）"""
+    start = g.pop('metrics_start', None)
+    if start is None or not Config.METRICS_ENABLED:
+        return response
+    rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        blueprint=request.blueprint or '', route=rule, method=request.method, status=response.status_code
+    )
+    return response
+
+########################################
+# メトリクス: /metrics
+########################################
+@metrics_bp.route('/metrics')
+def metrics():
+    """すべてのメトリクスをPrometheusのテキスト形式で返す（外部のメトリクスサーバーは不要）"""
+    if not Config.METRICS_ENABLED:
+        return Response('metrics disabled\n', status=404, mimetype='text/plain')
+    return Response(_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
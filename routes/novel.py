@@ -9,21 +9,36 @@ Handles story generation, synopsis, and episode generation.
 import os
 import json
 import time
+import uuid
+import hashlib
 import datetime
 import logging
 import markdown
-from flask import Blueprint, request, render_template, session, redirect, url_for, jsonify, flash, current_app
+from typing import Dict, Any, List, Tuple
+from flask import (
+    Blueprint, request, render_template, session, redirect, url_for, jsonify, flash, current_app,
+    Response, stream_with_context
+)
 
 # 一時的な修正: パッケージ構造が完成するまで直接utilsからインポート
+from config import Config
 from utils import (
-    parse_synopsis, call_api_for_novel, get_episode_summary,
+    parse_synopsis, call_api_for_novel,
     generate_random_character_legacy
 )
+from utils.token_budget import estimate_tokens, max_tokens_for_chars, fit_prompt, cache_break
+from utils.tracing import span, traced
+from utils.cost_ledger import update_call_tags
 from services.novel_templates import (
     load_templates, get_template_by_id,
     load_writing_styles, get_style_by_id, get_random_murakami_style,
     load_story_structures, get_structure_by_id
 )
+from services.streaming_service import create_stream, get_stream, pop_completed_stream, run_stream
+from services.summary_service import schedule_summary, apply_ready_summary, get_summary
+from services.story_memory import new_memory, update_story_memory, build_story_context
+from services.draft_service import draft_episodes, smooth_continuity, write_long_episode
+from .jobs import wants_job, submit_generation_job
 
 # ロギングの設定
 logger = logging.getLogger('novel_generator')
@@ -31,6 +46,138 @@ logger = logging.getLogger('novel_generator')
 # Blueprint definition
 novel_bp = Blueprint('novel', __name__)
 
+# 同じフォーム内容の送信を二重送信とみなして同じ文体を選ぶ時間幅（秒）
+STYLE_SEED_WINDOW = 30
+
+def _get_client_id() -> str:
+    """セッションに紐づくクライアントIDを取得（なければ発行）する"""
+    if 'client_id' not in session:
+        session['client_id'] = uuid.uuid4().hex
+    return session['client_id']
+
+def _start_novel() -> str:
+    """新しい作品のIDを発行し、以降のプロバイダー呼び出しをその作品としてコスト台帳に記録する"""
+    session['novel_id'] = uuid.uuid4().hex
+    update_call_tags(session_id=_get_client_id(), novel_id=session['novel_id'])
+    return session['novel_id']
+
+def _novel_setting_sections(prompt: str, characters: List[Dict[str, str]], essential_settings: str,
+                            explicit_level: str, detail_level: str, psychological_level: str) -> List[Tuple[str, int]]:
+    """
+    エピソード執筆プロンプトの先頭に置く、作品内で変わらないセクション（(セクション, 優先度) のリスト）
+
+    あらすじの生成・修正、第1話と第2話以降で同じ文字列になるようにし、プロバイダーのプロンプトキャッシュで先頭部分を共有させます。
+    文体は話ごとに選び直される（自動選択）ため含めません。
+    """
+    sections = [("あなたは官能小説作家です。以下の設定と情報に基づいて、官能小説を執筆してください。\n\n", 0)]
+    
+    if characters:
+        character_lines = ''.join(f"{c['name']}: {c['description']}\n" for c in characters)
+        sections.append((f"### 登場人物:\n{character_lines}\n", 0))
+    
+    if essential_settings:
+        sections.append((f"### 絶対守るべき設定:\n{essential_settings}\n\n", 0))
+    
+    # 淫語レベル設定を追加
+    sections.append((
+        f"### 表現レベル設定:\n"
+        f"- 淫語レベル: {explicit_level}% (値が高いほど直接的で卑猥な表現を使用)\n"
+        f"- 描写詳細度: {detail_level}% (値が高いほど細部までの生々しい描写)\n"
+        f"- 心理描写の深さ: {psychological_level}% (値が高いほど登場人物の内面を掘り下げる)\n\n", 0
+    ))
+    sections.append((f"### メインプロンプト:\n{prompt}\n\n", 0))
+    return sections
+
+def _style_sections(murakami_style: Dict[str, Any], sample_priority: int) -> List[Tuple[str, int]]:
+    """文体指定のセクション（固定部分の最後に置き、同じ文体が続く間はキャッシュに載る）"""
+    return [
+        (f"### 文体:\n{murakami_style['name']}の文体で書いてください。{murakami_style['description']}\n", 0),
+        (f"サンプル文: {murakami_style.get('sample', '')}\n\n", sample_priority),
+    ]
+
+def _first_episode_sections(setting_sections: List[Tuple[str, int]], murakami_style: Dict[str, Any],
+                            episode_synopsis: str) -> List[Tuple[str, int]]:
+    """
+    第1話執筆用プロンプトのセクション
+
+    作品内で変わらない設定を先頭に、話ごとに変わる内容を区切りの後ろに置きます（第2話以降と先頭部分を共有する）。
+    """
+    sections = setting_sections + [cache_break()]
+    sections.append((
+        "### 指示:\n"
+        "- 官能小説として魅力的で詳細な描写を心がけてください\n"
+        "- 800〜1000文字程度で執筆してください\n"
+        "- 各段落の最初は字下げし、会話文は「」で囲んでください\n"
+        "- 適切に改行を入れて読みやすくしてください\n"
+        "- 村上龍風の特徴である「生々しい描写」「都市の孤独」「機械的な性描写」などを活かしてください\n"
+        "- キャラクターの内面の葛藤や感情を丁寧に描写してください\n"
+        "- 物語の導入として読者の興味を引く展開を心がけてください\n\n", 0
+    ))
+    sections.append(cache_break())
+    sections += _style_sections(murakami_style, sample_priority=1)
+    sections.append(cache_break())
+    sections.append((f"### 第1話のあらすじ:\n{episode_synopsis}\n\n", 0))
+    sections.append(("以上の設定と第1話のあらすじに基づいて、官能小説の第1話を執筆してください。\n", 0))
+    return sections
+
+def _next_episode_fixed_sections(setting_sections: List[Tuple[str, int]],
+                                 murakami_style: Dict[str, Any]) -> List[Tuple[str, int]]:
+    """
+    第2話以降の執筆用プロンプトの固定部分（設定・連続性と執筆の指示・文体）
+
+    話ごとに変わる内容（あらすじ・前話の要約など）は呼び出し元で後ろに追加します。
+    """
+    sections = setting_sections + [cache_break()]
+    
+    # 連続性を保つための指示
+    sections.append((
+        "### 連続性の指示:\n"
+        "- 前話からのキャラクターの関係性や状況を維持してください\n"
+        "- 前のエピソードで始まったストーリーを自然に発展させてください\n"
+        "- 登場人物の内面的変化や感情の変化を前のエピソードからの発展として描写してください\n"
+        "- 前話との整合性を保ちながら物語を展開させてください\n\n", 0
+    ))
+    
+    sections.append((
+        "### 執筆指示:\n"
+        "- 官能小説として魅力的で詳細な描写を心がけてください\n"
+        "- 800〜1000文字程度で執筆してください\n"
+        "- 各段落の最初は字下げし、会話文は「」で囲んでください\n"
+        "- 適切に改行を入れて読みやすくしてください\n"
+        "- 前話からの自然な流れを意識してください\n"
+        "- 村上龍風の特徴である「生々しい描写」「都市の孤独」「機械的な性描写」などを活かしてください\n\n", 0
+    ))
+    sections.append(cache_break())
+    sections += _style_sections(murakami_style, sample_priority=2)
+    sections.append(cache_break())
+    return sections
+
+def _write_episode(model_choice: str, episode_prompt: str, max_tokens: int, long_form: bool) -> str:
+    """
+    1話分の本文を執筆する
+
+    長編モードでは構成案を作ってから場面ごとに並行して執筆し、LONG_EPISODE_TARGET_CHARS 文字程度にします。
+    """
+    if long_form:
+        return write_long_episode(model_choice, episode_prompt, Config.LONG_EPISODE_TARGET_CHARS)
+    return call_api_for_novel(model_choice, episode_prompt, max_tokens=max_tokens)
+
+def _markdown_to_html(text: str) -> str:
+    """エピソード本文をHTMLに変換する（トレースには markdown スパンとして記録する）"""
+    with span('markdown', chars=len(text)):
+        return markdown.markdown(text)
+
+def _style_seed() -> str:
+    """
+    文体のランダム選択に使うシード
+
+    二重送信やブラウザの再送で届いた同じリクエストが同じ文体を選び、
+    同一のプロンプトとしてプロバイダー呼び出しを共有できるようにします。
+    """
+    form = json.dumps(sorted(request.form.items(multi=True)), ensure_ascii=False)
+    fingerprint = hashlib.sha256(form.encode('utf-8')).hexdigest()
+    return f"{_get_client_id()}:{fingerprint}:{int(time.time() // STYLE_SEED_WINDOW)}"
+
 ########################################
 # ルート: ホーム
 ########################################
@@ -108,6 +255,7 @@ def generate_synopsis():
     try:
         start_time = time.time()
         logger.info("あらすじ生成開始")
+        _start_novel()
         
         # フォーム入力の取得
         prompt = request.form.get('prompt', '')
@@ -140,86 +288,89 @@ def generate_synopsis():
             if name:  # 名前がある場合のみキャラクターとして追加
                 characters.append({'name': name, 'description': desc})
         
-        # 生成用プロンプトの組み立て（あらすじ用）
-        synopsis_prompt = "あなたは官能小説作家です。以下の設定に基づいて、官能小説の3話分のあらすじを作成してください。\n\n"
-        synopsis_prompt += f"### メインプロンプト:\n{prompt}\n\n"
-        
         # 村上龍風文体を指定
-        murakami_style = get_random_murakami_style()
-        synopsis_prompt += f"### 文体:\n{murakami_style['name']}の文体で書いてください。{murakami_style['description']}\n\n"
-            
-        if characters:
-            synopsis_prompt += "### 登場人物:\n"
-            for c in characters:
-                synopsis_prompt += f"{c['name']}: {c['description']}\n"
-            synopsis_prompt += "\n"
-            
-        if essential_settings:
-            synopsis_prompt += f"### 絶対守るべき設定:\n{essential_settings}\n\n"
-        
-        # 淫語レベル設定を追加
-        synopsis_prompt += f"### 表現レベル設定:\n"
-        synopsis_prompt += f"- 淫語レベル: {explicit_level}% (値が高いほど直接的で卑猥な表現を使用)\n"
-        synopsis_prompt += f"- 描写詳細度: {detail_level}% (値が高いほど細部までの生々しい描写)\n"
-        synopsis_prompt += f"- 心理描写の深さ: {psychological_level}% (値が高いほど登場人物の内面を掘り下げる)\n\n"
-        
-        # ストーリー構造を追加
-        if selected_structure:
-            synopsis_prompt += f"### ストーリー構造:\n{selected_structure}構造で展開してください。\n\n"
-        
-        synopsis_prompt += (
+        murakami_style = get_random_murakami_style(_style_seed())
+        
+        # 生成用プロンプトの組み立て（あらすじ用）。作品の設定・文体はエピソード執筆と同じセクションを先頭に置き、
+        # プロバイダーのプロンプトキャッシュで第1話以降の呼び出しと共有させる
+        sections = _novel_setting_sections(prompt, characters, essential_settings,
+                                           explicit_level, detail_level, psychological_level)
+        sections.append(cache_break())
+        sections.append((
             "### 指示:\n"
             "- 3話分のあらすじを作成してください\n"
             "- 各話は明確に「第1話:」「第2話:」「第3話:」などのラベルを付けてください\n"
             "- 各話は200〜300文字程度で簡潔に要約してください\n"
             "- 1話目は導入、2話目は展開、3話目はクライマックスになるよう構成してください\n"
             "- 官能描写のあるシーンは「〜〜という情事があった」など簡潔に示してください\n"
-            "- 村上龍風の特徴である「生々しい描写」「都市の孤独」「機械的な性描写」などを活かしてください\n"
-        )
+            "- 村上龍風の特徴である「生々しい描写」「都市の孤独」「機械的な性描写」などを活かしてください\n\n", 0
+        ))
+        sections.append(cache_break())
+        sections += _style_sections(murakami_style, sample_priority=1)
+        sections.append(cache_break())
         
-        logger.info(f"あらすじ生成プロンプト: {len(synopsis_prompt)}文字")
+        # ストーリー構造を追加
+        if selected_structure:
+            sections.append((f"### ストーリー構造:\n{selected_structure}構造で展開してください。\n\n", 0))
+        sections.append(("以上の設定に基づいて、この官能小説の3話分のあらすじを作成してください。\n", 0))
         
-        # API 呼び出しであらすじ生成
-        synopsis_result = call_api_for_novel(model_choice, synopsis_prompt, max_tokens=1500)
+        synopsis_prompt = fit_prompt(sections, model_choice)
         
-        # あらすじを3つに分割（強化した解析関数を使用）
-        synopsis_parts = parse_synopsis(synopsis_result)
+        max_tokens = max_tokens_for_chars(model_choice, Config.SYNOPSIS_TARGET_CHARS)
+        logger.info(f"あらすじ生成プロンプト: {len(synopsis_prompt)}文字, "
+                    f"推定{estimate_tokens(synopsis_prompt, model_choice)}トークン, max_tokens={max_tokens}")
         
-        # セッションに保存
-        session['prompt'] = prompt
-        session['model_choice'] = model_choice
-        session['writing_style'] = writing_style
-        session['essential_settings'] = essential_settings
-        session['characters'] = characters
-        session['synopsis'] = synopsis_parts
-        session['episodes'] = []
-        session['explicit_level'] = explicit_level
-        session['detail_level'] = detail_level
-        session['psychological_level'] = psychological_level
-        session['murakami_style'] = murakami_style['id']  # 使用する村上龍風のバリエーションを保存
-        
-        # JSONとして保存するためのシリアライズ
-        synopsis_json = json.dumps(synopsis_parts)
-        
-        elapsed_time = time.time() - start_time
-        logger.info(f"あらすじ生成完了: 所要時間={elapsed_time:.2f}秒")
-        
-        return render_template('synopsis.html', 
-                              synopsis=synopsis_parts,
-                              synopsis_json=synopsis_json,
-                              prompt=prompt,
-                              model_choice=model_choice,
-                              writing_style=writing_style,
-                              essential_settings=essential_settings,
-                              characters=characters,
-                              explicit_level=explicit_level,
-                              detail_level=detail_level,
-                              psychological_level=psychological_level,
-                              datetime=datetime,
-                              notification={
-                                  'message': 'あらすじの生成が完了しました。内容を確認してください。',
-                                  'type': 'success'
-                              })
+        def finish(synopsis_result: str):
+            """生成されたあらすじを解析・保存し、あらすじ画面を返す"""
+            # あらすじを3つに分割（強化した解析関数を使用）
+            synopsis_parts = parse_synopsis(synopsis_result)
+            
+            # セッションに保存
+            session['prompt'] = prompt
+            session['model_choice'] = model_choice
+            session['writing_style'] = writing_style
+            session['essential_settings'] = essential_settings
+            session['characters'] = characters
+            session['synopsis'] = synopsis_parts
+            session['episodes'] = []
+            session['story_memory'] = new_memory()
+            session['explicit_level'] = explicit_level
+            session['detail_level'] = detail_level
+            session['psychological_level'] = psychological_level
+            session['murakami_style'] = murakami_style['id']  # 使用する村上龍風のバリエーションを保存
+            
+            # JSONとして保存するためのシリアライズ
+            synopsis_json = json.dumps(synopsis_parts)
+            
+            elapsed_time = time.time() - start_time
+            logger.info(f"あらすじ生成完了: 所要時間={elapsed_time:.2f}秒")
+            
+            return render_template('synopsis.html', 
+                                  synopsis=synopsis_parts,
+                                  synopsis_json=synopsis_json,
+                                  prompt=prompt,
+                                  model_choice=model_choice,
+                                  writing_style=writing_style,
+                                  essential_settings=essential_settings,
+                                  characters=characters,
+                                  explicit_level=explicit_level,
+                                  detail_level=detail_level,
+                                  psychological_level=psychological_level,
+                                  datetime=datetime,
+                                  notification={
+                                      'message': 'あらすじの生成が完了しました。内容を確認してください。',
+                                      'type': 'success'
+                                  })
+        
+        # 非同期モード: ジョブとして投入し、結果は /jobs/<job_id>/finish で反映する
+        if wants_job():
+            return submit_generation_job(_get_client_id(), 'generate_synopsis', 'あらすじ生成',
+                                         lambda: call_api_for_novel(model_choice, synopsis_prompt, max_tokens=max_tokens),
+                                         finish)
+        
+        # API 呼び出しであらすじ生成
+        synopsis_result = call_api_for_novel(model_choice, synopsis_prompt, max_tokens=max_tokens)
+        return finish(synopsis_result)
     except Exception as e:
         logger.error(f"あらすじ生成エラー: {e}", exc_info=True)
         # エラーページを表示
@@ -260,87 +411,91 @@ def revise_synopsis():
             logger.error("あらすじJSONのパースに失敗")
             current_synopsis = {'episode1': '', 'episode2': '', 'episode3': ''}
         
-        # 修正用プロンプトの組み立て
-        revision_prompt = "あなたは官能小説作家です。以下の3話分のあらすじを修正指示に従って書き直してください。\n\n"
-        revision_prompt += f"### 現在のあらすじ:\n\n"
-        revision_prompt += f"第1話:\n{current_synopsis.get('episode1', '')}\n\n"
-        revision_prompt += f"第2話:\n{current_synopsis.get('episode2', '')}\n\n"
-        revision_prompt += f"第3話:\n{current_synopsis.get('episode3', '')}\n\n"
-        revision_prompt += f"### 修正指示:\n{revision_instructions}\n\n"
-        revision_prompt += f"### 元の設定:\n{prompt}\n\n"
-        
         # 村上龍風文体を指定
         murakami_style_id = session.get('murakami_style', 'murakami_ryu_1')
         murakami_style = get_style_by_id(murakami_style_id) or get_random_murakami_style()
-        revision_prompt += f"### 文体:\n{murakami_style['name']}の文体で書いてください。{murakami_style['description']}\n\n"
-            
-        if characters:
-            revision_prompt += "### 登場人物:\n"
-            for c in characters:
-                revision_prompt += f"{c['name']}: {c['description']}\n"
-            revision_prompt += "\n"
-            
-        if essential_settings:
-            revision_prompt += f"### 絶対守るべき設定:\n{essential_settings}\n\n"
-        
-        # 淫語レベル設定を追加
-        revision_prompt += f"### 表現レベル設定:\n"
-        revision_prompt += f"- 淫語レベル: {explicit_level}% (値が高いほど直接的で卑猥な表現を使用)\n"
-        revision_prompt += f"- 描写詳細度: {detail_level}% (値が高いほど細部までの生々しい描写)\n"
-        revision_prompt += f"- 心理描写の深さ: {psychological_level}% (値が高いほど登場人物の内面を掘り下げる)\n\n"
         
-        revision_prompt += (
+        # 修正用プロンプトの組み立て（先頭の設定・文体はあらすじ生成・エピソード執筆と共通）
+        sections = _novel_setting_sections(prompt, characters, essential_settings,
+                                           explicit_level, detail_level, psychological_level)
+        sections.append(cache_break())
+        sections.append((
             "### 指示:\n"
             "- 3話分のあらすじを修正指示に従って書き直してください\n"
             "- 各話は明確に「第1話:」「第2話:」「第3話:」などのラベルを付けてください\n"
             "- 各話は200〜300文字程度で簡潔に要約してください\n"
             "- 1話目は導入、2話目は展開、3話目はクライマックスになるよう構成してください\n"
             "- 官能描写のあるシーンは「〜〜という情事があった」など簡潔に示してください\n"
-            "- 村上龍風の特徴である「生々しい描写」「都市の孤独」「機械的な性描写」などを活かしてください\n"
-        )
-        
-        logger.info(f"あらすじ修正プロンプト: {len(revision_prompt)}文字")
+            "- 村上龍風の特徴である「生々しい描写」「都市の孤独」「機械的な性描写」などを活かしてください\n\n", 0
+        ))
+        sections.append(cache_break())
+        sections += _style_sections(murakami_style, sample_priority=1)
+        sections.append(cache_break())
+        sections.append((
+            f"### 現在のあらすじ:\n\n"
+            f"第1話:\n{current_synopsis.get('episode1', '')}\n\n"
+            f"第2話:\n{current_synopsis.get('episode2', '')}\n\n"
+            f"第3話:\n{current_synopsis.get('episode3', '')}\n\n", 0
+        ))
+        sections.append((f"### 修正指示:\n{revision_instructions}\n\n", 0))
+        sections.append(("以上の設定に基づいて、現在の3話分のあらすじを修正指示に従って書き直してください。\n", 0))
+        
+        revision_prompt = fit_prompt(sections, model_choice)
+        
+        max_tokens = max_tokens_for_chars(model_choice, Config.SYNOPSIS_TARGET_CHARS)
+        logger.info(f"あらすじ修正プロンプト: {len(revision_prompt)}文字, "
+                    f"推定{estimate_tokens(revision_prompt, model_choice)}トークン, max_tokens={max_tokens}")
+        
+        def finish(revised_synopsis: str):
+            """修正されたあらすじを解析・保存し、あらすじ画面を返す"""
+            # あらすじを3つに分割（強化した解析関数を使用）
+            synopsis_parts = parse_synopsis(revised_synopsis)
+            
+            # セッションに保存
+            session['prompt'] = prompt
+            session['model_choice'] = model_choice
+            session['writing_style'] = writing_style
+            session['essential_settings'] = essential_settings
+            session['characters'] = characters
+            session['synopsis'] = synopsis_parts
+            session['episodes'] = []
+            session['story_memory'] = new_memory()
+            session['explicit_level'] = explicit_level
+            session['detail_level'] = detail_level
+            session['psychological_level'] = psychological_level
+            
+            # JSONとして保存するためのシリアライズ
+            synopsis_json = json.dumps(synopsis_parts)
+            
+            elapsed_time = time.time() - start_time
+            logger.info(f"あらすじ修正完了: 所要時間={elapsed_time:.2f}秒")
+            
+            return render_template('synopsis.html', 
+                                  synopsis=synopsis_parts,
+                                  synopsis_json=synopsis_json,
+                                  prompt=prompt,
+                                  model_choice=model_choice,
+                                  writing_style=writing_style,
+                                  essential_settings=essential_settings,
+                                  characters=characters,
+                                  explicit_level=explicit_level,
+                                  detail_level=detail_level,
+                                  psychological_level=psychological_level,
+                                  datetime=datetime,
+                                  notification={
+                                      'message': 'あらすじの修正が完了しました。内容を確認してください。',
+                                      'type': 'success'
+                                  })
+        
+        # 非同期モード: ジョブとして投入し、結果は /jobs/<job_id>/finish で反映する
+        if wants_job():
+            return submit_generation_job(_get_client_id(), 'revise_synopsis', 'あらすじ修正',
+                                         lambda: call_api_for_novel(model_choice, revision_prompt, max_tokens=max_tokens),
+                                         finish)
         
         # API 呼び出しであらすじ修正
-        revised_synopsis = call_api_for_novel(model_choice, revision_prompt, max_tokens=1500)
-        
-        # あらすじを3つに分割（強化した解析関数を使用）
-        synopsis_parts = parse_synopsis(revised_synopsis)
-        
-        # セッションに保存
-        session['prompt'] = prompt
-        session['model_choice'] = model_choice
-        session['writing_style'] = writing_style
-        session['essential_settings'] = essential_settings
-        session['characters'] = characters
-        session['synopsis'] = synopsis_parts
-        session['episodes'] = []
-        session['explicit_level'] = explicit_level
-        session['detail_level'] = detail_level
-        session['psychological_level'] = psychological_level
-        
-        # JSONとして保存するためのシリアライズ
-        synopsis_json = json.dumps(synopsis_parts)
-        
-        elapsed_time = time.time() - start_time
-        logger.info(f"あらすじ修正完了: 所要時間={elapsed_time:.2f}秒")
-        
-        return render_template('synopsis.html', 
-                              synopsis=synopsis_parts,
-                              synopsis_json=synopsis_json,
-                              prompt=prompt,
-                              model_choice=model_choice,
-                              writing_style=writing_style,
-                              essential_settings=essential_settings,
-                              characters=characters,
-                              explicit_level=explicit_level,
-                              detail_level=detail_level,
-                              psychological_level=psychological_level,
-                              datetime=datetime,
-                              notification={
-                                  'message': 'あらすじの修正が完了しました。内容を確認してください。',
-                                  'type': 'success'
-                              })
+        revised_synopsis = call_api_for_novel(model_choice, revision_prompt, max_tokens=max_tokens)
+        return finish(revised_synopsis)
     except Exception as e:
         logger.error(f"あらすじ修正エラー: {e}", exc_info=True)
         # エラーページを表示
@@ -370,6 +525,9 @@ def start_writing():
         detail_level = request.form.get('detail_level', '80')
         psychological_level = request.form.get('psychological_level', '60')
         
+        # 長編モード（場面ごとに並行して執筆する。逐次表示はしない）
+        long_form = request.form.get('long_form') == '1'
+        
         # キャラクター情報の取得
         characters = session.get('characters', [])
         
@@ -384,45 +542,15 @@ def start_writing():
         murakami_style_id = session.get('murakami_style', 'murakami_ryu_1')
         murakami_style = get_style_by_id(murakami_style_id) or get_random_murakami_style()
         
-        # 第1話執筆用プロンプトの組み立て
-        episode_prompt = "あなたは官能小説作家です。以下の設定と第1話のあらすじに基づいて、官能小説の第1話を執筆してください。\n\n"
-        episode_prompt += f"### メインプロンプト:\n{prompt}\n\n"
-        episode_prompt += f"### 第1話のあらすじ:\n{synopsis.get('episode1', '')}\n\n"
-        
-        # 文体指定
-        episode_prompt += f"### 文体:\n{murakami_style['name']}の文体で書いてください。{murakami_style['description']}\n"
-        episode_prompt += f"サンプル文: {murakami_style.get('sample', '')}\n\n"
-            
-        if characters:
-            episode_prompt += "### 登場人物:\n"
-            for c in characters:
-                episode_prompt += f"{c['name']}: {c['description']}\n"
-            episode_prompt += "\n"
-            
-        if essential_settings:
-            episode_prompt += f"### 絶対守るべき設定:\n{essential_settings}\n\n"
-        
-        # 淫語レベル設定を追加
-        episode_prompt += f"### 表現レベル設定:\n"
-        episode_prompt += f"- 淫語レベル: {explicit_level}% (値が高いほど直接的で卑猥な表現を使用)\n"
-        episode_prompt += f"- 描写詳細度: {detail_level}% (値が高いほど細部までの生々しい描写)\n"
-        episode_prompt += f"- 心理描写の深さ: {psychological_level}% (値が高いほど登場人物の内面を掘り下げる)\n\n"
+        # 第1話執筆用プロンプトの組み立て（(セクション, 優先度)。優先度1以上は予算超過時に縮める）
+        setting_sections = _novel_setting_sections(prompt, characters, essential_settings,
+                                                   explicit_level, detail_level, psychological_level)
+        sections = _first_episode_sections(setting_sections, murakami_style, synopsis.get('episode1', ''))
         
-        episode_prompt += (
-            "### 指示:\n"
-            "- 官能小説として魅力的で詳細な描写を心がけてください\n"
-            "- 800〜1000文字程度で執筆してください\n"
-            "- 各段落の最初は字下げし、会話文は「」で囲んでください\n"
-            "- 適切に改行を入れて読みやすくしてください\n"
-            "- 村上龍風の特徴である「生々しい描写」「都市の孤独」「機械的な性描写」などを活かしてください\n"
-            "- キャラクターの内面の葛藤や感情を丁寧に描写してください\n"
-            "- 物語の導入として読者の興味を引く展開を心がけてください\n"
-        )
-        
-        logger.info(f"第1話執筆プロンプト: {len(episode_prompt)}文字")
-        
-        # API 呼び出しで第1話執筆
-        episode_text = call_api_for_novel(model_choice, episode_prompt, max_tokens=2000)
+        episode_prompt = fit_prompt(sections, model_choice)
+        max_tokens = max_tokens_for_chars(model_choice, Config.EPISODE_TARGET_CHARS)
+        logger.info(f"第1話執筆プロンプト: {len(episode_prompt)}文字, "
+                    f"推定{estimate_tokens(episode_prompt, model_choice)}トークン, max_tokens={max_tokens}")
         
         # セッションに保存
         session['prompt'] = prompt
@@ -435,38 +563,62 @@ def start_writing():
         session['detail_level'] = detail_level
         session['psychological_level'] = psychological_level
         
-        # エピソード情報を保存
-        episodes = session.get('episodes', [])
-        episodes.append({
-            'number': 1,
-            'text': episode_text,
-            'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'style': murakami_style['name']
-        })
-        session['episodes'] = episodes
-        
-        # マークダウンからHTMLに変換
-        episode_html = markdown.markdown(episode_text)
-        
-        elapsed_time = time.time() - start_time
-        logger.info(f"第1話執筆完了: 所要時間={elapsed_time:.2f}秒, 文字数={len(episode_text)}")
+        # ストリーミングモード: 本文は /stream/<stream_id> で逐次送信し、完了後に保存する
+        if request.form.get('stream') == '1' and not long_form:
+            stream_id = create_stream(_get_client_id(), model_choice, lambda: episode_prompt, max_tokens,
+                                      {'number': 1, 'style': murakami_style['name']})
+            return render_template('streaming.html',
+                                  stream_url=url_for('novel.stream_episode', stream_id=stream_id),
+                                  finish_url=url_for('novel.finish_stream', stream_id=stream_id),
+                                  episode_number=1,
+                                  current_style=murakami_style['name'])
+        
+        def finish(episode_text: str):
+            """執筆された第1話をエピソードとして保存し、結果画面を返す"""
+            # エピソード情報を保存
+            episodes = session.get('episodes', [])
+            episodes.append({
+                'number': 1,
+                'text': episode_text,
+                'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'style': murakami_style['name'],
+                # 次話執筆で使う要約はバックグラウンドで先に生成しておく
+                'summary_hash': schedule_summary(episode_text, model_choice)
+            })
+            session['episodes'] = episodes
+            
+            # マークダウンからHTMLに変換
+            episode_html = _markdown_to_html(episode_text)
+            
+            elapsed_time = time.time() - start_time
+            logger.info(f"第1話執筆完了: 所要時間={elapsed_time:.2f}秒, 文字数={len(episode_text)}")
+            
+            return render_template('result.html',
+                                  novel=episode_html,
+                                  episodes=episodes,
+                                  current_episode=1,
+                                  prompt=prompt,
+                                  writing_style=writing_style,
+                                  model_choice=model_choice,
+                                  explicit_level=explicit_level,
+                                  detail_level=detail_level,
+                                  psychological_level=psychological_level,
+                                  current_style=murakami_style['name'],
+                                  datetime=datetime,  # datetimeモジュールを追加
+                                  notification={
+                                      'message': '第1話の執筆が完了しました。',
+                                      'type': 'success'
+                                  })
+        
+        # 非同期モード: ジョブとして投入し、結果は /jobs/<job_id>/finish で反映する
+        if wants_job():
+            return submit_generation_job(_get_client_id(), 'start_writing', '第1話の執筆',
+                                         lambda: _write_episode(model_choice, episode_prompt, max_tokens, long_form),
+                                         finish)
         
-        return render_template('result.html',
-                              novel=episode_html,
-                              episodes=episodes,
-                              current_episode=1,
-                              prompt=prompt,
-                              writing_style=writing_style,
-                              model_choice=model_choice,
-                              explicit_level=explicit_level,
-                              detail_level=detail_level,
-                              psychological_level=psychological_level,
-                              current_style=murakami_style['name'],
-                              datetime=datetime,  # datetimeモジュールを追加
-                              notification={
-                                  'message': '第1話の執筆が完了しました。',
-                                  'type': 'success'
-                              })
+        # API 呼び出しで第1話執筆
+        episode_text = _write_episode(model_choice, episode_prompt, max_tokens, long_form)
+        return finish(episode_text)
     except Exception as e:
         logger.error(f"第1話執筆エラー: {e}", exc_info=True)
         # エラーページを表示
@@ -476,6 +628,124 @@ def start_writing():
                               back_link='/',
                               datetime=datetime)
 
+########################################
+# 第1〜3話の一括執筆: /draft_all
+########################################
+@novel_bp.route('/draft_all', methods=['POST'])
+def draft_all():
+    """あらすじから第1〜3話を並行して執筆し、話のつなぎ目を整えてからまとめて保存する"""
+    try:
+        start_time = time.time()
+        logger.info("第1〜3話一括執筆開始")
+        
+        prompt = request.form.get('prompt', '')
+        model_choice = request.form.get('model_choice', 'xai')  # デフォルトはxAI
+        writing_style = request.form.get('writing_style', '村上龍風')
+        essential_settings = request.form.get('essential_settings', '')
+        synopsis_data = request.form.get('synopsis_data', '{}')
+        
+        # 淫語レベル設定の取得
+        explicit_level = request.form.get('explicit_level', '70')
+        detail_level = request.form.get('detail_level', '80')
+        psychological_level = request.form.get('psychological_level', '60')
+        
+        # キャラクター情報の取得
+        characters = session.get('characters', [])
+        
+        # あらすじをJSONから復元
+        try:
+            synopsis = json.loads(synopsis_data)
+        except ValueError:
+            logger.error("あらすじJSONのパースに失敗")
+            synopsis = {'episode1': '', 'episode2': '', 'episode3': ''}
+        
+        # 3話とも同じ村上龍風文体バリエーションで書く
+        murakami_style_id = session.get('murakami_style', 'murakami_ryu_1')
+        murakami_style = get_style_by_id(murakami_style_id) or get_random_murakami_style()
+        
+        # 各話のプロンプト（第2・3話は前話の本文がまだないため、前話の要約の代わりに前話のあらすじを渡す）
+        setting_sections = _novel_setting_sections(prompt, characters, essential_settings,
+                                                   explicit_level, detail_level, psychological_level)
+        episode_prompts = [fit_prompt(_first_episode_sections(setting_sections, murakami_style,
+                                                              synopsis.get('episode1', '')), model_choice)]
+        for number in (2, 3):
+            sections = _next_episode_fixed_sections(setting_sections, murakami_style)
+            sections.append((f"### 第{number}話のあらすじ:\n{synopsis.get(f'episode{number}', '')}\n\n", 0))
+            previous_synopsis = synopsis.get(f'episode{number - 1}', '')
+            sections.append((f"### 前話（第{number - 1}話）のあらすじ:\n{previous_synopsis}\n\n", 0))
+            sections.append((f"以上の設定と情報に基づいて、官能小説の第{number}話を執筆してください。\n", 0))
+            episode_prompts.append(fit_prompt(sections, model_choice))
+        max_tokens = max_tokens_for_chars(model_choice, Config.EPISODE_TARGET_CHARS)
+        logger.info(f"第1〜3話執筆プロンプト: {[len(p) for p in episode_prompts]}文字, max_tokens={max_tokens}")
+        
+        def work() -> List[str]:
+            """3話を並行して執筆し、つなぎ目を整える"""
+            texts = draft_episodes(model_choice, episode_prompts, max_tokens)
+            return smooth_continuity(model_choice, texts)
+        
+        def finish(episode_texts: List[str]):
+            """執筆された3話をエピソード一覧として保存し、第3話の結果画面を返す"""
+            # 3話とも執筆できた場合だけセッションを置き換える（失敗した場合はこれまでの内容を残す）
+            session['prompt'] = prompt
+            session['model_choice'] = model_choice
+            session['writing_style'] = writing_style
+            session['essential_settings'] = essential_settings
+            session['characters'] = characters
+            session['synopsis'] = synopsis
+            session['explicit_level'] = explicit_level
+            session['detail_level'] = detail_level
+            session['psychological_level'] = psychological_level
+            
+            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            episodes = [{
+                'number': number,
+                'text': episode_text,
+                'timestamp': timestamp,
+                'style': murakami_style['name'],
+                # 第4話以降の執筆で使う要約はバックグラウンドで先に生成しておく
+                'summary_hash': schedule_summary(episode_text, model_choice)
+            } for number, episode_text in enumerate(episode_texts, 1)]
+            session['episodes'] = episodes
+            session['story_memory'] = new_memory()
+            
+            # マークダウンからHTMLに変換
+            episode_html = _markdown_to_html(episode_texts[-1])
+            
+            elapsed_time = time.time() - start_time
+            logger.info(f"第1〜3話一括執筆完了: 所要時間={elapsed_time:.2f}秒, "
+                        f"文字数={[len(text) for text in episode_texts]}")
+            
+            return render_template('result.html',
+                                  novel=episode_html,
+                                  episodes=episodes,
+                                  current_episode=len(episodes),
+                                  prompt=prompt,
+                                  writing_style=writing_style,
+                                  model_choice=model_choice,
+                                  explicit_level=explicit_level,
+                                  detail_level=detail_level,
+                                  psychological_level=psychological_level,
+                                  current_style=murakami_style['name'],
+                                  datetime=datetime,
+                                  notification={
+                                      'message': '第1〜3話の執筆が完了しました。エピソード一覧から第1話を読めます。',
+                                      'type': 'success'
+                                  })
+        
+        # 非同期モード: ジョブとして投入し、結果は /jobs/<job_id>/finish で反映する
+        if wants_job():
+            return submit_generation_job(_get_client_id(), 'draft_all', '第1〜3話の一括執筆', work, finish)
+        
+        return finish(work())
+    except Exception as e:
+        logger.error(f"第1〜3話一括執筆エラー: {e}", exc_info=True)
+        # エラーページを表示
+        return render_template('error.html', 
+                              error_title='一括執筆エラー',
+                              error_message=f'第1〜3話の執筆中にエラーが発生しました: {str(e)}',
+                              back_link='/',
+                              datetime=datetime)
+
 ########################################
 # 次のエピソード生成: /next_episode
 ########################################
@@ -490,6 +760,7 @@ def next_episode():
         direction_request = request.form.get('direction_request', '')
         direction_tags = request.form.get('direction_tags', '')
         episode_style_choice = request.form.get('episode_style', 'auto')  # 文体選択を取得
+        long_form = request.form.get('long_form') == '1'  # 長編モード（逐次表示はしない）
         
         # セッションからデータ取得
         prompt = session.get('prompt', '')
@@ -514,7 +785,7 @@ def next_episode():
                 murakami_style = get_style_by_id(episode_style_choice) or get_random_murakami_style()
             else:
                 # 自動選択の場合はランダム
-                murakami_style = get_random_murakami_style()
+                murakami_style = get_random_murakami_style(_style_seed())
         else:  # 団鬼六風など他の文体
             murakami_style = get_style_by_id(episode_style_choice) or get_random_murakami_style()
         
@@ -523,119 +794,204 @@ def next_episode():
         episode_synopsis = synopsis.get(episode_synopsis_key, '')
         
         # 前話のテキスト取得
+        previous_episode = None
         previous_episode_text = ""
         if episodes and len(episodes) >= current_episode:
-            previous_episode_text = episodes[current_episode - 1].get('text', '')
-        
-        # 前話の要約を生成
-        previous_episode_summary = get_episode_summary(previous_episode_text, model_choice)
-        
-        # 次話執筆用プロンプトの組み立て
-        episode_prompt = f"あなたは官能小説作家です。以下の設定と情報に基づいて、官能小説の第{next_episode_num}話を執筆してください。\n\n"
-        episode_prompt += f"### メインプロンプト:\n{prompt}\n\n"
-        
-        # 3話目までならあらすじを使用
-        if next_episode_num <= 3 and episode_synopsis:
-            episode_prompt += f"### 第{next_episode_num}話のあらすじ:\n{episode_synopsis}\n\n"
-        else:
-            # 4話目以降は前のエピソードから展開を続ける
-            episode_prompt += f"### 続編の執筆指示:\n前話までの流れを踏まえて、第{next_episode_num}話を自然な展開で書いてください。\n\n"
-        
-        # 選択されたタグがあれば追加
-        if direction_tags:
-            episode_prompt += f"### 次話の方向性タグ:\n{direction_tags}\n\n"
-        
-        # 方向性リクエストがあれば追加
-        if direction_request:
-            episode_prompt += f"### 方向性リクエスト:\n{direction_request}\n\n"
-        
-        # 前話の内容要約を提供
-        episode_prompt += f"### 前話の内容要約:\n{previous_episode_summary}\n\n"
-        
-        # 選択された文体を指定
-        episode_prompt += f"### 文体:\n{murakami_style['name']}の文体で書いてください。{murakami_style['description']}\n"
-        episode_prompt += f"サンプル文: {murakami_style.get('sample', '')}\n\n"
-        
-        # 登場人物情報
-        if characters:
-            episode_prompt += "### 登場人物:\n"
-            for c in characters:
-                episode_prompt += f"{c['name']}: {c['description']}\n"
-            episode_prompt += "\n"
-        
-        # 絶対守るべき設定
-        if essential_settings:
-            episode_prompt += f"### 絶対守るべき設定:\n{essential_settings}\n\n"
-        
-        # 淫語レベル設定を追加
-        episode_prompt += f"### 表現レベル設定:\n"
-        episode_prompt += f"- 淫語レベル: {explicit_level}% (値が高いほど直接的で卑猥な表現を使用)\n"
-        episode_prompt += f"- 描写詳細度: {detail_level}% (値が高いほど細部までの生々しい描写)\n"
-        episode_prompt += f"- 心理描写の深さ: {psychological_level}% (値が高いほど登場人物の内面を掘り下げる)\n\n"
-        
-        # 連続性を保つための指示
-        episode_prompt += (
-            "### 連続性の指示:\n"
-            "- 前話からのキャラクターの関係性や状況を維持してください\n"
-            "- 前のエピソードで始まったストーリーを自然に発展させてください\n"
-            "- 登場人物の内面的変化や感情の変化を前のエピソードからの発展として描写してください\n"
-            "- 前話との整合性を保ちながら物語を展開させてください\n\n"
-        )
-        
-        episode_prompt += (
-            "### 執筆指示:\n"
-            "- 官能小説として魅力的で詳細な描写を心がけてください\n"
-            "- 800〜1000文字程度で執筆してください\n"
-            "- 各段落の最初は字下げし、会話文は「」で囲んでください\n"
-            "- 適切に改行を入れて読みやすくしてください\n"
-            "- 前話からの自然な流れを意識してください\n"
-            "- 村上龍風の特徴である「生々しい描写」「都市の孤独」「機械的な性描写」などを活かしてください\n"
-        )
-        
-        logger.info(f"第{next_episode_num}話執筆プロンプト: {len(episode_prompt)}文字")
+            previous_episode = episodes[current_episode - 1]
+            previous_episode_text = previous_episode.get('text', '')
+            # バックグラウンドで完成済みの要約があればエピソードの記録に保存
+            if apply_ready_summary(previous_episode):
+                session['episodes'] = episodes
+        
+        # 前々話までの物語は、まとめ要約を使って一定の大きさの文脈にする
+        with span('story_memory'):
+            story_memory = session.get('story_memory') or new_memory()
+            update_story_memory(episodes, story_memory, model_choice)
+            session['story_memory'] = story_memory
+            session['episodes'] = episodes
+            story_context = build_story_context(episodes, story_memory, current_episode - 1,
+                                                model_choice=model_choice)
+        max_tokens = max_tokens_for_chars(model_choice, Config.EPISODE_TARGET_CHARS)
+        
+        @traced('prompt.build')
+        def build_episode_prompt() -> str:
+            """前話の要約を取得し、次話執筆用プロンプトを組み立てる"""
+            # 前話の要約（保存済み・生成済みのものを優先し、なければ生成）
+            with span('summary.previous'):
+                previous_episode_summary = get_summary(previous_episode_text, model_choice, previous_episode)
+        
+            # 次話執筆用プロンプトの組み立て（(セクション, 優先度)。優先度1以上は予算超過時に縮める）
+            setting_sections = _novel_setting_sections(prompt, characters, essential_settings,
+                                                       explicit_level, detail_level, psychological_level)
+            sections = _next_episode_fixed_sections(setting_sections, murakami_style)
+        
+            # 3話目までならあらすじを使用
+            if next_episode_num <= 3 and episode_synopsis:
+                sections.append((f"### 第{next_episode_num}話のあらすじ:\n{episode_synopsis}\n\n", 0))
+            else:
+                # 4話目以降は前のエピソードから展開を続ける
+                sections.append((f"### 続編の執筆指示:\n前話までの流れを踏まえて、第{next_episode_num}話を自然な展開で書いてください。\n\n", 0))
+        
+            # これまでの物語（前々話まで）
+            if story_context:
+                sections.append((f"### これまでの物語:\n{story_context}\n\n", 1))
+        
+            # 前話の内容要約を提供
+            sections.append((f"### 前話の内容要約:\n{previous_episode_summary}\n\n", 0))
+        
+            # 選択されたタグがあれば追加
+            if direction_tags:
+                sections.append((f"### 次話の方向性タグ:\n{direction_tags}\n\n", 0))
+        
+            # 方向性リクエストがあれば追加
+            if direction_request:
+                sections.append((f"### 方向性リクエスト:\n{direction_request}\n\n", 0))
+        
+            sections.append((f"以上の設定と情報に基づいて、官能小説の第{next_episode_num}話を執筆してください。\n", 0))
+        
+            episode_prompt = fit_prompt(sections, model_choice)
+            logger.info(f"第{next_episode_num}話執筆プロンプト: {len(episode_prompt)}文字, "
+                        f"推定{estimate_tokens(episode_prompt, model_choice)}トークン, max_tokens={max_tokens}")
+            return episode_prompt
+        
+        # ストリーミングモード: 本文は /stream/<stream_id> で逐次送信し、完了後に保存する
+        if request.form.get('stream') == '1' and not long_form:
+            stream_id = create_stream(_get_client_id(), model_choice, build_episode_prompt, max_tokens,
+                                      {'number': next_episode_num, 'style': murakami_style['name']})
+            return render_template('streaming.html',
+                                  stream_url=url_for('novel.stream_episode', stream_id=stream_id),
+                                  finish_url=url_for('novel.finish_stream', stream_id=stream_id),
+                                  episode_number=next_episode_num,
+                                  current_style=murakami_style['name'])
+        
+        def finish(episode_text: str):
+            """執筆された次話をエピソードとして保存し、結果画面を返す"""
+            # エピソード情報を保存（ジョブの場合は完了時点のセッションに追加する）
+            episodes = session.get('episodes', [])
+            episodes.append({
+                'number': next_episode_num,
+                'text': episode_text,
+                'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'style': murakami_style['name'],
+                'summary_hash': schedule_summary(episode_text, model_choice)
+            })
+            session['episodes'] = episodes
+            
+            # マークダウンからHTMLに変換
+            episode_html = _markdown_to_html(episode_text)
+            
+            elapsed_time = time.time() - start_time
+            logger.info(f"第{next_episode_num}話執筆完了: 所要時間={elapsed_time:.2f}秒, 文字数={len(episode_text)}")
+            
+            return render_template('result.html',
+                                novel=episode_html,
+                                episodes=episodes,
+                                current_episode=next_episode_num,
+                                prompt=prompt,
+                                writing_style=writing_style,
+                                model_choice=model_choice,
+                                explicit_level=explicit_level,
+                                detail_level=detail_level,
+                                psychological_level=psychological_level,
+                                current_style=murakami_style['name'],
+                                datetime=datetime,  # datetimeモジュールを追加
+                                notification={
+                                    'message': f'第{next_episode_num}話の執筆が完了しました。',
+                                    'type': 'success'
+                                })
+        
+        # 非同期モード: 前話の要約とプロンプトの組み立てもワーカーで行う
+        if wants_job():
+            return submit_generation_job(_get_client_id(), 'next_episode', f'第{next_episode_num}話の執筆',
+                                         lambda: _write_episode(model_choice, build_episode_prompt(), max_tokens, long_form),
+                                         finish)
         
         # API 呼び出しで次話執筆
-        episode_text = call_api_for_novel(model_choice, episode_prompt, max_tokens=2000)
+        episode_prompt = build_episode_prompt()
+        episode_text = _write_episode(model_choice, episode_prompt, max_tokens, long_form)
+        return finish(episode_text)
+    except Exception as e:
+        logger.error(f"次話執筆エラー: {e}", exc_info=True)
+        # エラーページを表示
+        return render_template('error.html', 
+                            error_title='次話執筆エラー',
+                            error_message=f'次のエピソードの執筆中にエラーが発生しました: {str(e)}',
+                            back_link=f'/view_episode/{current_episode}',
+                            datetime=datetime)
+
+########################################
+# ストリーミング送信: /stream/<stream_id>
+########################################
+@novel_bp.route('/stream/<stream_id>')
+def stream_episode(stream_id):
+    """登録済みのストリーミング生成を Server-Sent Events で配信する"""
+    stream = get_stream(stream_id, session.get('client_id', ''))
+    if not stream:
+        return jsonify({'error': 'ストリームが見つかりません'}), 404
+    
+    return Response(stream_with_context(run_stream(stream)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+########################################
+# ストリーミング完了: /stream/<stream_id>/finish
+########################################
+@novel_bp.route('/stream/<stream_id>/finish')
+def finish_stream(stream_id):
+    """完了したストリーミング生成の本文をエピソードとして保存し、結果を表示する"""
+    try:
+        stream = pop_completed_stream(stream_id, session.get('client_id', ''))
+        if not stream:
+            logger.warning(f"ストリーミング完了エラー: 完了済みのストリームが見つかりません: {stream_id}")
+            return render_template('error.html',
+                                  error_title='執筆エラー',
+                                  error_message='生成が完了していないか、既に保存済みです。',
+                                  back_link='/',
+                                  datetime=datetime)
+        
+        episode_num = stream['episode']['number']
+        episode_text = stream['text']
+        style_name = stream['episode']['style']
         
         # エピソード情報を保存
+        episodes = session.get('episodes', [])
         episodes.append({
-            'number': next_episode_num,
+            'number': episode_num,
             'text': episode_text,
             'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-            'style': murakami_style['name']
+            'style': style_name,
+            'summary_hash': schedule_summary(episode_text, stream['model_choice'])
         })
         session['episodes'] = episodes
         
         # マークダウンからHTMLに変換
-        episode_html = markdown.markdown(episode_text)
+        episode_html = _markdown_to_html(episode_text)
         
-        elapsed_time = time.time() - start_time
-        logger.info(f"第{next_episode_num}話執筆完了: 所要時間={elapsed_time:.2f}秒, 文字数={len(episode_text)}")
+        logger.info(f"第{episode_num}話執筆完了(ストリーミング): 文字数={len(episode_text)}")
         
         return render_template('result.html',
-                            novel=episode_html,
-                            episodes=episodes,
-                            current_episode=next_episode_num,
-                            prompt=prompt,
-                            writing_style=writing_style,
-                            model_choice=model_choice,
-                            explicit_level=explicit_level,
-                            detail_level=detail_level,
-                            psychological_level=psychological_level,
-                            current_style=murakami_style['name'],
-                            datetime=datetime,  # datetimeモジュールを追加
-                            notification={
-                                'message': f'第{next_episode_num}話の執筆が完了しました。',
-                                'type': 'success'
-                            })
+                              novel=episode_html,
+                              episodes=episodes,
+                              current_episode=episode_num,
+                              prompt=session.get('prompt', ''),
+                              writing_style=session.get('writing_style', ''),
+                              model_choice=session.get('model_choice', ''),
+                              explicit_level=session.get('explicit_level', '70'),
+                              detail_level=session.get('detail_level', '80'),
+                              psychological_level=session.get('psychological_level', '60'),
+                              current_style=style_name,
+                              datetime=datetime,
+                              notification={
+                                  'message': f'第{episode_num}話の執筆が完了しました。',
+                                  'type': 'success'
+                              })
     except Exception as e:
-        logger.error(f"次話執筆エラー: {e}", exc_info=True)
-        # エラーページを表示
-        return render_template('error.html', 
-                            error_title='次話執筆エラー',
-                            error_message=f'次のエピソードの執筆中にエラーが発生しました: {str(e)}',
-                            back_link=f'/view_episode/{current_episode}',
-                            datetime=datetime)
+        logger.error(f"ストリーミング完了エラー: {e}", exc_info=True)
+        return render_template('error.html',
+                              error_title='執筆エラー',
+                              error_message=f'エピソードの保存中にエラーが発生しました: {str(e)}',
+                              back_link='/',
+                              datetime=datetime)
 
 ########################################
 # エピソード表示: /view_episode/<episode_num>
@@ -655,7 +1011,7 @@ def view_episode(episode_num):
         episode_style = episode.get('style', '村上龍風')
         
         # マークダウンからHTMLに変換
-        episode_html = markdown.markdown(episode_text)
+        episode_html = _markdown_to_html(episode_text)
         
         # すべての必要な変数をテンプレートに渡す
         return render_template('result.html',
@@ -703,10 +1059,13 @@ def save_edited_episode():
         episodes[episode_number - 1]['text'] = content
         episodes[episode_number - 1]['edited'] = True  # 編集フラグを追加
         episodes[episode_number - 1]['edit_timestamp'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # 本文が変わったので要約を作り直す
+        episodes[episode_number - 1].pop('summary', None)
+        episodes[episode_number - 1]['summary_hash'] = schedule_summary(content, session.get('model_choice', 'xai'))
         session['episodes'] = episodes
         
         # HTMLコンテンツを生成
-        html_content = markdown.markdown(content)
+        html_content = _markdown_to_html(content)
         
         return jsonify({
             'success': True,
@@ -858,31 +1217,50 @@ def apply_writing_style():
         if not style:
             return jsonify({"error": "無効な文体IDです"}), 400
             
-        # 文体変換用プロンプト作成
-        prompt = f"""
-あなたは文体変換の専門家です。以下のテキストを「{style['name']}」の文体に変換してください。
-
-### 変換対象テキスト:
-{text}
+        # モデル選択してAPIを呼び出す
+        model_choice = session.get('model_choice', 'openai')
+        
+        # 文体変換用プロンプト作成（文体サンプルは予算超過時に縮める）
+        # 文体ごとに変わらない部分を先頭に、変換対象テキストを区切りの後ろに置く
+        prompt = fit_prompt([
+            (f"""
+あなたは文体変換の専門家です。与えられたテキストを「{style['name']}」の文体に変換してください。
 
 ### 目標とする文体の特徴:
 {style['description']}
 
-### 文体サンプル:
+""", 0),
+            (f"""### 文体サンプル:
 {style.get('sample', '')}
 
-### 指示:
+""", 1),
+            ("""### 指示:
 - 内容は保持しつつ、文体のみを変換してください
 - 段落構造や会話の構造は維持してください
 - 官能的な表現や描写のニュアンスは保持してください
 - 原文と同程度の長さを維持してください
-"""
+""", 0),
+            cache_break(),
+            (f"""### 変換対象テキスト:
+{text}
+""", 0),
+        ], model_choice)
         
-        # モデル選択してAPIを呼び出す
-        model_choice = session.get('model_choice', 'openai')
-        converted_text = call_api_for_novel(model_choice, prompt, max_tokens=2000)
+        # 原文と同程度の長さを出力できるだけのトークン数
+        max_tokens = max_tokens_for_chars(model_choice, len(text))
+        
+        def finish(converted_text: str):
+            """変換後のテキストをJSONで返す"""
+            return jsonify({"success": True, "converted_text": converted_text})
+        
+        # 非同期モード（{"async": true}）: ジョブIDを返し、結果は /jobs/<job_id> で取得する
+        if wants_job():
+            return submit_generation_job(_get_client_id(), 'apply_writing_style', '文体変換',
+                                         lambda: call_api_for_novel(model_choice, prompt, max_tokens=max_tokens, use_cache=True),
+                                         finish)
         
-        return jsonify({"success": True, "converted_text": converted_text})
+        converted_text = call_api_for_novel(model_choice, prompt, max_tokens=max_tokens, use_cache=True)
+        return finish(converted_text)
     except Exception as e:
         logger.error(f"文体適用エラー: {e}", exc_info=True)
         return jsonify({"error": str(e)}), 500
\ No newline at end of file
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Status routes for the novel generator application.
+Exposes runtime statistics of the AI provider layer.
+"""
+
+import logging
+from flask import Blueprint, jsonify
+
+from utils.http_client import get_pool_stats
+from utils.retry_policy import get_retry_stats
+from utils.circuit_breaker import get_breaker_states
+from utils.hedging import get_hedge_stats
+from utils.response_cache import get_cache_stats
+from utils.single_flight import get_single_flight_stats
+from utils.token_budget import get_token_stats
+from utils.providers import get_provider_stats
+from utils.rate_limiter import get_rate_limit_stats
+from utils.tracing import get_trace_stats
+from services.job_queue import get_job_stats
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# Blueprint definition
+status_bp = Blueprint('status', __name__)
+
+########################################
+# HTTPプール統計: /status/http_pool
+########################################
+@status_bp.route('/status/http_pool')
+def http_pool_status():
+    """プロバイダーごとのHTTPコネクションプール統計をJSON形式で返す"""
+    return jsonify(get_pool_stats())
+
+########################################
+# リトライ統計: /status/retries
+########################################
+@status_bp.route('/status/retries')
+def retry_status():
+    """プロバイダー呼び出しのリトライ統計とリトライ予算をJSON形式で返す"""
+    return jsonify(get_retry_stats())
+
+########################################
+# サーキットブレーカー状態: /status/circuit_breakers
+########################################
+@status_bp.route('/status/circuit_breakers')
+def circuit_breaker_status():
+    """プロバイダーごとのサーキットブレーカー状態をJSON形式で返す"""
+    return jsonify(get_breaker_states())
+
+########################################
+# ヘッジ統計: /status/hedging
+########################################
+@status_bp.route('/status/hedging')
+def hedging_status():
+    """ヘッジ付きリクエストの発動回数・学習済みレイテンシ・ヘッジ予算をJSON形式で返す"""
+    return jsonify(get_hedge_stats())
+
+########################################
+# レスポンスキャッシュ統計: /status/response_cache
+########################################
+@status_bp.route('/status/response_cache')
+def response_cache_status():
+    """レスポンスキャッシュのヒット/ミス数と各層の使用状況をJSON形式で返す"""
+    return jsonify(get_cache_stats())
+
+########################################
+# シングルフライト統計: /status/single_flight
+########################################
+@status_bp.route('/status/single_flight')
+def single_flight_status():
+    """実行中の同一リクエストにまとめた呼び出しの件数をJSON形式で返す"""
+    return jsonify(get_single_flight_stats())
+
+########################################
+# トークン見積もり: /status/token_budget
+########################################
+@status_bp.route('/status/token_budget')
+def token_budget_status():
+    """プロバイダーごとの文字数/トークン比（usage による補正後）をJSON形式で返す"""
+    return jsonify(get_token_stats())
+
+########################################
+# プロバイダーアダプター: /status/providers
+########################################
+@status_bp.route('/status/providers')
+def providers_status():
+    """登録済みプロバイダーのエンドポイント・同時実行数・レート制限と実行中の呼び出し数をJSON形式で返す"""
+    return jsonify(get_provider_stats())
+
+########################################
+# レート制限: /status/rate_limits
+########################################
+@status_bp.route('/status/rate_limits')
+def rate_limits_status():
+    """プロバイダー・APIキーごとのレート制限の残量と待ち時間をJSON形式で返す
+
+    wait_seconds_total が増えていれば自分側の送信ペースで、rejected_by_provider が増えていれば
+    プロバイダー側の拒否（429）で詰まっていることを示します。
+    """
+    return jsonify(get_rate_limit_stats())
+
+########################################
+# ジョブキュー統計: /status/jobs
+########################################
+@status_bp.route('/status/jobs')
+def job_queue_status():
+    """生成ジョブキューの深さと状態ごとの件数をJSON形式で返す"""
+    return jsonify(get_job_stats())
+
+########################################
+# トレース: /status/traces
+########################################
+@status_bp.route('/status/traces')
+def traces_status():
+    """出力したトレース数と最近の遅いトレース（trace_id で slow_traces.jsonl を検索できる）をJSON形式で返す"""
+    return jsonify(get_trace_stats())
@@ -1,245 +1,182 @@
-import os
+import time
 import aiohttp
 import logging
-import json
 import asyncio
 from typing import Dict, Any, Optional, List
-from config import Config
+from config import Config, AIModels
+from services.async_runtime import get_runtime
+from utils.circuit_breaker import get_breaker
+from utils.providers import build_provider_request, request_prompt_chars, request_token_cost, record_call_cost
+from utils.rate_limiter import RateLimitWaitExceeded
+from utils.retry_policy import get_retry_policy
+from utils.ai_utils import ProviderHTTPError
+from utils.token_budget import get_token_estimator
+from utils.metrics import observe_provider_call, count_provider_tokens
+from utils.tracing import span, traceparent_headers
+
+# プロバイダー呼び出し1回あたりのタイムアウト
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=300)
+
+# 同時実行の枠が空くのを待つ間隔（秒）
+SLOT_POLL_INTERVAL = 0.05
 
 class AIService:
     """AIサービスの基本クラス"""
     
-    # サポートするモデル一覧
-    SUPPORTED_MODELS = ["xai", "grok-3", "gpt-4o", "claude-3-opus", "deepseek-v3"]
-    
-    @staticmethod
-    async def generate_text(prompt: str, model_choice: str, max_tokens: int = 1500, temperature: float = 0.7) -> str:
-        """モデル選択に基づいて適切なAPI呼び出しを行う"""
-        try:
-            # 非サポートモデルの場合はデフォルト（xAI）にフォールバック
-            if model_choice not in AIService.SUPPORTED_MODELS:
-                logging.warning(f"非サポートモデル '{model_choice}' が指定されました。xAIにフォールバックします。")
-                model_choice = "xai"
-            
-            # モデル選択に基づいて適切なサービスを呼び出す
-            if model_choice == "deepseek-v3":
-                return await DeepseekService.generate_text(prompt, model_choice, max_tokens=max_tokens, temperature=temperature)
-            elif model_choice == "claude-3-opus":
-                return await AnthropicService.generate_text(prompt, model_choice, max_tokens=max_tokens, temperature=temperature)
-            elif model_choice == "gpt-4o":
-                return await OpenAIService.generate_text(prompt, model_choice, max_tokens=max_tokens, temperature=temperature)
-            elif model_choice in ["xai", "grok-3"]:
-                return await XAIService.generate_text(prompt, model_choice, max_tokens=max_tokens, temperature=temperature)
-        except Exception as e:
-            logging.error(f"テキスト生成エラー: {str(e)}")
-            return f"エラーが発生しました: {str(e)}"
-
     @staticmethod
-    def generate_text_sync(prompt: str, model_choice: str, max_tokens: int = 1500, temperature: float = 0.7) -> str:
-        """非同期関数を同期的に呼び出すためのヘルパーメソッド"""
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                future = asyncio.run_coroutine_threadsafe(
-                    AIService.generate_text(prompt, model_choice, max_tokens, temperature),
-                    loop
-                )
-                return future.result(timeout=300)  # 5分タイムアウト
-            else:
-                return asyncio.run(AIService.generate_text(prompt, model_choice, max_tokens, temperature))
-        except Exception as e:
-            logging.error(f"同期API呼び出しエラー: {str(e)}")
-            return f"エラーが発生しました: {str(e)}"
-
-
-class DeepseekService:
-    """Deepseek API統合サービス"""
-    
-    API_BASE = Config.DEEPSEEK_API_BASE
-    MODEL_NAME = "DeepSeek-V3-0324"
-    
-    @classmethod
-    async def generate_text(cls, prompt: str, model_choice: str, max_tokens: int = 1500, temperature: float = 0.7) -> str:
-        """DeepseekのAPIを使用してテキストを生成する"""
-        # APIキーの確認
-        if not Config.DEEPSEEK_API_KEY:
-            raise ValueError("Deepseek APIキーが設定されていません。.envファイルを確認してください。")
+    async def generate_text(prompt: str, model_choice: str, max_tokens: int = 1500, temperature: float = 0.7,
+                            allow_failover: Optional[bool] = None) -> str:
+        """モデル選択に基づいて適切なAPI呼び出しを行う
         
-        # リクエストヘッダー
-        headers = {
-            "Authorization": f"Bearer {Config.DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
+        プロバイダーのサーキットブレーカーが open の場合、または一時的な障害（リトライ可能なステータス・
+        接続エラー・タイムアウト）で失敗した場合は、AIModels.FALLBACK_CHAINS に従って別のモデルにフェイルオーバーします。
+        """
+        # 非サポートモデルの場合はデフォルト（xAI）にフォールバック
+        if not AIModels.is_known(model_choice):
+            logging.warning(f"非サポートモデル '{model_choice}' が指定されました。xAIにフォールバックします。")
+            model_choice = "xai"
         
-        # リクエストボディ
-        payload = {
-            "model": cls.MODEL_NAME,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": temperature,
-            "max_tokens": max_tokens
-        }
+        if allow_failover is None:
+            allow_failover = Config.AI_FAILOVER_ENABLED
+        candidates = [model_choice]
+        if allow_failover:
+            candidates += [m for m in AIModels.get_fallback_chain(model_choice) if m != model_choice]
         
-        logging.info(f"Deepseekリクエスト: model={cls.MODEL_NAME}, temp={temperature}, max_tokens={max_tokens}")
+        error_text = "エラーが発生しました: APIサービスに接続できませんでした"
+        for candidate in candidates:
+            breaker = get_breaker(AIModels.get_provider(candidate))
+            if not breaker.allow_request():
+                logging.warning(f"サーキットブレーカー open のため {candidate} をスキップします")
+                error_text = f"エラーが発生しました: {AIModels.get_display_name(candidate)} は一時的に利用できません"
+                continue
+            if candidate != model_choice:
+                logging.warning(f"フェイルオーバー: {model_choice} -> {candidate}")
+            
+            start_time = time.time()
+            try:
+                text = await AIService._dispatch(prompt, candidate, max_tokens, temperature)
+                breaker.record_success(time.time() - start_time)
+                return text
+            except RateLimitWaitExceeded as e:
+                # 自分側の送信ペースの問題はプロバイダー障害として数えない
+                breaker.release()
+                logging.warning(f"テキスト生成を見送り: {str(e)}")
+                transient = True
+                error = f"エラーが発生しました: {str(e)}"
+            except ValueError as e:
+                # APIキー未設定などの設定エラーはプロバイダー障害として数えない
+                breaker.release()
+                logging.error(f"テキスト生成エラー: {str(e)}")
+                transient = False
+                error = f"エラーが発生しました: {str(e)}"
+            except ProviderHTTPError as e:
+                logging.error(f"テキスト生成エラー: {str(e)}")
+                transient = get_retry_policy().is_retryable(status_code=e.status_code)
+                if transient:
+                    breaker.record_failure(f"HTTP {e.status_code}")
+                else:
+                    # リクエスト内容の問題（400など）はプロバイダー障害として数えない
+                    breaker.release()
+                error = f"エラーが発生しました: {str(e)}"
+            except Exception as e:
+                breaker.record_failure(type(e).__name__)
+                logging.error(f"テキスト生成エラー: {str(e)}")
+                transient = isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError))
+                error = f"エラーが発生しました: {str(e)}"
+            
+            # 要求したモデルの失敗が一時的なもの（リトライ可能なステータス・接続エラー・タイムアウト）でなければ、
+            # 別のモデルに切り替えても解決しないため、フェイルオーバーしない
+            if candidate == model_choice:
+                error_text = error
+                if not transient:
+                    break
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{cls.API_BASE}/chat/completions", 
-                    headers=headers, 
-                    json=payload,
-                    timeout=300
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data["choices"][0]["message"]["content"]
-                    else:
-                        error_detail = await response.text()
-                        raise Exception(f"Deepseek API error: {response.status} - {error_detail}")
-        except Exception as e:
-            logging.error(f"Deepseek API エラー: {str(e)}")
-            raise
+        return error_text
 
-
-class AnthropicService:
-    """Anthropic API統合サービス"""
-    
-    API_BASE = "https://api.anthropic.com/v1/messages"
-    MODEL_NAME = "claude-3-opus-20240229"
-    
-    @classmethod
-    async def generate_text(cls, prompt: str, model_choice: str, max_tokens: int = 1500, temperature: float = 0.7) -> str:
-        """AnthropicのAPIを使用してテキストを生成する"""
-        # APIキーの確認
-        if not Config.ANTHROPIC_API_KEY:
-            raise ValueError("Anthropic APIキーが設定されていません。.envファイルを確認してください。")
-        
-        # リクエストヘッダー
-        headers = {
-            "x-api-key": Config.ANTHROPIC_API_KEY,
-            "anthropic-version": "2023-06-01",
-            "Content-Type": "application/json"
-        }
+    @staticmethod
+    async def _dispatch(prompt: str, model_choice: str, max_tokens: int, temperature: float) -> str:
+        """プロバイダーアダプターでリクエストを組み立て、共有セッションで呼び出す"""
+        req = build_provider_request(model_choice, prompt, max_tokens, temperature)
+        adapter = req['adapter']
+        logging.info(f"{req['provider']}リクエスト: model={req['model_id']}, temp={temperature}, max_tokens={max_tokens}")
         
-        # リクエストボディ
-        payload = {
-            "model": cls.MODEL_NAME,
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": max_tokens,
-            "temperature": temperature
-        }
+        # レート制限の枠を予約し、送信できる時刻までイベントループを止めずに待つ
+        limiter = req['limiter']
+        reserved = 0
+        if limiter is not None:
+            reserved = request_token_cost(req)
+            wait = limiter.reserve(reserved)
+            if wait > 0:
+                await asyncio.sleep(wait)
         
+        # 同時実行の枠はスレッド間で共有されるため、イベントループを止めずに空きを待つ
+        while not adapter.acquire(timeout=0):
+            await asyncio.sleep(SLOT_POLL_INTERVAL)
+        post_start = time.time()
+        status = None
         try:
-            async with aiohttp.ClientSession() as session:
+            session = await get_runtime().get_session()
+            with span('provider.http', 'client', provider=adapter.name, model=req['model_id']) as http_span:
                 async with session.post(
-                    cls.API_BASE, 
-                    headers=headers, 
-                    json=payload,
-                    timeout=300
+                    req['endpoint'],
+                    headers=traceparent_headers(req['headers']),
+                    json=req['data'],
+                    timeout=REQUEST_TIMEOUT
                 ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data["content"][0]["text"]
-                    else:
+                    status = response.status
+                    http_span.set_attribute('http.status_code', status)
+                    observe_provider_call(adapter.name, req['model_id'], status, time.time() - post_start)
+                    if limiter is not None:
+                        limiter.update_from_headers(response.headers, response.status)
+                    if response.status != 200:
                         error_detail = await response.text()
-                        raise Exception(f"Anthropic API error: {response.status} - {error_detail}")
-        except Exception as e:
-            logging.error(f"Anthropic API エラー: {str(e)}")
+                        record_call_cost(req, model_choice, str(status), post_start, prompt)
+                        raise ProviderHTTPError(response.status, error_detail, dict(response.headers))
+                    data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # 応答ヘッダーが届く前の失敗（接続エラー・タイムアウト）
+            if status is None:
+                kind = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'error'
+                observe_provider_call(adapter.name, req['model_id'], kind, time.time() - post_start)
+                record_call_cost(req, model_choice, kind, post_start, prompt)
             raise
-
-
-class OpenAIService:
-    """OpenAI API統合サービス"""
-    
-    API_BASE = "https://api.openai.com/v1/chat/completions"
-    MODEL_NAME = "gpt-4o"
-    
-    @classmethod
-    async def generate_text(cls, prompt: str, model_choice: str, max_tokens: int = 1500, temperature: float = 0.7) -> str:
-        """OpenAIのAPIを使用してテキストを生成する"""
-        # APIキーの確認
-        if not Config.OPENAI_API_KEY:
-            raise ValueError("OpenAI APIキーが設定されていません。.envファイルを確認してください。")
-        
-        # リクエストヘッダー
-        headers = {
-            "Authorization": f"Bearer {Config.OPENAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        # リクエストボディ
-        payload = {
-            "model": cls.MODEL_NAME,
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": max_tokens,
-            "temperature": temperature
-        }
+        finally:
+            adapter.release()
         
+        text = adapter.parse_text(data)
+        usage = adapter.parse_usage(data)
+        cached_tokens = adapter.parse_cached_tokens(data)
+        if usage:
+            get_token_estimator().record_usage(adapter.name, request_prompt_chars(req), usage[0], len(text), usage[1])
+            if limiter is not None:
+                limiter.settle(reserved, usage[0] + usage[1])
+            count_provider_tokens(adapter.name, req['model_id'], usage[0], usage[1], cached_tokens)
+        record_call_cost(req, model_choice, 'ok', post_start, prompt, len(text), usage, cached_tokens)
+        return text
+
+    @staticmethod
+    def generate_text_sync(prompt: str, model_choice: str, max_tokens: int = 1500, temperature: float = 0.7) -> str:
+        """非同期関数を共有ランタイムで実行し、同期的に結果を返すヘルパーメソッド"""
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    cls.API_BASE, 
-                    headers=headers, 
-                    json=payload,
-                    timeout=300
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data["choices"][0]["message"]["content"]
-                    else:
-                        error_detail = await response.text()
-                        raise Exception(f"OpenAI API error: {response.status} - {error_detail}")
+            return get_runtime().run(
+                AIService.generate_text(prompt, model_choice, max_tokens, temperature),
+                timeout=300  # 5分タイムアウト
+            )
         except Exception as e:
-            logging.error(f"OpenAI API エラー: {str(e)}")
-            raise
-
+            logging.error(f"同期API呼び出しエラー: {str(e)}")
+            return f"エラーが発生しました: {str(e)}"
 
-class XAIService:
-    """xAI (Grok) API統合サービス"""
-    
-    API_BASE = "https://api.groq.com/openai/v1/chat/completions"
-    MODEL_MAPPING = {
-        "xai": "grok-2",
-        "grok-3": "grok-3"
-    }
-    
-    @classmethod
-    async def generate_text(cls, prompt: str, model_choice: str, max_tokens: int = 1500, temperature: float = 0.7) -> str:
-        """xAIのAPIを使用してテキストを生成する"""
-        # モデル設定
-        model_name = cls.MODEL_MAPPING.get(model_choice, "grok-2")
-        
-        # APIキーの確認
-        if not Config.XAI_API_KEY:
-            raise ValueError("xAI APIキーが設定されていません。.envファイルを確認してください。")
-        
-        # リクエストヘッダー
-        headers = {
-            "Authorization": f"Bearer {Config.XAI_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        # リクエストボディ
-        payload = {
-            "model": model_name,
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": max_tokens,
-            "temperature": temperature
-        }
+    @staticmethod
+    async def generate_texts(requests: List[Dict[str, Any]]) -> List[str]:
+        """複数のテキスト生成を並行して実行する
         
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    cls.API_BASE, 
-                    headers=headers, 
-                    json=payload,
-                    timeout=300
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data["choices"][0]["message"]["content"]
-                    else:
-                        error_detail = await response.text()
-                        raise Exception(f"xAI API error: {response.status} - {error_detail}")
-        except Exception as e:
-            logging.error(f"xAI API エラー: {str(e)}")
-            raise
\ No newline at end of file
+        各要素は generate_text のキーワード引数（prompt, model_choice, max_tokens, temperature）の辞書です。
+        結果は入力と同じ順序で返します。
+        """
+        return await asyncio.gather(*(AIService.generate_text(**req) for req in requests))
+
+    @staticmethod
+    def generate_texts_sync(requests: List[Dict[str, Any]], timeout: float = 300) -> List[str]:
+        """generate_texts を共有ランタイムで実行し、すべての結果を待って返す"""
+        return get_runtime().run(AIService.generate_texts(requests), timeout=timeout)
+
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Async runtime for the novel generator application.
+Runs one background event loop thread with a shared aiohttp session.
+"""
+
+import atexit
+import asyncio
+import threading
+import contextvars
+import logging
+import concurrent.futures
+from typing import Any, Awaitable, Optional
+
+import aiohttp
+
+from config import Config
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+
+class AsyncRuntime:
+    """プロセス全体で共有する非同期ランタイム
+
+    バックグラウンドスレッドで1つのイベントループを動かし続け、
+    ホストごとの接続数上限つきの aiohttp.ClientSession を共有します。
+    Flaskのルートなど同期コードからは run() / submit() でコルーチンを投入します。
+    """
+
+    def __init__(self, limit: int = Config.ASYNC_HTTP_LIMIT, limit_per_host: int = Config.ASYNC_HTTP_LIMIT_PER_HOST):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """イベントループを取得（未起動なら起動）する"""
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    self._start()
+        return self._loop
+
+    def _start(self) -> None:
+        """バックグラウンドスレッドでイベントループを起動する"""
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run_loop() -> None:
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=run_loop, name='async-runtime', daemon=True)
+        self._thread.start()
+        ready.wait()
+        self._loop = loop
+        logger.info(f"非同期ランタイム起動: limit={self.limit}, limit_per_host={self.limit_per_host}")
+
+    def in_runtime_thread(self) -> bool:
+        """現在のスレッドがランタイムのループスレッドかどうか"""
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """
+        共有の aiohttp.ClientSession を取得する（ループ上で呼ぶこと）
+
+        Returns:
+            aiohttp.ClientSession: 共有セッション
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def submit(self, coro: Awaitable[Any]) -> concurrent.futures.Future:
+        """
+        コルーチンをランタイムに投入し、スレッドセーフなFutureを返す
+
+        Args:
+            coro: 実行するコルーチン
+
+        Returns:
+            concurrent.futures.Future: 結果のFuture
+        """
+        return asyncio.run_coroutine_threadsafe(_in_context(coro, contextvars.copy_context()), self.loop)
+
+    def run(self, coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+        """
+        コルーチンをランタイムで実行し、完了まで待って結果を返す
+
+        Args:
+            coro: 実行するコルーチン
+            timeout: 待機の上限秒数
+
+        Returns:
+            Any: コルーチンの戻り値
+
+        Raises:
+            RuntimeError: ランタイムのループスレッドから呼ばれた場合（デッドロック防止）
+        """
+        if self.in_runtime_thread():
+            coro.close()
+            raise RuntimeError("ランタイムのループ内から同期呼び出しはできません。awaitしてください。")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def shutdown(self) -> None:
+        """共有セッションを閉じてイベントループを停止する"""
+        with self._lock:
+            loop = self._loop
+            if loop is None:
+                return
+            if self._session is not None and not self._session.closed:
+                asyncio.run_coroutine_threadsafe(self._session.close(), loop).result(timeout=5)
+            loop.call_soon_threadsafe(loop.stop)
+            self._thread.join(timeout=5)
+            self._loop = None
+            self._thread = None
+            self._session = None
+
+
+async def _in_context(coro: Awaitable[Any], context: contextvars.Context) -> Any:
+    """呼び出し元のコンテキスト変数（トレースのスパンなど）をタスクに引き継いでコルーチンを実行する"""
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+# プロセス全体で共有するランタイム
+_runtime: Optional[AsyncRuntime] = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime() -> AsyncRuntime:
+    """
+    プロセス共有の非同期ランタイムを取得する
+
+    Returns:
+        AsyncRuntime: 共有ランタイム
+    """
+    global _runtime
+    if _runtime is None:
+        with _runtime_lock:
+            if _runtime is None:
+                _runtime = AsyncRuntime()
+                atexit.register(_runtime.shutdown)
+    return _runtime
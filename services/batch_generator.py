@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Offline batch generation for the novel generator application.
+Generates synopsis + episodes for template/style/structure combinations into resumable JSONL.
+
+使い方:
+    python -m services.batch_generator --templates netorare,kinbaku --styles murakami_ryu_1,dan_oniroku \
+        --structures three_act --episodes 3 --model deepseek-v3 --output data/batch/novels.jsonl
+"""
+
+import os
+import sys
+import json
+import asyncio
+import argparse
+import datetime
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Callable
+
+from config import Config, AIModels
+from utils import generate_text, parse_synopsis, get_episode_summary, ProviderCallError
+from utils.token_budget import max_tokens_for_chars
+from services.novel_templates import (
+    load_templates, get_template_by_id, get_style_by_id, get_random_murakami_style, get_structure_by_id
+)
+from services.story_service import generate_synopsis_prompt, generate_episode_prompt
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+
+def _append_jsonl(path: str, record: Dict[str, Any]) -> None:
+    """1レコードを追記し、ディスクまで書き込む（途中で止まっても書き込み済みの行は残る）"""
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_jsonl(path: str) -> List[Dict[str, Any]]:
+    """JSONLを読み込む（書き込み途中で止まった最終行は読み飛ばす）"""
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"壊れた行を読み飛ばします: {path}:{line_number}")
+    return records
+
+
+class BatchGenerator:
+    """テンプレート×文体×ストーリー構造の組み合わせごとに、あらすじとエピソードを生成する
+
+    完成した小説は出力JSONLに1行ずつ追記します。あらすじ・各エピソードの本文・要約は生成するたびに
+    チェックポイントJSONL（出力ファイル名 + '.checkpoint'）に追記し、再実行時は出力済みの
+    小説を飛ばし、途中の小説は続きのステップから再開します。
+    プロバイダー呼び出しはプロバイダーごとのセマフォで同時実行数を制限します。
+    """
+
+    def __init__(self, jobs: List[Dict[str, Any]], output_path: str, episodes: int = 3,
+                 concurrency: int = Config.BATCH_CONCURRENCY_PER_PROVIDER):
+        self.jobs = jobs
+        self.output_path = output_path
+        self.checkpoint_path = output_path + '.checkpoint'
+        self.episodes = episodes
+        self.concurrency = concurrency
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._stats = {'jobs': len(jobs), 'skipped': 0, 'completed': 0, 'failed': 0, 'resumed_steps': 0, 'calls': 0}
+
+    async def _call(self, model_choice: str, fn: Callable[[], str]) -> str:
+        """プロバイダーの同時実行数の枠内で、ブロッキングの呼び出しをワーカースレッドで実行する"""
+        provider = AIModels.get_provider(model_choice)
+        semaphore = self._semaphores.setdefault(provider, asyncio.Semaphore(self.concurrency))
+        async with semaphore:
+            self._stats['calls'] += 1
+            return await asyncio.get_running_loop().run_in_executor(None, fn)
+
+    def _checkpoint(self, job_id: str, step: str, data: Dict[str, Any]) -> None:
+        _append_jsonl(self.checkpoint_path, {'job_id': job_id, 'step': step, **data})
+
+    def _load_progress(self) -> Dict[str, Dict[str, Any]]:
+        """
+        チェックポイントからジョブごとの途中経過を復元する
+
+        あらすじ、要約まで済んだエピソード、本文だけ生成済みで要約が未完了のエピソード（drafts）に分けて返します。
+        """
+        progress: Dict[str, Dict[str, Any]] = {}
+        for record in _read_jsonl(self.checkpoint_path):
+            state = progress.setdefault(record['job_id'], {'synopsis': None, 'episodes': {}, 'drafts': {}})
+            if record['step'] == 'synopsis':
+                state['synopsis'] = record['synopsis']
+            elif record['step'] == 'episode_text':
+                state['drafts'][record['episode']['number']] = record['episode']
+            elif record['step'] == 'episode':
+                state['episodes'][record['episode']['number']] = record['episode']
+        return progress
+
+    async def _run_job(self, job: Dict[str, Any], state: Dict[str, Any]) -> None:
+        """1つの組み合わせについて、未完了のステップを順に生成する"""
+        job_id = job['job_id']
+        template, style, structure = job['template'], job['style'], job['structure']
+        model_choice = job['model_choice']
+
+        synopsis = state['synopsis']
+        if synopsis is None:
+            prompt = generate_synopsis_prompt(
+                template.get('prompt', ''), style['name'], [], template.get('essential_settings', ''),
+                structure['id'] if structure else None
+            )
+            max_tokens = max_tokens_for_chars(model_choice, Config.SYNOPSIS_TARGET_CHARS)
+            text = await self._call(model_choice, lambda: generate_text(model_choice, prompt, max_tokens=max_tokens))
+            synopsis = parse_synopsis(text)
+            self._checkpoint(job_id, 'synopsis', {'synopsis': synopsis})
+        else:
+            self._stats['resumed_steps'] += 1
+
+        episodes = []
+        for number in range(1, self.episodes + 1):
+            episode = state['episodes'].get(number)
+            if episode is not None:
+                self._stats['resumed_steps'] += 1
+                episodes.append(episode)
+                continue
+            previous = episodes[-1] if episodes else None
+            prompt = generate_episode_prompt(
+                number, template.get('prompt', ''), synopsis.get(f'episode{number}', ''), style, [],
+                template.get('essential_settings', ''),
+                previous_summary=previous['summary'] if previous else None
+            )
+            draft = state['drafts'].get(number)
+            if draft is not None:
+                # 本文は生成済みで、要約のステップから再開する
+                self._stats['resumed_steps'] += 1
+                text = draft['text']
+            else:
+                max_tokens = max_tokens_for_chars(model_choice, Config.EPISODE_TARGET_CHARS)
+                text = await self._call(model_choice, lambda: generate_text(model_choice, prompt, max_tokens=max_tokens))
+                self._checkpoint(job_id, 'episode_text', {'episode': {'number': number, 'text': text,
+                                                                      'style': style['name']}})
+            # 次話のプロンプトで使う要約（最終話はカタログ表示用）。失敗した場合は ProviderCallError でジョブを失敗させる
+            summary = await self._call(model_choice, lambda: get_episode_summary(text, model_choice))
+            episode = {'number': number, 'text': text, 'summary': summary, 'style': style['name']}
+            self._checkpoint(job_id, 'episode', {'episode': episode})
+            episodes.append(episode)
+            logger.info(f"バッチ生成: {job_id} 第{number}話 {len(text)}文字")
+
+        _append_jsonl(self.output_path, {
+            'job_id': job_id,
+            'template_id': template['id'],
+            'template_name': template.get('name', ''),
+            'style_id': style['id'],
+            'style_name': style['name'],
+            'structure_id': structure['id'] if structure else None,
+            'model_choice': model_choice,
+            'synopsis': synopsis,
+            'episodes': episodes,
+            'generated_at': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        })
+
+    async def _run_job_safely(self, job: Dict[str, Any], state: Dict[str, Any]) -> None:
+        try:
+            await self._run_job(job, state)
+            self._stats['completed'] += 1
+            logger.info(f"バッチ生成完了: {job['job_id']}")
+        except ProviderCallError as e:
+            # 生成済みのステップはチェックポイントに残るため、再実行でその続きから再開できる
+            self._stats['failed'] += 1
+            logger.error(f"バッチ生成失敗: {job['job_id']}: {e}")
+
+    async def run(self) -> Dict[str, Any]:
+        """
+        すべての組み合わせを生成する
+
+        Returns:
+            Dict[str, Any]: 件数の統計
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+        done = {record['job_id'] for record in _read_jsonl(self.output_path)}
+        progress = self._load_progress()
+
+        # ブロッキングの呼び出しはセマフォの合計分のスレッドで実行する
+        providers = {AIModels.get_provider(job['model_choice']) for job in self.jobs}
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=max(len(providers), 1) * self.concurrency,
+                                                     thread_name_prefix='batch'))
+
+        pending = []
+        for job in self.jobs:
+            if job['job_id'] in done:
+                self._stats['skipped'] += 1
+                continue
+            state = progress.get(job['job_id'], {'synopsis': None, 'episodes': {}, 'drafts': {}})
+            pending.append(self._run_job_safely(job, state))
+        logger.info(f"バッチ生成開始: 全{len(self.jobs)}件, 出力済み{self._stats['skipped']}件をスキップ")
+        await asyncio.gather(*pending)
+        return dict(self._stats)
+
+
+def build_jobs(template_ids: List[str], style_ids: List[str], structure_ids: List[str],
+               model_choice: str) -> List[Dict[str, Any]]:
+    """
+    テンプレート×文体×ストーリー構造の組み合わせをジョブにする
+
+    Args:
+        template_ids: templates.json のID（空の場合はすべて）
+        style_ids: writing_styles.json のID（空の場合は組み合わせごとにランダムな村上龍風を固定で選ぶ）
+        structure_ids: story_structures.json のID（空の場合は構造を指定しない）
+        model_choice: 使用するAIモデル
+
+    Returns:
+        List[Dict[str, Any]]: job_id, template, style, structure, model_choice を含むジョブのリスト
+
+    Raises:
+        ValueError: 存在しないIDが指定された場合
+    """
+    templates = [_lookup(get_template_by_id, 'テンプレート', t) for t in template_ids] or load_templates()
+    styles: List[Optional[Dict[str, Any]]] = [_lookup(get_style_by_id, '文体', s) for s in style_ids] or [None]
+    structures: List[Optional[Dict[str, Any]]] = [_lookup(get_structure_by_id, 'ストーリー構造', s)
+                                                  for s in structure_ids] or [None]
+
+    jobs = []
+    for template, style, structure in itertools.product(templates, styles, structures):
+        structure_key = structure['id'] if structure else 'none'
+        if style is None:
+            # 再実行でも同じ組み合わせに同じ文体が選ばれるよう、ジョブの内容をシードにする
+            style = get_random_murakami_style(f"{template['id']}:{structure_key}:{model_choice}")
+        jobs.append({
+            'job_id': f"{template['id']}:{style['id']}:{structure_key}:{model_choice}",
+            'template': template,
+            'style': style,
+            'structure': structure,
+            'model_choice': model_choice,
+        })
+    return jobs
+
+
+def _lookup(getter: Callable[[str], Optional[Dict[str, Any]]], label: str, item_id: str) -> Dict[str, Any]:
+    item = getter(item_id)
+    if item is None:
+        raise ValueError(f"{label}が見つかりません: {item_id}")
+    return item
+
+
+def _split_ids(value: str) -> List[str]:
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """コマンドラインのエントリーポイント"""
+    parser = argparse.ArgumentParser(description='テンプレートからあらすじとエピソードを一括生成し、JSONLに出力します。')
+    parser.add_argument('--templates', default='', help='テンプレートID（カンマ区切り、省略時はすべて）')
+    parser.add_argument('--styles', default='', help='文体ID（カンマ区切り、省略時はランダムな村上龍風）')
+    parser.add_argument('--structures', default='', help='ストーリー構造ID（カンマ区切り、省略時は指定なし）')
+    parser.add_argument('--episodes', type=int, default=3, help='1作あたりのエピソード数')
+    parser.add_argument('--model', default='xai', help='使用するAIモデル')
+    parser.add_argument('--concurrency', type=int, default=Config.BATCH_CONCURRENCY_PER_PROVIDER,
+                        help='プロバイダーごとの同時呼び出し数')
+    parser.add_argument('--output', default=os.path.join(Config.DATA_DIR, 'batch', 'novels.jsonl'),
+                        help='出力JSONLファイル（チェックポイントは同名 + .checkpoint）')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        jobs = build_jobs(_split_ids(args.templates), _split_ids(args.styles), _split_ids(args.structures),
+                          args.model)
+    except ValueError as e:
+        parser.error(str(e))
+
+    generator = BatchGenerator(jobs, args.output, episodes=args.episodes, concurrency=args.concurrency)
+    stats = asyncio.run(generator.run())
+    print(json.dumps(stats, ensure_ascii=False))
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark for the novel generator application.
+Drives the synopsis → episodes → view flow against the Flask app and a local mock provider.
+
+使い方:
+    python -m services.benchmark --users 8 --novels 2 --episodes 3 --latency lognormal:1.5,0.4 \
+        --output data/benchmarks/current.json --compare data/benchmarks/baseline.json
+"""
+
+import os
+import re
+import sys
+import json
+import html
+import atexit
+import time
+import pickle
+import shutil
+import tempfile
+import platform
+import argparse
+import datetime
+import threading
+import subprocess
+import logging
+from typing import Dict, Any, List, Optional
+
+from services.mock_llm_server import MockBehavior, start_server
+
+try:
+    import resource
+except ImportError:
+    # Windows には resource モジュールがない
+    resource = None
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# 計測するルート（集計のキー）
+ROUTES = ['/generate_synopsis', '/start_writing', '/next_episode', '/view_episode']
+
+_SYNOPSIS_DATA_PATTERN = re.compile(r'name="synopsis_data" value="([^"]*)"')
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """線形補間の分位数（値がなければNone）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class SessionStoreMeter:
+    """Flaskのセッションインターフェースを包み、セッションの読み書き回数・バイト数・時間を計測する"""
+
+    def __init__(self, app: Any):
+        self.interface = app.session_interface
+        self._lock = threading.Lock()
+        self.stats = {'reads': 0, 'writes': 0, 'read_bytes': 0, 'write_bytes': 0,
+                      'read_seconds': 0.0, 'write_seconds': 0.0, 'max_write_bytes': 0}
+        original_open, original_save = self.interface.open_session, self.interface.save_session
+
+        def open_session(app: Any, request: Any) -> Any:
+            start = time.perf_counter()
+            session = original_open(app, request)
+            self._record('read', time.perf_counter() - start, self._size(session))
+            return session
+
+        def save_session(app: Any, session: Any, response: Any) -> None:
+            start = time.perf_counter()
+            original_save(app, session, response)
+            self._record('write', time.perf_counter() - start, self._size(session))
+
+        self.interface.open_session = open_session
+        self.interface.save_session = save_session
+
+    def _size(self, session: Any) -> int:
+        """セッションを保存形式にしたときのバイト数"""
+        if not session:
+            return 0
+        serializer = getattr(self.interface, 'serializer', None)
+        try:
+            if serializer is not None:
+                return len(serializer.encode(dict(session)))
+            return len(pickle.dumps(dict(session)))
+        except Exception:
+            return len(json.dumps(dict(session), ensure_ascii=False, default=str).encode('utf-8'))
+
+    def _record(self, kind: str, seconds: float, size: int) -> None:
+        with self._lock:
+            self.stats[f'{kind}s'] += 1
+            self.stats[f'{kind}_bytes'] += size
+            self.stats[f'{kind}_seconds'] += seconds
+            if kind == 'write':
+                self.stats['max_write_bytes'] = max(self.stats['max_write_bytes'], size)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        stats['read_seconds'] = round(stats['read_seconds'], 4)
+        stats['write_seconds'] = round(stats['write_seconds'], 4)
+        stats['mean_write_bytes'] = stats['write_bytes'] // stats['writes'] if stats['writes'] else 0
+        return stats
+
+
+class NovelFlowBenchmark:
+    """仮想ユーザーごとに1つのクッキー（セッション）で小説1作分の流れを繰り返す"""
+
+    def __init__(self, app: Any, users: int, novels: int, episodes: int, model_choice: str):
+        self.app = app
+        self.users = users
+        self.novels = novels
+        self.episodes = episodes
+        self.model_choice = model_choice
+        self._latencies: Dict[str, List[float]] = {route: [] for route in ROUTES}
+        self._errors: Dict[str, int] = {route: 0 for route in ROUTES}
+        self._flows = 0
+        self._lock = threading.Lock()
+
+    def _request(self, client: Any, route: str, method: str, path: str, **kwargs: Any) -> Any:
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._latencies[route].append(elapsed)
+            # エラー時もルートは error.html を200で返すため、本文でも判定する
+            if response.status_code >= 400 or b'card-header bg-danger' in response.data:
+                self._errors[route] += 1
+        return response
+
+    def _flow(self, client: Any, user: int, novel: int) -> None:
+        """あらすじ → 第1話 → 次話×(N-1) → 各話の表示"""
+        levels = {'explicit_level': '70', 'detail_level': '80', 'psychological_level': '60'}
+        # レスポンスキャッシュで短絡しないよう、フローごとにプロンプトを変える
+        prompt = f"ベンチマーク用の物語 ユーザー{user} 作品{novel}: 都会の夜に出会った二人"
+        response = self._request(client, '/generate_synopsis', 'POST', '/generate_synopsis', data=dict(
+            levels, prompt=prompt, model_choice=self.model_choice,
+            character_name1='佐藤', character_description1='会社員', character_name2='美咲', character_description2='画家'
+        ))
+        match = _SYNOPSIS_DATA_PATTERN.search(response.get_data(as_text=True))
+        synopsis_data = html.unescape(match.group(1)) if match else '{}'
+
+        self._request(client, '/start_writing', 'POST', '/start_writing', data=dict(
+            levels, prompt=prompt, model_choice=self.model_choice, synopsis_data=synopsis_data
+        ))
+        for current in range(1, self.episodes):
+            self._request(client, '/next_episode', 'POST', '/next_episode',
+                          data={'current_episode': str(current), 'episode_style': 'auto'})
+        for number in range(1, self.episodes + 1):
+            self._request(client, '/view_episode', 'GET', f'/view_episode/{number}')
+        with self._lock:
+            self._flows += 1
+
+    def _user(self, user: int) -> None:
+        client = self.app.test_client()
+        for novel in range(self.novels):
+            self._flow(client, user, novel)
+
+    def run(self) -> Dict[str, Any]:
+        """
+        全ユーザーを並行に動かし、結果を集計する
+
+        Returns:
+            Dict[str, Any]: summary と routes を含む結果
+        """
+        threads = [threading.Thread(target=self._user, args=(user,), name=f'bench-user-{user}')
+                   for user in range(self.users)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - start
+
+        routes = {}
+        for route, values in self._latencies.items():
+            routes[route] = {
+                'count': len(values),
+                'errors': self._errors[route],
+                'mean': round(sum(values) / len(values), 4) if values else None,
+                'p50': _round(percentile(values, 0.50)),
+                'p95': _round(percentile(values, 0.95)),
+                'p99': _round(percentile(values, 0.99)),
+                'max': _round(max(values) if values else None),
+            }
+        requests_total = sum(route['count'] for route in routes.values())
+        return {
+            'summary': {
+                'wall_seconds': round(wall, 3),
+                'flows': self._flows,
+                'flows_per_second': round(self._flows / wall, 4) if wall else None,
+                'requests': requests_total,
+                'requests_per_second': round(requests_total / wall, 3) if wall else None,
+                'errors': sum(self._errors.values()),
+            },
+            'routes': routes,
+        }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 4) if value is not None else None
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb() -> Optional[float]:
+    """このプロセスの最大常駐メモリ（MB、モックサーバー分を含む。取得できない場合はNone）"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux は KB、macOS はバイト単位
+        return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    memory = psutil.Process().memory_info()
+    # Windows はピークのワーキングセット、それ以外は現在の常駐メモリ
+    return round(getattr(memory, 'peak_wset', memory.rss) / (1024 * 1024), 1)
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], max_regression: float) -> List[str]:
+    """
+    前回の結果と比べ、許容範囲を超えて悪化した項目を返す（比較結果は表示する）
+
+    Args:
+        current: 今回の結果
+        baseline: 比較対象の結果
+        max_regression: 許容する悪化の割合（0.2 なら20%）
+
+    Returns:
+        List[str]: 悪化した項目の説明
+    """
+    regressions = []
+
+    def check(label: str, now: Optional[float], before: Optional[float], higher_is_better: bool = False) -> None:
+        if now is None or not before:
+            return
+        change = (now - before) / before
+        print(f"{label}: {before} -> {now} ({change:+.1%})")
+        worse = -change if higher_is_better else change
+        if worse > max_regression:
+            regressions.append(f"{label} が {worse:.1%} 悪化")
+
+    print(f"比較対象: {baseline.get('meta', {}).get('git_commit')} -> {current['meta'].get('git_commit')}")
+    check('flows_per_second', current['summary']['flows_per_second'], baseline['summary'].get('flows_per_second'),
+          higher_is_better=True)
+    for route, stats in current['routes'].items():
+        before = baseline.get('routes', {}).get(route, {})
+        for key in ('p50', 'p95'):
+            check(f"{route} {key}", stats[key], before.get(key))
+    check('peak_rss_mb', current['peak_rss_mb'], baseline.get('peak_rss_mb'))
+    check('session mean_write_bytes', current['session_store']['mean_write_bytes'],
+          baseline.get('session_store', {}).get('mean_write_bytes'))
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """コマンドラインのエントリーポイント"""
+    parser = argparse.ArgumentParser(description='小説生成フローの負荷試験（モックプロバイダー使用）')
+    parser.add_argument('--users', type=int, default=4, help='同時に動かす仮想ユーザー数')
+    parser.add_argument('--novels', type=int, default=1, help='ユーザーあたりの作品数')
+    parser.add_argument('--episodes', type=int, default=3, help='1作あたりのエピソード数')
+    parser.add_argument('--model', default='deepseek-v3', help='使用するAIモデル（呼び出し先はモック）')
+    parser.add_argument('--latency', default='fixed:0.2', help='モックの最初の応答までの遅延プロファイル')
+    parser.add_argument('--tokens-per-second', type=float, default=0.0, help='モックの生成速度（0は待たない）')
+    parser.add_argument('--seed', type=int, default=0, help='モックの乱数シード')
+    parser.add_argument('--log-level', default='WARNING', help='計測中のアプリのログレベル')
+    parser.add_argument('--output', help='結果JSONの出力先')
+    parser.add_argument('--compare', help='比較対象の結果JSON')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='比較で許容する悪化の割合')
+    args = parser.parse_args(argv)
+
+    # すべてのプロバイダーをモックに向ける（アプリの読み込み前に設定する）
+    server = start_server(MockBehavior(latency=args.latency, tokens_per_second=args.tokens_per_second, seed=args.seed))
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    for provider in ('XAI', 'OPENAI', 'ANTHROPIC', 'DEEPSEEK'):
+        os.environ[f'{provider}_API_BASE'] = base_url
+        os.environ[f'{provider}_API_KEY'] = 'benchmark'
+    # セッション・コスト台帳・レスポンスキャッシュ・トレースは一時ディレクトリに書き、
+    # 実データを汚さず、前回の実行のキャッシュにも当たらないようにする
+    work_dir = tempfile.mkdtemp(prefix='novel-bench-')
+    session_dir = os.path.join(work_dir, 'sessions')
+    os.makedirs(session_dir)
+    # 計測後もバックグラウンドの要約などが書き込むため、スレッドプールの終了後（プロセス終了時）に消す
+    atexit.register(shutil.rmtree, work_dir, ignore_errors=True)
+    os.environ['COST_LEDGER_PATH'] = os.path.join(work_dir, 'cost_ledger.db')
+    os.environ['RESPONSE_CACHE_PATH'] = os.path.join(work_dir, 'response_cache.db')
+    os.environ['SINGLE_FLIGHT_DB_PATH'] = os.path.join(work_dir, 'single_flight.db')
+    os.environ['TRACE_EXPORT_PATH'] = os.path.join(work_dir, 'traces', 'spans.jsonl')
+    os.environ['TRACE_SLOW_PATH'] = os.path.join(work_dir, 'traces', 'slow_traces.jsonl')
+
+    from config import Config
+    from app import create_app
+
+    class BenchmarkConfig(Config):
+        SESSION_FILE_DIR = session_dir
+
+    app = create_app(BenchmarkConfig)
+    logging.getLogger().setLevel(args.log_level)
+    logger.setLevel(args.log_level)
+    meter = SessionStoreMeter(app)
+
+    benchmark = NovelFlowBenchmark(app, args.users, args.novels, args.episodes, args.model)
+    result = benchmark.run()
+    result['session_store'] = meter.snapshot()
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['meta'] = {
+        'git_commit': _git_commit(),
+        'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'users': args.users,
+        'novels_per_user': args.novels,
+        'episodes': args.episodes,
+        'model': args.model,
+        'mock_latency': args.latency,
+        'mock_tokens_per_second': args.tokens_per_second,
+    }
+    server.shutdown()
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.max_regression)
+        if regressions:
+            print("悪化: " + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Draft service for the novel generator application.
+Drafts several episodes (or the scenes of one long episode) concurrently and smooths the seams.
+"""
+
+import re
+import math
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from config import Config
+from utils import generate_text, ProviderCallError
+from utils.token_budget import max_tokens_for_chars
+from utils.tracing import span, in_current_context
+from utils.cost_ledger import call_tags
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# 書き直した冒頭がこの範囲の長さ（元の冒頭に対する比率）に収まらない場合は元のまま使う
+SMOOTHING_MIN_RATIO = 0.5
+SMOOTHING_MAX_RATIO = 2.0
+
+# 構成案の1行（「場面1: 〜」「1. 〜」など）
+OUTLINE_LINE_PATTERN = re.compile(r'^\s*[-*]?\s*(?:場面|シーン)?\s*[0-9０-９]+\s*[:：.．、)）]\s*(.+)$')
+
+# 構成案の1場面あたりの目標文字数
+OUTLINE_CHARS_PER_SCENE = 80
+
+_executor = ThreadPoolExecutor(max_workers=Config.DRAFT_WORKERS, thread_name_prefix='draft')
+
+
+def _draft_one(model_choice: str, prompt: str, max_tokens: int, number: int) -> str:
+    """1話分を執筆する（ワーカースレッドで実行）"""
+    with span('draft.episode', number=number), call_tags(purpose='draft_episode'):
+        return generate_text(model_choice, prompt, max_tokens=max_tokens)
+
+
+def draft_episodes(model_choice: str, prompts: List[str], max_tokens: int) -> List[str]:
+    """
+    複数話を並行して執筆する
+
+    Args:
+        model_choice: 使用するAIモデル
+        prompts: 話の順に並べた執筆プロンプト
+        max_tokens: 1話あたりの最大トークン数
+
+    Returns:
+        List[str]: 話の順に並べた本文
+
+    Raises:
+        ProviderCallError: いずれかの話の執筆に失敗した場合
+    """
+    futures = [_executor.submit(in_current_context(_draft_one), model_choice, prompt, max_tokens, number)
+               for number, prompt in enumerate(prompts, 1)]
+    return [future.result() for future in futures]
+
+
+def _split_opening(text: str, max_chars: int) -> Tuple[str, str]:
+    """
+    本文を冒頭（段落単位で max_chars 文字程度まで）と残りに分ける
+
+    最初の段落だけで max_chars を超える場合は、その範囲の最後の句点で区切ります。
+    """
+    paragraphs = text.split('\n')
+    opening_lines: List[str] = []
+    length = 0
+    for line in paragraphs:
+        if opening_lines and length + len(line) > max_chars:
+            break
+        opening_lines.append(line)
+        length += len(line) + 1
+    opening = '\n'.join(opening_lines)
+    if len(opening) > max_chars:
+        cut = opening.rfind('。', 0, max_chars)
+        opening = opening[:cut + 1] if cut > 0 else opening[:max_chars]
+    return opening, text[len(opening):]
+
+
+def _smooth_seam(model_choice: str, previous_text: str, text: str, label: str, unit: str) -> str:
+    """
+    前の部分の結末につながるように次の部分の冒頭を書き直す（失敗した場合は元の本文を返す）
+
+    Args:
+        label: ログとトレースに使う名前（「第2話」「場面2」など）
+        unit: プロンプトで使う部分の呼び方（「話」または「場面」）
+    """
+    opening, rest = _split_opening(text, Config.DRAFT_SMOOTHING_CHARS)
+    if not opening.strip():
+        return text
+    ending = previous_text[-Config.DRAFT_SMOOTHING_CHARS:]
+    prompt = f"""
+あなたは官能小説の編集者です。続けて読まれる前の{unit}の結末と次の{unit}の冒頭を読み、次の{unit}の冒頭を前の{unit}から自然につながるように書き直してください。
+
+### 前の{unit}の結末:
+{ending}
+
+### 次の{unit}の冒頭（書き直す部分）:
+{opening}
+
+### 指示:
+- 時間・場所・登場人物の状態や関係が前の{unit}の結末と矛盾しないようにしてください
+- 次の{unit}の冒頭の出来事と文体、字下げと改行は保ってください
+- {len(opening)}文字程度で、書き直した冒頭部分だけを前置きや説明なしで出力してください
+"""
+    try:
+        with span('draft.smooth', label=label), call_tags(purpose='continuity_smoothing'):
+            smoothed = generate_text(model_choice, prompt,
+                                     max_tokens=max_tokens_for_chars(model_choice, len(opening) * 2))
+    except ProviderCallError as e:
+        logger.warning(f"{label}の冒頭の調整に失敗したため元の本文を使います: {e}")
+        return text
+    smoothed = smoothed.strip('\n')
+    if not SMOOTHING_MIN_RATIO * len(opening) <= len(smoothed) <= SMOOTHING_MAX_RATIO * len(opening):
+        logger.warning(f"{label}の冒頭の調整結果の長さが不自然なため元の本文を使います: "
+                       f"{len(opening)}文字 -> {len(smoothed)}文字")
+        return text
+    return smoothed + rest
+
+
+def smooth_continuity(model_choice: str, texts: List[str], unit: str = '話') -> List[str]:
+    """
+    並行して書いた各話（または各場面）のつなぎ目を整える
+
+    2つ目以降の冒頭を、直前の結末から自然につながるように短く書き直します（つなぎ目ごとに並行して実行）。
+    書き直しに失敗したつなぎ目は元の本文のままにします。
+
+    Args:
+        model_choice: 使用するAIモデル
+        texts: 順に並べた本文
+        unit: 部分の呼び方（「話」または「場面」）
+
+    Returns:
+        List[str]: つなぎ目を整えた本文
+    """
+    if not Config.DRAFT_SMOOTHING_ENABLED or len(texts) < 2:
+        return list(texts)
+    labels = [f"第{i + 1}話" if unit == '話' else f"{unit}{i + 1}" for i in range(len(texts))]
+    futures = [_executor.submit(in_current_context(_smooth_seam), model_choice, texts[i - 1], texts[i],
+                                labels[i], unit)
+               for i in range(1, len(texts))]
+    return [texts[0]] + [future.result() for future in futures]
+
+
+def _scene_count(target_chars: int) -> int:
+    """目標文字数を書き分ける場面の数（2場面以上、LONG_EPISODE_MAX_SCENES 以下）"""
+    count = math.ceil(target_chars / max(Config.LONG_EPISODE_SCENE_CHARS, 1))
+    return min(max(count, 2), Config.LONG_EPISODE_MAX_SCENES)
+
+
+def _parse_outline(outline: str) -> List[str]:
+    """
+    構成案を場面ごとの展開（1行ずつ）に分ける
+
+    番号付きの行があればそれだけを、なければ空でない行をそのまま場面として扱います。
+    """
+    lines = [line.strip() for line in outline.split('\n') if line.strip()]
+    beats = [m.group(1).strip() for m in map(OUTLINE_LINE_PATTERN.match, lines) if m]
+    return beats or [line for line in lines if not line.startswith('#')]
+
+
+def _write_outline(model_choice: str, episode_prompt: str, target_chars: int, scene_count: int) -> List[str]:
+    """執筆プロンプトの内容から、1話分の場面の構成案を作る"""
+    prompt = episode_prompt + f"""
+### 長編モード（構成案の作成）:
+この話は上記の文字数の指定によらず、全体で{target_chars}文字程度の長編として書きます。
+本文はまだ書かず、この話を{scene_count}個の場面に分けた構成案だけを出力してください。
+- 「場面1: 」のように番号を付けて、1場面を1行で書いてください
+- 各場面で起きること（舞台・登場人物の行動・感情の動き）を1〜2文で具体的に書いてください
+- 場面の順に読むと話の始まりから終わりまでが自然につながるようにしてください
+"""
+    with span('draft.outline', scenes=scene_count), call_tags(purpose='scene_outline'):
+        outline = generate_text(model_choice, prompt,
+                                max_tokens=max_tokens_for_chars(model_choice, scene_count * OUTLINE_CHARS_PER_SCENE))
+    return _parse_outline(outline)[:Config.LONG_EPISODE_MAX_SCENES]
+
+
+def _draft_scene(model_choice: str, episode_prompt: str, beats: List[str], index: int,
+                 target_chars: int, scene_chars: int) -> str:
+    """構成案の1場面を、前後の場面の展開を踏まえて執筆する（ワーカースレッドで実行）"""
+    previous_beat: Optional[str] = beats[index - 1] if index > 0 else None
+    next_beat: Optional[str] = beats[index + 1] if index + 1 < len(beats) else None
+    neighbours = (
+        (f"- 前の場面（場面{index}）: {previous_beat}\n" if previous_beat else "- この場面から話が始まります\n")
+        + (f"- 次の場面（場面{index + 2}）: {next_beat}\n" if next_beat else "- この場面で話が終わります\n")
+    )
+    prompt = episode_prompt + f"""
+### 長編モード（場面の執筆）:
+この話は全{len(beats)}場面・全体で{target_chars}文字程度の長編です。上記の文字数の指定の代わりに、場面{index + 1}だけを{scene_chars}文字程度で執筆してください。
+
+### 場面{index + 1}の展開:
+{beats[index]}
+
+### 前後の場面:
+{neighbours}
+### 場面の執筆指示:
+- 前の場面の出来事は書き直さず、そこから続く書き出しにしてください
+- 次の場面の展開には踏み込まず、この場面の終わりで止めてください
+- 場面の見出しや番号、前置きは付けず本文だけを出力してください
+"""
+    with span('draft.scene', index=index + 1), call_tags(purpose='draft_scene'):
+        return generate_text(model_choice, prompt,
+                             max_tokens=max_tokens_for_chars(model_choice, scene_chars)).strip('\n')
+
+
+def write_long_episode(model_choice: str, episode_prompt: str, target_chars: int) -> str:
+    """
+    1話を長編モードで執筆する
+
+    まず場面の構成案を作り、各場面を前後の場面の展開を添えて並行して執筆し、
+    順に連結してから場面のつなぎ目を整えます。1回の呼び出しの出力上限を超える長さの話を、
+    長い逐次生成の代わりに短い並行生成で書けます。構成案が2場面以上に分けられない場合は、
+    目標文字数を指定した1回の呼び出しで書きます。
+
+    Args:
+        model_choice: 使用するAIモデル
+        episode_prompt: 通常の執筆プロンプト（設定・あらすじ・指示を含む）
+        target_chars: 1話全体の目標文字数
+
+    Returns:
+        str: 連結した本文
+
+    Raises:
+        ProviderCallError: 構成案またはいずれかの場面の執筆に失敗した場合
+    """
+    beats = _write_outline(model_choice, episode_prompt, target_chars, _scene_count(target_chars))
+    if len(beats) < 2:
+        logger.warning(f"構成案を場面に分けられなかったため1回の呼び出しで執筆します: {len(beats)}場面")
+        return generate_text(model_choice, episode_prompt,
+                             max_tokens=max_tokens_for_chars(model_choice, target_chars))
+
+    scene_chars = math.ceil(target_chars / len(beats))
+    logger.info(f"長編モード: {len(beats)}場面 × {scene_chars}文字程度")
+    futures = [_executor.submit(in_current_context(_draft_scene), model_choice, episode_prompt, beats, index,
+                                target_chars, scene_chars)
+               for index in range(len(beats))]
+    scenes = smooth_continuity(model_choice, [future.result() for future in futures], unit='場面')
+    return '\n\n'.join(scene.strip('\n') for scene in scenes)
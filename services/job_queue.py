@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Job queue service for the novel generator application.
+Runs generation jobs on a bounded worker pool and tracks their state.
+"""
+
+import math
+import time
+import uuid
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, Iterator, Optional
+
+from config import Config
+from utils.tracing import trace, current_trace_id
+from utils.cost_ledger import current_call_tags, call_tags
+from utils.ai_utils import cancel_scope, CallCancelled
+from .streaming_service import format_sse
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# ジョブの状態
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+TERMINAL_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+# 完了したジョブがまだない間に Retry-After の見積もりに使う所要時間（秒）
+DEFAULT_DURATION_ESTIMATE = 30.0
+
+
+class JobQueueFullError(Exception):
+    """待機中のジョブが上限に達していることを表す例外"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("生成リクエストが混み合っています。しばらくしてから再試行してください。")
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """生成ジョブのキュー
+
+    ジョブは固定サイズのワーカープールで実行され、状態は
+    queued → running → succeeded / failed / cancelled と遷移します。
+    待機中のジョブが max_depth に達すると新しいジョブを受け付けません（バックプレッシャー）。
+    結果は ttl 秒保持され、所有者（クライアントID）だけが参照できます。
+    """
+
+    def __init__(self, max_workers: int = Config.JOB_WORKERS,
+                 max_depth: int = Config.JOB_MAX_QUEUE_DEPTH,
+                 ttl: float = Config.JOB_RESULT_TTL):
+        self.max_workers = max_workers
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._changed = threading.Condition()
+        # 完了したジョブの所要時間の指数移動平均（最初の1件で初期化する）
+        self._avg_duration: Optional[float] = None
+        self._stats = {'submitted': 0, 'rejected': 0, SUCCEEDED: 0, FAILED: 0, CANCELLED: 0}
+
+    def _purge_expired(self) -> None:
+        """完了後に期限切れとなったジョブを削除する（ロック取得済みで呼ぶこと）"""
+        now = time.time()
+        expired = [jid for jid, job in self._jobs.items()
+                   if job['state'] in TERMINAL_STATES and now - job['finished_at'] > self.ttl]
+        for jid in expired:
+            del self._jobs[jid]
+
+    def _queued_count(self) -> int:
+        return sum(1 for job in self._jobs.values() if job['state'] == QUEUED)
+
+    def _retry_after(self) -> int:
+        """キューが空くまでのおおよその秒数（ロック取得済みで呼ぶこと）"""
+        waves = (self._queued_count() + self.max_workers) / self.max_workers
+        avg_duration = self._avg_duration if self._avg_duration is not None else DEFAULT_DURATION_ESTIMATE
+        return max(1, math.ceil(avg_duration * waves))
+
+    def submit(self, owner: str, kind: str, work: Callable[[], Any],
+               meta: Optional[Dict[str, Any]] = None) -> str:
+        """
+        ジョブを登録してワーカープールに投入する
+
+        Args:
+            owner: ジョブを所有するクライアントID
+            kind: ジョブの種類（'generate_synopsis' など）
+            work: ワーカーで実行する関数（戻り値が結果になる）
+            meta: ジョブに付随する情報（完了時の処理など）
+
+        Returns:
+            str: ジョブID
+
+        Raises:
+            JobQueueFullError: 待機中のジョブが上限に達している場合
+        """
+        with self._changed:
+            self._purge_expired()
+            if self._queued_count() >= self.max_depth:
+                self._stats['rejected'] += 1
+                raise JobQueueFullError(self._retry_after())
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                'id': job_id,
+                'owner': owner,
+                'kind': kind,
+                'state': QUEUED,
+                'result': None,
+                'error': None,
+                'meta': meta or {},
+                'cancel_event': threading.Event(),
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+            }
+            self._stats['submitted'] += 1
+        self._executor.submit(self._run, job_id, work, current_trace_id(), current_call_tags())
+        logger.info(f"ジョブ登録: {kind} ({job_id})")
+        return job_id
+
+    def _transition(self, job: Dict[str, Any], state: str, **fields: Any) -> None:
+        """状態を変更して待機中の購読者に通知する（ロック取得済みで呼ぶこと）"""
+        job['state'] = state
+        job.update(fields)
+        if state in TERMINAL_STATES:
+            job['finished_at'] = time.time()
+            self._stats[state] += 1
+        self._changed.notify_all()
+
+    def _run(self, job_id: str, work: Callable[[], Any], parent_trace_id: Optional[str] = None,
+             tags: Optional[Dict[str, str]] = None) -> None:
+        """
+        ワーカースレッドでジョブを実行する（登録したリクエストのトレースIDを属性に持つ別トレースにする）
+
+        コスト台帳のタグ（ルート・セッション・作品）も登録したリクエストのものを引き継ぎ、
+        work 内のプロバイダー呼び出しはジョブのキャンセル要求で打ち切られる
+        """
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None or job['state'] != QUEUED:
+                # 待機中にキャンセルされた
+                return
+            self._transition(job, RUNNING, started_at=time.time())
+
+        try:
+            with trace(f"job {job['kind']}", **{'job.id': job_id, 'link.trace_id': parent_trace_id or ''}), \
+                    call_tags(**(tags or {})), cancel_scope(job['cancel_event']):
+                result = work()
+            error = None
+        except CallCancelled:
+            # 実行中にキャンセルされ、残りのプロバイダー呼び出しを打ち切った
+            result, error = None, None
+        except Exception as e:
+            logger.error(f"ジョブ実行エラー: {job['kind']} ({job_id}): {e}", exc_info=True)
+            result, error = None, str(e)
+
+        with self._changed:
+            duration = time.time() - job['started_at']
+            if self._avg_duration is None:
+                self._avg_duration = duration
+            else:
+                self._avg_duration = self._avg_duration * 0.8 + duration * 0.2
+            if job['state'] in TERMINAL_STATES:
+                # 実行中にキャンセルされた場合（cancel で cancelled に遷移済み）、結果は破棄する
+                pass
+            elif error is not None:
+                self._transition(job, FAILED, error=error)
+            else:
+                self._transition(job, SUCCEEDED, result=result)
+        logger.info(f"ジョブ終了: {job['kind']} ({job_id}) state={job['state']}, 所要時間={duration:.2f}秒")
+
+    def get(self, job_id: str, owner: str) -> Optional[Dict[str, Any]]:
+        """所有者が一致するジョブを取得する"""
+        with self._changed:
+            job = self._jobs.get(job_id)
+        if not job or job['owner'] != owner:
+            return None
+        return job
+
+    def cancel(self, job_id: str, owner: str) -> bool:
+        """
+        ジョブをキャンセルする
+
+        待機中のジョブは実行されません。実行中のジョブはプロバイダー呼び出しの完了を待たずに
+        cancelled となり、結果は破棄されます。送信済みの呼び出しは完了まで続きますが、
+        以降の呼び出しとリトライは行われません（CallCancelled で打ち切る）。
+
+        Args:
+            job_id: ジョブID
+            owner: クライアントID
+
+        Returns:
+            bool: キャンセルできた場合はTrue（完了済み・不明の場合はFalse）
+        """
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if not job or job['owner'] != owner or job['state'] in TERMINAL_STATES:
+                return False
+            job['cancel_event'].set()
+            self._transition(job, CANCELLED)
+        logger.info(f"ジョブキャンセル: {job['kind']} ({job_id})")
+        return True
+
+    def pop_succeeded(self, job_id: str, owner: str) -> Optional[Dict[str, Any]]:
+        """
+        成功したジョブを取り出して登録を解除する
+
+        Args:
+            job_id: ジョブID
+            owner: クライアントID
+
+        Returns:
+            Optional[Dict[str, Any]]: 成功したジョブ（未完了・不明の場合はNone）
+        """
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if not job or job['owner'] != owner or job['state'] != SUCCEEDED:
+                return None
+            return self._jobs.pop(job_id)
+
+    def describe(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """ジョブの状態をJSONで返せる辞書にする"""
+        with self._changed:
+            info = {
+                'id': job['id'],
+                'kind': job['kind'],
+                'state': job['state'],
+                'created_at': job['created_at'],
+                'started_at': job['started_at'],
+                'finished_at': job['finished_at'],
+                'error': job['error'],
+            }
+            if job['state'] == QUEUED:
+                info['queue_position'] = sum(
+                    1 for other in self._jobs.values()
+                    if other['state'] == QUEUED and other['created_at'] <= job['created_at']
+                )
+            if job['state'] == SUCCEEDED and isinstance(job['result'], str):
+                info['result'] = job['result']
+        return info
+
+    def events(self, job: Dict[str, Any], keepalive: float = 15.0) -> Iterator[str]:
+        """
+        ジョブの状態変化をSSEイベントとして順に返す（終了状態で止まる）
+
+        Args:
+            job: get で取得したジョブ
+            keepalive: 変化がないときにコメント行を送る間隔（秒）
+
+        Yields:
+            str: SSEフォーマットのイベント
+        """
+        last_state = None
+        while True:
+            with self._changed:
+                if job['state'] == last_state:
+                    self._changed.wait(keepalive)
+                state = job['state']
+            if state == last_state:
+                yield ': keepalive\n\n'
+                continue
+            last_state = state
+            yield format_sse('state', self.describe(job))
+            if state in TERMINAL_STATES:
+                return
+
+    def get_stats(self) -> Dict[str, Any]:
+        """キューの深さと状態ごとの件数を返す"""
+        with self._changed:
+            self._purge_expired()
+            counts: Dict[str, int] = {}
+            for job in self._jobs.values():
+                counts[job['state']] = counts.get(job['state'], 0) + 1
+            return {
+                'workers': self.max_workers,
+                'max_queue_depth': self.max_depth,
+                'queued': counts.get(QUEUED, 0),
+                'running': counts.get(RUNNING, 0),
+                'avg_duration_seconds': round(self._avg_duration, 2) if self._avg_duration is not None else None,
+                'totals': dict(self._stats),
+            }
+
+
+# プロセス全体で共有するジョブキュー
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """
+    プロセス共有のジョブキューを取得する
+
+    Returns:
+        JobQueue: 共有ジョブキュー
+    """
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue()
+    return _queue
+
+
+def get_job_stats() -> Dict[str, Any]:
+    """共有ジョブキューの統計を取得する"""
+    return get_job_queue().get_stats()
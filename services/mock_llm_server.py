@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Local mock LLM provider server for the novel generator application.
+Serves OpenAI- and Anthropic-compatible endpoints with configurable latency, errors and usage.
+
+使い方:
+    python -m services.mock_llm_server --port 8099 --latency lognormal:2,0.5 --error-429 0.05
+    # 各プロバイダーの呼び出し先をこのサーバーに向ける
+    export XAI_API_BASE=http://127.0.0.1:8099/v1 OPENAI_API_BASE=http://127.0.0.1:8099/v1 \
+           ANTHROPIC_API_BASE=http://127.0.0.1:8099/v1 DEEPSEEK_API_BASE=http://127.0.0.1:8099/v1
+"""
+
+import sys
+import json
+import hashlib
+import math
+import time
+import random
+import argparse
+import threading
+import logging
+from collections import deque, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Tuple
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# プロンプトキャッシュとして覚えておく先頭部分（システムプロンプト）の数
+PREFIX_CACHE_SIZE = 1024
+
+# ランダム生成に使う文（日本語の長さ・句読点の分布がそれらしくなるように）
+SENTENCES = [
+    "夜の街は湿った空気に包まれていた。",
+    "ネオンの光がアスファルトに滲み、彼女の横顔を青く染めた。",
+    "「どうしてここに来たの」と彼女は小さな声で言った。",
+    "男は答えずに煙草に火をつけ、窓の外を見つめた。",
+    "遠くで電車の音が響き、部屋の静けさを際立たせた。",
+    "彼女の指先は冷たく、わずかに震えていた。",
+    "グラスの氷が溶ける音だけが二人の間に残った。",
+    "記憶の奥で、古い傷が鈍く疼きはじめる。",
+    "「もう戻れないよ」と男は呟いた。",
+    "雨が降り出し、窓ガラスを細い線が流れ落ちていった。",
+    "都市の孤独は、誰かの体温を求める理由にしかならなかった。",
+    "彼女は目を閉じ、ゆっくりと息を吐いた。",
+]
+
+
+class LatencyProfile:
+    """遅延の分布
+
+    'fixed:0.5' / 'uniform:0.2,1.5' / 'normal:1.0,0.3' / 'lognormal:2.0,0.5'（中央値, σ）の形式で指定します。
+    """
+
+    def __init__(self, spec: str):
+        kind, _, params = spec.partition(':')
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(p) for p in params.split(',') if p] if params else []
+        expected = {'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2}
+        if kind not in expected or len(self.params) != expected[kind]:
+            raise ValueError(f"遅延プロファイルの形式が不正です: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        """遅延秒数を1つ取り出す（負の値にはしない）"""
+        if self.kind == 'fixed':
+            value = self.params[0]
+        elif self.kind == 'uniform':
+            value = rng.uniform(*self.params)
+        elif self.kind == 'normal':
+            value = rng.gauss(*self.params)
+        else:
+            value = rng.lognormvariate(math.log(self.params[0]), self.params[1])
+        return max(value, 0.0)
+
+
+class MockBehavior:
+    """モックサーバーの応答内容・遅延・エラー注入の設定と統計"""
+
+    def __init__(self, latency: str = 'fixed:0', tokens_per_second: float = 0.0, chars_per_token: float = 1.0,
+                 error_429: float = 0.0, error_500: float = 0.0, timeout_rate: float = 0.0,
+                 hang_seconds: float = 600.0, rpm: int = 0, script: Optional[List[Dict[str, str]]] = None,
+                 seed: Optional[int] = None):
+        self.latency = LatencyProfile(latency)
+        self.tokens_per_second = tokens_per_second
+        self.chars_per_token = chars_per_token
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.timeout_rate = timeout_rate
+        self.hang_seconds = hang_seconds
+        self.rpm = rpm
+        self.script = script or []
+        self._script_index = 0
+        self._rng = random.Random(seed)
+        self._recent: deque = deque()
+        self._prefixes: 'OrderedDict[str, None]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Any] = {'requests': 0, 'streamed': 0, 'statuses': {}, 'timeouts': 0,
+                                       'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+
+    def random(self) -> float:
+        with self._lock:
+            return self._rng.random()
+
+    def sample_latency(self) -> float:
+        with self._lock:
+            return self.latency.sample(self._rng)
+
+    def count(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += amount
+
+    def count_status(self, status: int) -> None:
+        with self._lock:
+            statuses = self._stats['statuses']
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    def take_request_slot(self) -> Tuple[bool, Dict[str, str]]:
+        """
+        1分あたりのリクエスト数の上限（rpm）を判定する
+
+        Returns:
+            Tuple[bool, Dict[str, str]]: (受け付けたか, x-ratelimit-* 形式の値)
+        """
+        if self.rpm <= 0:
+            return True, {}
+        now = time.time()
+        with self._lock:
+            while self._recent and self._recent[0] <= now - 60:
+                self._recent.popleft()
+            accepted = len(self._recent) < self.rpm
+            if accepted:
+                self._recent.append(now)
+            reset = 60 - (now - self._recent[0]) if self._recent else 0.0
+            remaining = self.rpm - len(self._recent)
+        return accepted, {'limit': str(self.rpm), 'remaining': str(max(remaining, 0)), 'reset': f"{max(reset, 0):.3f}s"}
+
+    def tokens(self, text: str) -> int:
+        return max(math.ceil(len(text) / self.chars_per_token), 1)
+
+    def cached_prefix(self, prefixes: List[str]) -> str:
+        """
+        以前に受け取った最も長い先頭部分を返す（プロバイダーのプロンプトキャッシュの模擬。今回の先頭部分は覚える）
+
+        Args:
+            prefixes: キャッシュのブレークポイントまでの先頭部分（短い順）
+
+        Returns:
+            str: キャッシュに載っていた先頭部分（なければ空文字列）
+        """
+        hit = ''
+        with self._lock:
+            for prefix in prefixes:
+                digest = hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+                if digest in self._prefixes:
+                    hit = prefix
+                self._prefixes[digest] = None
+                self._prefixes.move_to_end(digest)
+            while len(self._prefixes) > PREFIX_CACHE_SIZE:
+                self._prefixes.popitem(last=False)
+        return hit
+
+    def generate_text(self, prompt: str, max_tokens: int) -> str:
+        """
+        応答テキストを作る
+
+        スクリプトがあれば、プロンプトに match を含む最初の規則、なければ match のない規則を順番に使います。
+        スクリプトがなければランダムな日本語を max_tokens に収まる長さで作り、
+        3話分のあらすじを求めるプロンプトには「第1話:」〜「第3話:」のラベル付きで返します。
+        """
+        with self._lock:
+            for rule in self.script:
+                if rule.get('match') and rule['match'] in prompt:
+                    return rule['text']
+            unconditional = [rule for rule in self.script if not rule.get('match')]
+            if unconditional:
+                rule = unconditional[self._script_index % len(unconditional)]
+                self._script_index += 1
+                return rule['text']
+
+            limit = int(max_tokens * self.chars_per_token) if max_tokens else 1000
+            if '第1話:' in prompt and '第3話:' in prompt:
+                part = max(limit // 3 - 6, 20)
+                return '\n'.join(f"第{n}話: {self._random_text(part)}" for n in (1, 2, 3))
+            return self._random_text(limit)
+
+    def _random_text(self, limit: int) -> str:
+        """limit 文字以内のランダムな文章（ロック取得済みで呼ぶこと）"""
+        parts: List[str] = []
+        length = 0
+        target = int(limit * self._rng.uniform(0.7, 1.0))
+        while True:
+            sentence = self._rng.choice(SENTENCES)
+            if length + len(sentence) + 1 > target and parts:
+                break
+            # 段落の区切り（字下げ）を時々入れる
+            if not parts or self._rng.random() < 0.25:
+                sentence = ('\n' if parts else '') + '　' + sentence
+            parts.append(sentence)
+            length += len(sentence)
+        return ''.join(parts)[:limit]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = json.loads(json.dumps(self._stats))
+        stats['latency'] = self.latency.spec
+        stats['error_rates'] = {'429': self.error_429, '500': self.error_500, 'timeout': self.timeout_rate}
+        return stats
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """OpenAI互換（/v1/chat/completions）と Anthropic互換（/v1/messages）のエンドポイント"""
+
+    protocol_version = 'HTTP/1.1'
+    behavior: MockBehavior = MockBehavior()
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug("mock: " + format % args)
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.behavior.count_status(status)
+
+    def _send_chunk(self, data: str) -> None:
+        encoded = data.encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(encoded), encoded))
+        self.wfile.flush()
+
+    def do_GET(self) -> None:
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self._send_json(200, self.behavior.snapshot())
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self) -> None:
+        anthropic = self.path.rstrip('/').endswith('/messages')
+        if not anthropic and not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'not found'}})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError:
+            self._send_json(400, {'error': {'message': 'invalid json'}})
+            return
+
+        behavior = self.behavior
+        behavior.count('requests')
+        accepted, limits = behavior.take_request_slot()
+        prefix = 'anthropic-ratelimit-requests-' if anthropic else 'x-ratelimit-'
+        suffix = '' if anthropic else '-requests'
+        rate_headers = {f"{prefix}{name}{suffix}": value for name, value in limits.items()}
+
+        # エラー注入（上限超過・ランダムな429/500・応答しないタイムアウト）
+        roll = behavior.random()
+        if not accepted or roll < behavior.error_429:
+            self._send_json(429, {'error': {'type': 'rate_limit_error', 'message': 'Rate limit exceeded (mock)'}},
+                            dict(rate_headers, **{'retry-after': '1'}))
+            return
+        if roll < behavior.error_429 + behavior.error_500:
+            self._send_json(500, {'error': {'type': 'server_error', 'message': 'Internal error (mock)'}})
+            return
+        if roll < behavior.error_429 + behavior.error_500 + behavior.timeout_rate:
+            behavior.count('timeouts')
+            time.sleep(behavior.hang_seconds)
+            self.close_connection = True
+            return
+
+        messages = request.get('messages', [])
+        prompt = '\n'.join(m.get('content', '') if isinstance(m.get('content'), str) else
+                           json.dumps(m.get('content'), ensure_ascii=False) for m in messages)
+        # キャッシュの対象になる先頭部分（Anthropic は cache_control を付けた system ブロックまで、
+        # OpenAI互換は先頭の system メッセージ全体）
+        system, prefixes = '', []
+        if isinstance(request.get('system'), str):
+            system = request['system']
+        elif isinstance(request.get('system'), list):
+            for block in request['system']:
+                system += block.get('text', '')
+                if 'cache_control' in block:
+                    prefixes.append(system)
+        elif messages and messages[0].get('role') == 'system':
+            prefixes.append(messages[0].get('content', ''))
+        if system:
+            prompt = system + '\n' + prompt
+        text = behavior.generate_text(prompt, int(request.get('max_tokens') or 0))
+        prompt_tokens, completion_tokens = behavior.tokens(prompt), behavior.tokens(text)
+        hit = behavior.cached_prefix(prefixes)
+        cached_tokens = behavior.tokens(hit) if hit else 0
+        behavior.count('prompt_tokens', prompt_tokens)
+        behavior.count('completion_tokens', completion_tokens)
+        behavior.count('cached_tokens', cached_tokens)
+        model = request.get('model', 'mock')
+        if anthropic:
+            # input_tokens はキャッシュの読み書き分を除いた数
+            written = behavior.tokens(prefixes[-1]) - cached_tokens if prefixes and prefixes[-1] != hit else 0
+            prompt_usage = {'input_tokens': prompt_tokens - cached_tokens - written,
+                            'cache_read_input_tokens': cached_tokens, 'cache_creation_input_tokens': written}
+        else:
+            prompt_usage = {'prompt_tokens': prompt_tokens, 'prompt_tokens_details': {'cached_tokens': cached_tokens},
+                            'prompt_cache_hit_tokens': cached_tokens,
+                            'prompt_cache_miss_tokens': prompt_tokens - cached_tokens}
+
+        # 最初の応答までの遅延
+        time.sleep(behavior.sample_latency())
+
+        if request.get('stream'):
+            behavior.count('streamed')
+            include_usage = bool((request.get('stream_options') or {}).get('include_usage'))
+            self._stream(anthropic, model, text, prompt_usage, completion_tokens, rate_headers, include_usage)
+            return
+
+        # 非ストリーミングでは生成にかかる時間も待ってから返す
+        if behavior.tokens_per_second > 0:
+            time.sleep(completion_tokens / behavior.tokens_per_second)
+        if anthropic:
+            payload = {
+                'id': 'msg_mock', 'type': 'message', 'role': 'assistant', 'model': model,
+                'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn',
+                'usage': dict(prompt_usage, output_tokens=completion_tokens),
+            }
+        else:
+            payload = {
+                'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': dict(prompt_usage, completion_tokens=completion_tokens,
+                              total_tokens=prompt_tokens + completion_tokens),
+            }
+        self._send_json(200, payload, rate_headers)
+
+    def _stream(self, anthropic: bool, model: str, text: str, prompt_usage: Dict[str, Any], completion_tokens: int,
+                rate_headers: Dict[str, str], include_usage: bool = False) -> None:
+        """SSEで少しずつ送る（tokens_per_second に合わせて間隔を空ける。include_usage なら最後に usage を送る）"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        for name, value in rate_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.behavior.count_status(200)
+
+        chunk_chars = 8
+        chunks = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+        interval = self.behavior.tokens(text) / len(chunks) / self.behavior.tokens_per_second \
+            if self.behavior.tokens_per_second > 0 and chunks else 0.0
+        try:
+            if anthropic:
+                self._send_chunk('event: message_start\ndata: ' + json.dumps({
+                    'type': 'message_start',
+                    'message': {'model': model, 'usage': dict(prompt_usage, output_tokens=0)}
+                }) + '\n\n')
+                self._send_chunk('event: content_block_start\ndata: ' + json.dumps({
+                    'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}
+                }) + '\n\n')
+            for chunk in chunks:
+                if interval:
+                    time.sleep(interval)
+                if anthropic:
+                    event = {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': chunk}}
+                    self._send_chunk('event: content_block_delta\ndata: ' + json.dumps(event, ensure_ascii=False) + '\n\n')
+                else:
+                    event = {'model': model, 'choices': [{'index': 0, 'delta': {'content': chunk}}]}
+                    self._send_chunk('data: ' + json.dumps(event, ensure_ascii=False) + '\n\n')
+            if anthropic:
+                self._send_chunk('event: message_delta\ndata: ' + json.dumps({
+                    'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'},
+                    'usage': {'output_tokens': completion_tokens}
+                }) + '\n\n')
+                self._send_chunk('event: message_stop\ndata: {"type": "message_stop"}\n\n')
+            else:
+                if include_usage:
+                    event = {'model': model, 'choices': [],
+                             'usage': dict(prompt_usage, completion_tokens=completion_tokens,
+                                           total_tokens=prompt_usage['prompt_tokens'] + completion_tokens)}
+                    self._send_chunk('data: ' + json.dumps(event) + '\n\n')
+                self._send_chunk('data: [DONE]\n\n')
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # クライアント側の中断（ヘッジで負けた呼び出しなど）
+            self.close_connection = True
+
+
+def start_server(behavior: MockBehavior, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    """
+    モックサーバーをバックグラウンドスレッドで起動する（負荷試験・ベンチマークからの利用向け）
+
+    Args:
+        behavior: 応答の設定
+        host: 待ち受けるホスト
+        port: 待ち受けるポート（0の場合は空いているポート）
+
+    Returns:
+        ThreadingHTTPServer: 起動したサーバー（server_address でポートを取得できる）
+    """
+    handler = type('ConfiguredMockLLMHandler', (MockLLMHandler,), {'behavior': behavior})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-llm-server', daemon=True).start()
+    logger.info(f"モックLLMサーバー起動: http://{host}:{server.server_address[1]}/v1")
+    return server
+
+
+def _load_script(path: str) -> List[Dict[str, str]]:
+    """スクリプト（{"match": 含まれる文字列（省略可）, "text": 応答} のJSON配列またはJSONL）を読み込む"""
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """コマンドラインのエントリーポイント"""
+    parser = argparse.ArgumentParser(description='OpenAI/Anthropic互換のローカルモックLLMサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency', default='fixed:0',
+                        help="最初の応答までの遅延（fixed:秒 / uniform:最小,最大 / normal:平均,σ / lognormal:中央値,σ）")
+    parser.add_argument('--tokens-per-second', type=float, default=0.0, help='生成速度（0の場合は待たない）')
+    parser.add_argument('--chars-per-token', type=float, default=1.0, help='usage のトークン数の換算に使う文字数')
+    parser.add_argument('--error-429', type=float, default=0.0, help='429を返す割合')
+    parser.add_argument('--error-500', type=float, default=0.0, help='500を返す割合')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='応答せずに接続を保持する割合')
+    parser.add_argument('--hang-seconds', type=float, default=600.0, help='タイムアウト注入時に応答しない秒数')
+    parser.add_argument('--rpm', type=int, default=0, help='1分あたりのリクエスト数上限（超えると429）')
+    parser.add_argument('--script', help='応答スクリプト（JSON配列またはJSONL）')
+    parser.add_argument('--seed', type=int, help='乱数シード（再現性のある応答・遅延・エラー）')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        behavior = MockBehavior(
+            latency=args.latency, tokens_per_second=args.tokens_per_second, chars_per_token=args.chars_per_token,
+            error_429=args.error_429, error_500=args.error_500, timeout_rate=args.timeout_rate,
+            hang_seconds=args.hang_seconds, rpm=args.rpm,
+            script=_load_script(args.script) if args.script else None, seed=args.seed
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    server = start_server(behavior, args.host, args.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
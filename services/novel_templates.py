@@ -77,10 +77,13 @@ def get_style_by_id(style_id: str) -> Optional[Dict[str, Any]]:
             return style
     return None
 
-def get_random_murakami_style() -> Dict[str, Any]:
+def get_random_murakami_style(seed: Optional[str] = None) -> Dict[str, Any]:
     """
     ランダムな村上龍風文体を取得
     
+    Args:
+        seed: 指定した場合は同じシードから常に同じ文体を選ぶ
+    
     Returns:
         Dict[str, Any]: 村上龍風文体の情報
     """
@@ -88,7 +91,8 @@ def get_random_murakami_style() -> Dict[str, Any]:
     # murakami_ryu で始まるIDのスタイルだけをフィルタリング
     murakami_styles = [style for style in styles if style.get('id', '').startswith('murakami_ryu')]
     if murakami_styles:
-        return random.choice(murakami_styles)
+        chooser = random.Random(seed) if seed is not None else random
+        return chooser.choice(murakami_styles)
     # 見つからない場合はデフォルト返す
     return {"id": "murakami_ryu_1", "name": "村上龍風", "description": "都市の闇と若者文化の融合。"}
 
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Story memory service for the novel generator application.
+Rolls episode summaries up into arc summaries and builds a bounded story context.
+"""
+
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, List, Optional, Tuple
+
+from config import Config
+from utils import generate_text, ProviderCallError
+from utils.token_budget import estimate_tokens, max_tokens_for_chars
+from utils.cost_ledger import current_call_tags, call_tags
+from .summary_service import text_hash, schedule_summary, apply_ready_summary
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# 完成したまとめ要約を保持する件数（セッションに反映されるまでの受け渡し用）
+ROLLUP_STORE_SIZE = 256
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='story-memory')
+_pending: Dict[str, Future] = {}
+_completed: 'OrderedDict[str, str]' = OrderedDict()
+_lock = threading.Lock()
+
+
+def _node_key(level: int, start: int, end: int) -> str:
+    """まとめ要約の識別子（例: '1:6-10'）"""
+    return f"{level}:{start}-{end}"
+
+
+def _span(level: int, arc_size: int) -> int:
+    """指定レベルのまとめ要約がカバーする話数"""
+    return arc_size ** level
+
+
+def _range_label(start: int, end: int) -> str:
+    return f"第{start}話" if start == end else f"第{start}〜{end}話"
+
+
+def _episode_summary(episode: Dict[str, Any]) -> Optional[str]:
+    """本文が変わっていない場合のみ、エピソードに保存された要約を返す"""
+    if episode.get('summary') is None or episode.get('summary_hash') != text_hash(episode.get('text', '')):
+        return None
+    return episode['summary']
+
+
+def _children(episodes: List[Dict[str, Any]], memory: Dict[str, Any], level: int,
+              start: int, end: int) -> Optional[List[Tuple[int, int, int, str]]]:
+    """
+    まとめ要約の材料（レベル, 開始話, 終了話, 要約）を返す（揃っていない場合はNone）
+
+    レベル1は各話の要約、レベル2以上は1つ下のレベルのまとめ要約が材料になります。
+    """
+    children = []
+    if level == 1:
+        for number in range(start, end + 1):
+            summary = _episode_summary(episodes[number - 1])
+            if summary is None:
+                return None
+            children.append((0, number, number, summary))
+        return children
+
+    step = _span(level - 1, memory['arc_size'])
+    for child_start in range(start, end + 1, step):
+        child_end = child_start + step - 1
+        summary = _ready_node(episodes, memory, level - 1, child_start, child_end)
+        if summary is None:
+            return None
+        children.append((level - 1, child_start, child_end, summary))
+    return children
+
+
+def _render(sections: List[Tuple[int, int, int, str]]) -> List[str]:
+    """要約を「第n〜m話: 要約」の行にする"""
+    return [f"{_range_label(start, end)}: {summary}" for _, start, end, summary in sections]
+
+
+def _source_hash(children: List[Tuple[int, int, int, str]]) -> str:
+    material = '\n'.join(_render(children))
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def _ready_node(episodes: List[Dict[str, Any]], memory: Dict[str, Any], level: int,
+                start: int, end: int) -> Optional[str]:
+    """材料が変わっていない（最新の）まとめ要約を返す"""
+    node = memory['nodes'].get(_node_key(level, start, end))
+    if not node:
+        return None
+    children = _children(episodes, memory, level, start, end)
+    if children is None or node['source_hash'] != _source_hash(children):
+        return None
+    return node['summary']
+
+
+def _rollup(source_hash: str, level: int, start: int, end: int,
+            children: List[Tuple[int, int, int, str]], model_choice: str,
+            tags: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """
+    バックグラウンドで材料をひとつのまとめ要約にする（tags は投入元リクエストの台帳タグ）
+
+    失敗した場合は保存せずに None を返し、次の update_story_memory で生成し直します。
+    """
+    try:
+        material = '\n'.join(_render(children))
+        prompt = f"""
+以下は官能小説の{_range_label(start, end)}の要約です。この範囲の物語を{Config.STORY_ARC_SUMMARY_CHARS}字程度の一つの要約にまとめてください。
+
+### 要約:
+{material}
+
+### 指示:
+- {Config.STORY_ARC_SUMMARY_CHARS}字程度で簡潔にまとめること
+- 登場人物の名前と関係性、未解決の伏線、物語の重要な転換点を必ず残すこと
+- 官能描写は直接的な表現を避け「～という情事があった」など簡潔に示すこと
+"""
+        try:
+            with call_tags(**{**(tags or {}), 'purpose': 'arc_summary'}):
+                summary = generate_text(model_choice, prompt,
+                                        max_tokens=max_tokens_for_chars(model_choice, Config.STORY_ARC_SUMMARY_CHARS),
+                                        use_cache=True)
+        except ProviderCallError as e:
+            logger.warning(f"物語のまとめ要約を生成できませんでした（次回生成し直します）: {_range_label(start, end)}: {e}")
+            return None
+        logger.info(f"物語のまとめ要約を生成しました: {_range_label(start, end)} (レベル{level}), {len(summary)}文字")
+        with _lock:
+            _completed[source_hash] = summary
+            _completed.move_to_end(source_hash)
+            while len(_completed) > ROLLUP_STORE_SIZE:
+                _completed.popitem(last=False)
+        return summary
+    finally:
+        with _lock:
+            _pending.pop(source_hash, None)
+
+
+def new_memory(arc_size: int = Config.STORY_ARC_SIZE) -> Dict[str, Any]:
+    """セッションに保存する空の物語メモリを作る"""
+    return {'arc_size': arc_size, 'nodes': {}}
+
+
+def update_story_memory(episodes: List[Dict[str, Any]], memory: Dict[str, Any], model_choice: str) -> None:
+    """
+    物語メモリを最新の状態に近づける（待たない）
+
+    - 完成済みのエピソード要約をエピソードに反映し、未作成のものはバックグラウンドで生成する
+    - 要約が揃った区間（arc_size 話ごと、さらにその arc_size 区間ごと…）のまとめ要約を
+      バックグラウンドで生成し、完成済みのものを memory に反映する
+
+    Args:
+        episodes: セッションのエピソード一覧（要約が書き込まれる）
+        memory: セッションの物語メモリ（まとめ要約が書き込まれる）
+        model_choice: 使用するAIモデル
+    """
+    for episode in episodes:
+        if not apply_ready_summary(episode):
+            schedule_summary(episode.get('text', ''), model_choice)
+
+    arc_size = memory['arc_size']
+    level = 1
+    while _span(level, arc_size) <= len(episodes):
+        span = _span(level, arc_size)
+        for start in range(1, len(episodes) - span + 2, span):
+            end = start + span - 1
+            children = _children(episodes, memory, level, start, end)
+            if children is None:
+                continue
+            source_hash = _source_hash(children)
+            key = _node_key(level, start, end)
+            node = memory['nodes'].get(key)
+            if node and node['source_hash'] == source_hash:
+                continue
+            with _lock:
+                summary = _completed.get(source_hash)
+                if summary is None and source_hash not in _pending:
+                    _pending[source_hash] = _executor.submit(
+                        _rollup, source_hash, level, start, end, children, model_choice, current_call_tags()
+                    )
+            if summary is not None:
+                memory['nodes'][key] = {'summary': summary, 'source_hash': source_hash}
+        level += 1
+
+
+def _total_tokens(sections: List[Tuple[int, int, int, str]], model_choice: Optional[str]) -> int:
+    return sum(estimate_tokens(line, model_choice) for line in _render(sections))
+
+
+def build_story_context(episodes: List[Dict[str, Any]], memory: Dict[str, Any], upto: int,
+                        max_tokens: int = Config.STORY_CONTEXT_MAX_TOKENS,
+                        model_choice: Optional[str] = None) -> str:
+    """
+    第1話〜第upto話までの物語を、トークン予算内の文脈にまとめる
+
+    まず最も上位のまとめ要約で全体を覆い（まとめ要約のない直近の話は各話の要約、
+    要約もない場合は本文の冒頭）、予算に余裕があれば新しい区間から順に細かい要約へ展開します。
+    それでも予算を超える場合は古いものから省きます。
+    話数が増えても文脈の大きさはほぼ一定に保たれます。
+
+    Args:
+        episodes: セッションのエピソード一覧
+        memory: セッションの物語メモリ
+        upto: 文脈に含める最後の話数
+        max_tokens: 文脈のトークン予算
+        model_choice: トークン数を見積もるAIモデル（Noneの場合は控えめな既定値）
+
+    Returns:
+        str: プロンプトに埋め込む文脈（含める話がなければ空文字）
+    """
+    upto = min(upto, len(episodes))
+    arc_size = memory['arc_size']
+
+    # 最も粗い覆い方: 各位置から始まる最大の最新まとめ要約を使う
+    sections: List[Tuple[int, int, int, str]] = []
+    position = 1
+    while position <= upto:
+        level = 1
+        chosen = None
+        while _span(level, arc_size) <= upto:
+            span = _span(level, arc_size)
+            end = position + span - 1
+            if (position - 1) % span == 0 and end <= upto:
+                summary = _ready_node(episodes, memory, level, position, end)
+                if summary is not None:
+                    chosen = (level, position, end, summary)
+            level += 1
+
+        if chosen is None:
+            episode = episodes[position - 1]
+            summary = _episode_summary(episode) or (episode.get('text', '')[:Config.STORY_ARC_SUMMARY_CHARS] + "...")
+            chosen = (0, position, position, summary)
+        sections.append(chosen)
+        position = chosen[2] + 1
+
+    # 予算の範囲で、新しい区間から細かい要約に展開する
+    while True:
+        candidate = None
+        for index in range(len(sections) - 1, -1, -1):
+            level, start, end, _ = sections[index]
+            children = _children(episodes, memory, level, start, end) if level > 0 else None
+            if children:
+                candidate = sections[:index] + children + sections[index + 1:]
+                break
+        if candidate is None or _total_tokens(candidate, model_choice) > max_tokens:
+            break
+        sections = candidate
+
+    # 予算を超える場合は古いものから省く
+    while sections and _total_tokens(sections, model_choice) > max_tokens:
+        sections.pop(0)
+    return '\n'.join(_render(sections))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Streaming service for the novel generator application.
+Holds pending streamed generations and formats Server-Sent Events.
+"""
+
+import json
+import time
+import uuid
+import threading
+import logging
+from typing import Dict, Any, Callable, Iterator, Optional
+
+from utils import stream_api_for_novel
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# 完了・放置されたストリームを保持する秒数
+STREAM_TTL_SECONDS = 600
+
+_streams: Dict[str, Dict[str, Any]] = {}
+_streams_lock = threading.Lock()
+
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """
+    Server-Sent Events の1イベント分の文字列を作成する
+
+    Args:
+        event: イベント名
+        data: JSONとして送るデータ
+
+    Returns:
+        str: SSEフォーマットの文字列
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _purge_expired() -> None:
+    """期限切れのストリームを削除する（ロック取得済みで呼ぶこと）"""
+    now = time.time()
+    expired = [sid for sid, s in _streams.items() if now - s['created_at'] > STREAM_TTL_SECONDS]
+    for sid in expired:
+        del _streams[sid]
+
+
+def create_stream(owner: str, model_choice: str, prompt_factory: Callable[[], str],
+                  max_tokens: int, episode: Dict[str, Any]) -> str:
+    """
+    ストリーミング生成を登録する
+
+    プロンプトは実際にストリームが開始されたときに prompt_factory で組み立てるため、
+    前話要約などの事前処理もストリーム側で行われます。
+
+    Args:
+        owner: ストリームを所有するクライアントID
+        model_choice: 使用するAIモデル
+        prompt_factory: プロンプトを返す関数
+        max_tokens: 生成する最大トークン数
+        episode: 完了時にエピソードとして保存するメタ情報（number, style など）
+
+    Returns:
+        str: ストリームID
+    """
+    stream_id = uuid.uuid4().hex
+    with _streams_lock:
+        _purge_expired()
+        _streams[stream_id] = {
+            'owner': owner,
+            'model_choice': model_choice,
+            'prompt_factory': prompt_factory,
+            'max_tokens': max_tokens,
+            'episode': episode,
+            'status': 'pending',
+            'text': '',
+            'created_at': time.time(),
+        }
+    return stream_id
+
+
+def get_stream(stream_id: str, owner: str) -> Optional[Dict[str, Any]]:
+    """所有者が一致するストリームを取得する"""
+    with _streams_lock:
+        stream = _streams.get(stream_id)
+    if not stream or stream['owner'] != owner:
+        return None
+    return stream
+
+
+def pop_completed_stream(stream_id: str, owner: str) -> Optional[Dict[str, Any]]:
+    """
+    完了したストリームを取り出して登録を解除する
+
+    Args:
+        stream_id: ストリームID
+        owner: クライアントID
+
+    Returns:
+        Optional[Dict[str, Any]]: 完了したストリーム（未完了・不明の場合はNone）
+    """
+    with _streams_lock:
+        stream = _streams.get(stream_id)
+        if not stream or stream['owner'] != owner or stream['status'] != 'done':
+            return None
+        return _streams.pop(stream_id)
+
+
+def run_stream(stream: Dict[str, Any]) -> Iterator[str]:
+    """
+    登録済みストリームを実行し、SSEイベントを順に返す
+
+    Args:
+        stream: create_stream で登録したストリーム
+
+    Yields:
+        str: SSEフォーマットのイベント
+    """
+    with _streams_lock:
+        status = stream['status']
+        if status == 'pending':
+            stream['status'] = 'running'
+
+    if status != 'pending':
+        # 再接続された場合は二重に生成せず、現在の状態だけを返す
+        if status == 'done':
+            yield format_sse('done', {'chars': len(stream['text'])})
+        else:
+            yield format_sse('error', {'message': 'このストリームは既に実行中か失敗しています'})
+        return
+
+    start_time = time.time()
+    chunks = []
+    deltas = None
+    try:
+        yield format_sse('status', {'message': 'プロンプトを準備中...'})
+        prompt = stream['prompt_factory']()
+        yield format_sse('status', {'message': '執筆中...'})
+
+        first_token_logged = False
+        deltas = stream_api_for_novel(stream['model_choice'], prompt, max_tokens=stream['max_tokens'])
+        for delta in deltas:
+            if not first_token_logged:
+                logger.info(f"ストリーミング最初の応答: {time.time() - start_time:.2f}秒")
+                first_token_logged = True
+            chunks.append(delta)
+            yield format_sse('token', {'text': delta})
+
+        stream['text'] = ''.join(chunks)
+        stream['status'] = 'done'
+        logger.info(f"ストリーミング生成完了: 所要時間={time.time() - start_time:.2f}秒, 文字数={len(stream['text'])}")
+        yield format_sse('done', {'chars': len(stream['text'])})
+    except GeneratorExit:
+        # クライアント切断時はプロバイダー側の接続も閉じる
+        stream['status'] = 'failed'
+        logger.warning("ストリーミング中にクライアントが切断しました")
+        raise
+    except Exception as e:
+        stream['status'] = 'failed'
+        logger.error(f"ストリーミング生成エラー: {e}", exc_info=True)
+        yield format_sse('error', {'message': str(e)})
+    finally:
+        if deltas is not None:
+            deltas.close()
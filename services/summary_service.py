@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Episode summary service for the novel generator application.
+Precomputes episode summaries in the background, keyed by a content hash.
+"""
+
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Any, Optional
+
+from config import Config
+from utils import get_episode_summary, ProviderCallError
+from utils.tracing import trace
+from utils.cost_ledger import current_call_tags, call_tags
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# 完成した要約を保持する件数（セッションに反映されるまでの受け渡し用）
+SUMMARY_STORE_SIZE = 512
+
+# 要約を生成できなかった場合に代わりに使う本文の先頭の文字数
+SUMMARY_FALLBACK_CHARS = 300
+
+_executor = ThreadPoolExecutor(max_workers=Config.SUMMARY_WORKERS, thread_name_prefix='summary')
+_pending: Dict[str, Future] = {}
+_completed: 'OrderedDict[str, str]' = OrderedDict()
+_lock = threading.Lock()
+
+
+def text_hash(text: str) -> str:
+    """エピソード本文のハッシュ（要約が最新かどうかの判定用）"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _store(digest: str, summary: str) -> None:
+    """完成した要約を保持する（ロック取得済みで呼ぶこと）"""
+    _completed[digest] = summary
+    _completed.move_to_end(digest)
+    while len(_completed) > SUMMARY_STORE_SIZE:
+        _completed.popitem(last=False)
+
+
+def _run(digest: str, text: str, model_choice: str, tags: Dict[str, str]) -> str:
+    """バックグラウンドで要約を生成する（tags は投入元リクエストの台帳タグ。失敗した場合は保存しない）"""
+    try:
+        with trace('summary.background', model_choice=model_choice), call_tags(**tags):
+            summary = get_episode_summary(text, model_choice)
+        with _lock:
+            _store(digest, summary)
+        return summary
+    finally:
+        with _lock:
+            _pending.pop(digest, None)
+
+
+def schedule_summary(text: str, model_choice: str) -> str:
+    """
+    エピソード本文の要約をバックグラウンドで生成する（生成済み・生成中なら何もしない）
+
+    Args:
+        text: エピソード本文
+        model_choice: 使用するAIモデル
+
+    Returns:
+        str: 本文のハッシュ（エピソードの summary_hash に保存する）
+    """
+    digest = text_hash(text)
+    with _lock:
+        if digest in _completed or digest in _pending:
+            return digest
+        _pending[digest] = _executor.submit(_run, digest, text, model_choice, current_call_tags())
+    logger.info(f"エピソード要約をバックグラウンドで生成開始: {len(text)}文字")
+    return digest
+
+
+def apply_ready_summary(episode: Dict[str, Any]) -> bool:
+    """
+    完成済みの要約をエピソードの記録に反映する（待たない）
+
+    Args:
+        episode: セッションのエピソード辞書
+
+    Returns:
+        bool: 最新の本文に対する要約がエピソードにある場合はTrue
+    """
+    digest = text_hash(episode.get('text', ''))
+    if episode.get('summary') is not None and episode.get('summary_hash') == digest:
+        return True
+    with _lock:
+        summary = _completed.get(digest)
+    if summary is None:
+        return False
+    episode['summary'] = summary
+    episode['summary_hash'] = digest
+    return True
+
+
+def get_summary(text: str, model_choice: str, episode: Optional[Dict[str, Any]] = None) -> str:
+    """
+    エピソード本文の要約を取得する
+
+    エピソードに保存済みの要約 → 完成済みの要約 → 生成中の要約の完了待ち の順に探し、
+    いずれもなければその場で生成します。
+
+    Args:
+        text: エピソード本文
+        model_choice: 使用するAIモデル
+        episode: 要約を保存しているエピソード辞書（任意）
+
+    要約を生成できなかった場合は本文の先頭で代用します。代用した内容は保存しないため、
+    次の呼び出しで生成し直します。
+
+    Returns:
+        str: 要約
+    """
+    digest = text_hash(text)
+    if episode is not None and episode.get('summary') is not None and episode.get('summary_hash') == digest:
+        return episode['summary']
+
+    with _lock:
+        summary = _completed.get(digest)
+        future = _pending.get(digest)
+    if summary is not None:
+        return summary
+    try:
+        if future is not None:
+            logger.info("バックグラウンドで生成中のエピソード要約を待機")
+            return future.result()
+        summary = get_episode_summary(text, model_choice)
+    except ProviderCallError as e:
+        logger.warning(f"エピソード要約を生成できないため本文の先頭で代用します（保存しない）: {e}")
+        return text[:SUMMARY_FALLBACK_CHARS] + "..."
+    with _lock:
+        _store(digest, summary)
+    return summary
@@ -14,7 +14,10 @@ from .text_utils import (
 
 from .ai_utils import (
     call_api_for_novel,
-    get_episode_summary
+    generate_text,
+    stream_api_for_novel,
+    get_episode_summary,
+    ProviderCallError
 )
 
 # Add legacy function aliases for backward compatibility
@@ -29,6 +32,9 @@ __all__ = [
     'tags_list_to_string',
     'parse_synopsis',
     'call_api_for_novel',
+    'generate_text',
+    'ProviderCallError',
+    'stream_api_for_novel',
     'get_episode_summary',
     'generate_random_character',
     'generate_random_location',
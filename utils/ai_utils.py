@@ -6,208 +6,631 @@ AI API utilities for the novel generator application.
 These functions handle the interaction with various AI service providers.
 """
 
-import os
+import json
+import math
 import time
 import logging
-import requests
-from typing import Optional, Dict, Any, Union
-from datetime import datetime
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Iterator, Tuple
+
+from config import Config, AIModels
+from .http_client import get_client_registry
+from .providers import build_provider_request, request_prompt_chars, request_token_cost, record_call_cost
+from .rate_limiter import RateLimitWaitExceeded
+from .retry_policy import get_retry_policy
+from .circuit_breaker import CircuitBreaker, get_breaker, OPEN, CLOSED
+from .hedging import get_hedger
+from .metrics import observe_provider_call, count_provider_tokens, count_provider_retry
+from .tracing import span, traced, current_span, traceparent_headers
+from .cost_ledger import call_tags
+from .response_cache import get_response_cache, make_cache_key
+from .single_flight import get_single_flight
+from .token_budget import get_token_estimator, max_tokens_for_chars
 
 # ロギングの設定
 logger = logging.getLogger('novel_generator')
 
-def call_api_for_novel(model_choice: str, user_prompt: str, max_tokens: int = 2000) -> str:
+class ProviderHTTPError(Exception):
+    """プロバイダーAPIが200以外のステータスを返したことを表す例外"""
+    
+    def __init__(self, status_code: int, text: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(f"エラー: {status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+class HedgeCancelled(Exception):
+    """ヘッジで負けた呼び出しが中断されたことを表す例外"""
+
+class ProviderCallError(Exception):
+    """フェイルオーバー先を含めてすべての呼び出しが失敗したことを表す例外（メッセージは利用者向け）"""
+
+class CallCancelled(ProviderCallError):
+    """呼び出し元のジョブがキャンセルされたため、プロバイダー呼び出しを打ち切ったことを表す例外"""
+
+# 実行中のジョブのキャンセル要求（ジョブの外ではNone）
+_cancel_event: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar('novel_cancel_event',
+                                                                                          default=None)
+
+@contextmanager
+def cancel_scope(event: threading.Event) -> Iterator[None]:
+    """
+    この中で行うプロバイダー呼び出しを event がセットされた時点で打ち切る
+    
+    呼び出しの前とリトライの待機中に確認するため、送信済みの呼び出しはそのまま完了を待ちます。
+    
+    Args:
+        event: キャンセル要求
+    """
+    token = _cancel_event.set(event)
+    try:
+        yield
+    finally:
+        _cancel_event.reset(token)
+
+def _raise_if_cancelled() -> None:
+    """キャンセル要求があれば CallCancelled を送出する"""
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise CallCancelled("キャンセルされたため生成を中止しました。")
+
+def _iter_stream_events(resp: Any) -> Iterator[Dict[str, Any]]:
+    """SSEレスポンスの data 行をJSONイベントとして順に返す（終了イベントで止まる）"""
+    for raw_line in resp.iter_lines():
+        # SSEの data 行のみを処理（event: 行やコメントは無視）
+        line = raw_line.decode('utf-8').strip()
+        if not line.startswith('data:'):
+            continue
+        body = line[len('data:'):].strip()
+        if body == '[DONE]':
+            return
+        try:
+            event = json.loads(body)
+        except ValueError:
+            continue
+        if event.get('type') == 'message_stop':
+            return
+        yield event
+
+def _normalize_model_choice(model_choice: str) -> str:
+    """未知のモデルをデフォルト(xAI)に置き換える"""
+    if not AIModels.is_known(model_choice):
+        logger.warning(f"未サポートのモデル '{model_choice}' が指定されました。デフォルト(xAI)を使用します。")
+        return 'xai'
+    return model_choice
+
+def _response_cache_key(model_choice: str, user_prompt: str, max_tokens: int,
+                        temperature: Optional[float] = None) -> Optional[str]:
+    """実際に送るモデル識別子と温度を含めたキャッシュキーを返す（リクエストを組み立てられない場合はNone）"""
+    try:
+        req = build_provider_request(model_choice, user_prompt, max_tokens, temperature)
+    except ValueError:
+        return None
+    return make_cache_key(req['model_id'], user_prompt, max_tokens, req['data'].get('temperature'))
+
+def call_api_for_novel(model_choice: str, user_prompt: str, max_tokens: int = 2000,
+                       allow_failover: Optional[bool] = None, hedge: Optional[bool] = None,
+                       use_cache: bool = False) -> str:
     """
     モデル選択に応じて各AIサービスのAPIを呼び出す関数
     
+    generate_text と同じですが、失敗した場合は例外ではなくエラーメッセージを返します。
+    
     Args:
         model_choice: 使用するAIモデルの種類 ('xai', 'grok-3', 'gpt-4o', 'claude-3-opus', 'deepseek-v3')
         user_prompt: AIに送信するプロンプト
         max_tokens: 生成する最大トークン数
+        allow_failover: フェイルオーバーを許可するか（Noneの場合は Config.AI_FAILOVER_ENABLED）
+        hedge: ヘッジ付きリクエストを使うか（Noneの場合は Config.HEDGING_ENABLED）
+        use_cache: 入力だけで結果が決まる呼び出し（要約・文体変換など）でレスポンスキャッシュを使うか
         
     Returns:
-        str: AIからの応答テキスト
+        str: AIからの応答テキスト（失敗した場合はエラーメッセージ）
+    """
+    try:
+        return generate_text(model_choice, user_prompt, max_tokens, allow_failover=allow_failover,
+                             hedge=hedge, use_cache=use_cache)
+    except ProviderCallError as e:
+        return str(e)
+
+@traced('llm.generate')
+def generate_text(model_choice: str, user_prompt: str, max_tokens: int = 2000,
+                  temperature: Optional[float] = None, allow_failover: Optional[bool] = None,
+                  hedge: Optional[bool] = None, use_cache: bool = False) -> str:
     """
-    # 各APIキーを取得 (load_dotenv() で .env から自動ロード)
-    xai_api_key = os.getenv('XAI_API_KEY', '')
-    openai_api_key = os.getenv('OPENAI_API_KEY', '')
-    anthropic_api_key = os.getenv('ANTHROPIC_API_KEY', '')
-    deepseek_api_key = os.getenv('DEEPSEEK_API_KEY', '')
+    プロバイダーアダプター経由でテキストを生成する
+    
+    プロバイダーのサーキットブレーカーが open の場合は呼び出さずに、また一時的な障害（リトライ可能なエラー）で
+    リトライを使い切った場合は、AIModels.FALLBACK_CHAINS に従って別のモデルへフェイルオーバーします。
+    400 やAPIキー未設定などの失敗ではフェイルオーバーしません。
+    同じリクエストが実行中の場合は新たに呼び出さず、その結果を共有します。
     
+    Args:
+        model_choice: AIModels のモデル識別子
+        user_prompt: AIに送信するプロンプト
+        max_tokens: 生成する最大トークン数
+        temperature: 温度（Noneの場合はモデルの既定値）
+        allow_failover: フェイルオーバーを許可するか（Noneの場合は Config.AI_FAILOVER_ENABLED）
+        hedge: ヘッジ付きリクエストを使うか（Noneの場合は Config.HEDGING_ENABLED）
+        use_cache: 入力だけで結果が決まる呼び出し（要約・文体変換など）でレスポンスキャッシュを使うか
+        
+    Returns:
+        str: AIからの応答テキスト
+        
+    Raises:
+        ProviderCallError: フェイルオーバー先を含めてすべての呼び出しが失敗した場合
+            （実行中のジョブがキャンセルされた場合はサブクラスの CallCancelled）
+    """
     # サポートされているモデルの確認
-    supported_models = ['xai', 'grok-3', 'gpt-4o', 'claude-3-opus', 'deepseek-v3']
-    if model_choice not in supported_models:
-        logger.warning(f"未サポートのモデル '{model_choice}' が指定されました。デフォルト(xAI)を使用します。")
-        model_choice = 'xai'
+    model_choice = _normalize_model_choice(model_choice)
+    current_span().set_attribute('model_choice', model_choice)
     
-    # リトライ設定
-    max_retries = 3
-    retry_delay = 2  # 秒
+    cache_key = None
+    if use_cache and Config.RESPONSE_CACHE_ENABLED:
+        cache_key = _response_cache_key(model_choice, user_prompt, max_tokens, temperature)
+        if cache_key:
+            cached = get_response_cache().get(cache_key)
+            if cached is not None:
+                current_span().set_attribute('cache_hit', True)
+                logger.info(f"レスポンスキャッシュヒット: モデル={model_choice}, {len(cached)}文字")
+                return cached
     
-    for retry in range(max_retries):
-        try:
-            # xAI (Grok) モデル
-            if model_choice in ['xai', 'grok-3']:
-                if not xai_api_key:
-                    raise ValueError("xAI APIキーが設定されていません")
-                    
-                headers = {"Authorization": f"Bearer {xai_api_key}", "Content-Type": "application/json"}
-                
-                # モデルを識別子から選択
-                if model_choice == 'grok-3':
-                    model_id = "grok-3-1212"  # Grok-3モデル識別子
-                else:  # デフォルトはgrok-2
-                    model_id = "grok-2-1212"
-                    
-                data = {
-                    "model": model_id,
-                    "messages": [{"role": "user", "content": user_prompt}],
-                    "max_tokens": max_tokens,
-                    "temperature": 0.7
-                }
-                endpoint = "https://api.x.ai/v1/chat/completions"
-                
-                logger.info(f"xAI API呼び出し: モデル={model_id}, max_tokens={max_tokens}")
-                resp = requests.post(endpoint, headers=headers, json=data, timeout=60)
-                if resp.status_code == 200:
-                    result = resp.json().get("choices", [{}])[0].get("message", {}).get("content", "テキスト取得失敗")
-                    logger.info(f"xAI API応答: {len(result)}文字")
-                    return result
-                else:
-                    error_msg = f"xAI APIエラー: ステータスコード={resp.status_code}, レスポンス={resp.text}"
-                    logger.error(error_msg)
-                    if retry < max_retries - 1:
-                        logger.info(f"xAI API: {retry + 1}回目のリトライ...")
-                        time.sleep(retry_delay)
-                        continue
-                    return f"エラー: {resp.status_code} - {resp.text}"
-                
-            # OpenAI GPT-4o モデル
-            elif model_choice == 'gpt-4o':
-                if not openai_api_key:
-                    raise ValueError("OpenAI APIキーが設定されていません")
-                
-                headers = {"Content-Type": "application/json", "Authorization": f"Bearer {openai_api_key}"}
-                
-                data = {
-                    "model": "gpt-4o",
-                    "messages": [{"role": "user", "content": user_prompt}],
-                    "max_tokens": max_tokens,
-                    "temperature": 0.8
-                }
-                endpoint = "https://api.openai.com/v1/chat/completions"
-                
-                logger.info(f"OpenAI API呼び出し: モデル=gpt-4o, max_tokens={max_tokens}")
-                resp = requests.post(endpoint, headers=headers, json=data, timeout=60)
-                if resp.status_code == 200:
-                    result = resp.json().get("choices", [{}])[0].get("message", {}).get("content", "テキスト取得失敗")
-                    logger.info(f"OpenAI API応答: {len(result)}文字")
-                    return result
-                else:
-                    error_msg = f"OpenAI APIエラー: ステータスコード={resp.status_code}, レスポンス={resp.text}"
-                    logger.error(error_msg)
-                    if retry < max_retries - 1:
-                        logger.info(f"OpenAI API: {retry + 1}回目のリトライ...")
-                        time.sleep(retry_delay)
-                        continue
-                    return f"エラー: {resp.status_code} - {resp.text}"
-                
-            # Anthropic Claude 3 Opus モデル
-            elif model_choice == 'claude-3-opus':
-                if not anthropic_api_key:
-                    raise ValueError("Anthropic APIキーが設定されていません")
-                
-                headers = {
-                    "x-api-key": anthropic_api_key,
-                    "anthropic-version": "2023-06-01",
-                    "Content-Type": "application/json"
-                }
-                
-                data = {
-                    "model": "claude-3-opus-20240229",
-                    "max_tokens": max_tokens,
-                    "temperature": 0.7,
-                    "messages": [
-                        {"role": "user", "content": user_prompt}
-                    ]
-                }
-                endpoint = "https://api.anthropic.com/v1/messages"
-                
-                logger.info(f"Anthropic API呼び出し: モデル=claude-3-opus-20240229, max_tokens={max_tokens}")
-                resp = requests.post(endpoint, headers=headers, json=data, timeout=60)
-                if resp.status_code == 200:
-                    result = resp.json().get("content", [{}])[0].get("text", "テキスト取得失敗")
-                    logger.info(f"Anthropic API応答: {len(result)}文字")
-                    return result
-                else:
-                    error_msg = f"Anthropic APIエラー: ステータスコード={resp.status_code}, レスポンス={resp.text}"
-                    logger.error(error_msg)
-                    if retry < max_retries - 1:
-                        logger.info(f"Anthropic API: {retry + 1}回目のリトライ...")
-                        time.sleep(retry_delay)
-                        continue
-                    return f"エラー: {resp.status_code} - {resp.text}"
-            
-            # DeepSeek V3-0324 モデル
-            elif model_choice == 'deepseek-v3':
-                if not deepseek_api_key:
-                    raise ValueError("DeepSeek APIキーが設定されていません")
-                
-                headers = {
-                    "Authorization": f"Bearer {deepseek_api_key}",
-                    "Content-Type": "application/json"
-                }
-                
-                # 現在の日付を取得してシステムプロンプトに追加
-                today = datetime.now().strftime("%m月%d日")
-                
-                data = {
-                    "model": "deepseek-chat",  # 正しいモデル識別子
-                    "messages": [
-                        # システムプロンプトを追加
-                        {"role": "system", "content": f"该助手为DeepSeek Chat，由深度求索公司创造。今天是{today}。"},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    "max_tokens": max_tokens,
-                    "temperature": 0.7  # 0.7を指定すると内部では0.21として処理される
-                }
-                
-                # DeepSeek APIのベースURLを.envから取得（デフォルト値も設定）
-                deepseek_api_base = os.getenv('DEEPSEEK_API_BASE', 'https://api.deepseek.com/v1')
-                endpoint = f"{deepseek_api_base}/chat/completions"
-                
-                logger.info(f"DeepSeek API呼び出し: モデル=deepseek-chat, max_tokens={max_tokens}")
-                resp = requests.post(endpoint, headers=headers, json=data, timeout=60)
-                if resp.status_code == 200:
-                    result = resp.json().get("choices", [{}])[0].get("message", {}).get("content", "テキスト取得失敗")
-                    logger.info(f"DeepSeek API応答: {len(result)}文字")
-                    return result
-                else:
-                    error_msg = f"DeepSeek APIエラー: ステータスコード={resp.status_code}, レスポンス={resp.text}"
-                    logger.error(error_msg)
-                    if retry < max_retries - 1:
-                        logger.info(f"DeepSeek API: {retry + 1}回目のリトライ...")
-                        time.sleep(retry_delay)
-                        continue
-                    return f"エラー: {resp.status_code} - {resp.text}"
+    def call() -> str:
+        return _call_with_failover(model_choice, user_prompt, max_tokens, temperature,
+                                   allow_failover, hedge, cache_key)
+    
+    # 同じリクエスト（二重送信・ブラウザの再送など）が実行中であれば、その結果を共有する
+    if Config.SINGLE_FLIGHT_ENABLED:
+        flight_key = cache_key or _response_cache_key(model_choice, user_prompt, max_tokens, temperature)
+        if flight_key:
+            text, shared = get_single_flight().do(flight_key, call)
+            if shared:
+                current_span().set_attribute('single_flight_shared', True)
+                logger.info(f"実行中の同一リクエストの結果を共有: モデル={model_choice}, {len(text)}文字")
+            return text
+    return call()
 
-            else:
-                error_msg = f"未知のモデル: {model_choice}"
-                logger.error(error_msg)
-                return error_msg
+def _call_with_failover(model_choice: str, user_prompt: str, max_tokens: int, temperature: Optional[float],
+                        allow_failover: Optional[bool], hedge: Optional[bool],
+                        cache_key: Optional[str]) -> str:
+    """
+    サーキットブレーカーとフェイルオーバーに従ってモデルを順に呼び出す
+    
+    Args:
+        model_choice: 使用するAIモデル（正規化済み）
+        user_prompt: AIに送信するプロンプト
+        max_tokens: 生成する最大トークン数
+        temperature: 温度（Noneの場合はモデルの既定値）
+        allow_failover: フェイルオーバーを許可するか（Noneの場合は Config.AI_FAILOVER_ENABLED）
+        hedge: ヘッジ付きリクエストを使うか（Noneの場合は Config.HEDGING_ENABLED）
+        cache_key: 応答を保存するレスポンスキャッシュのキー（保存しない場合はNone）
+        
+    Returns:
+        str: AIからの応答テキスト
+        
+    Raises:
+        ProviderCallError: すべての候補が失敗した場合（最後のエラーメッセージを持つ）
+        CallCancelled: 実行中のジョブがキャンセルされた場合
+    """
+    if allow_failover is None:
+        allow_failover = Config.AI_FAILOVER_ENABLED
+    if hedge is None:
+        hedge = Config.HEDGING_ENABLED
+    candidates = [model_choice]
+    if allow_failover:
+        candidates += [m for m in AIModels.get_fallback_chain(model_choice) if m != model_choice]
+    
+    error_text = "APIサービスに接続できませんでした。後でもう一度お試しください。"
+    for candidate in candidates:
+        _raise_if_cancelled()
+        provider_name = AIModels.get_provider(candidate)
+        breaker = get_breaker(provider_name)
+        if not breaker.allow_request():
+            logger.warning(f"サーキットブレーカー open のため {provider_name} の呼び出しをスキップ: モデル={candidate}")
+            error_text = f"エラー: {AIModels.get_display_name(candidate)} は一時的に利用できません。しばらくしてから再試行してください。"
+            continue
+        
+        if candidate != model_choice:
+            logger.warning(f"フェイルオーバー: {model_choice} -> {candidate}")
+        
+        success, text, transient, answered_by = _call_provider(candidate, user_prompt, max_tokens, breaker,
+                                                               hedge=hedge, temperature=temperature)
+        if success:
+            # フェイルオーバー先・ヘッジのバックアップの応答は要求したモデルの結果としてキャッシュしない
+            if cache_key and answered_by == model_choice:
+                get_response_cache().set(cache_key, text, model=model_choice)
+            return text
+        if candidate == model_choice:
+            error_text = text
+            if not transient:
+                # リクエスト内容や設定の問題（400・APIキー未設定など）は別のモデルに切り替えても解決しない
+                break
+    
+    raise ProviderCallError(error_text)
+
+def _wait_for_capacity(req: Dict[str, Any]) -> int:
+    """
+    レート制限の枠が空くまで待つ
+    
+    Args:
+        req: build_provider_request の戻り値
+        
+    Returns:
+        int: 予約したトークン数（レート制限が無効な場合は0）
+        
+    Raises:
+        RateLimitWaitExceeded: 待ち時間が RATE_LIMIT_MAX_WAIT を超える場合
+    """
+    limiter = req.get('limiter')
+    if limiter is None:
+        return 0
+    reserved = request_token_cost(req)
+    limiter.acquire(reserved)
+    return reserved
 
+def _call_provider(model_choice: str, user_prompt: str, max_tokens: int, breaker: CircuitBreaker,
+                   hedge: bool = False, temperature: Optional[float] = None) -> Tuple[bool, str, bool, str]:
+    """
+    1つのモデルをリトライ方針に従って呼び出し、結果をブレーカーに記録する
+    
+    Args:
+        model_choice: 使用するAIモデル
+        user_prompt: AIに送信するプロンプト
+        max_tokens: 生成する最大トークン数
+        breaker: プロバイダーのサーキットブレーカー
+        hedge: 各試行をヘッジ付きで行うか
+        temperature: 温度（Noneの場合はモデルの既定値）
+        
+    Returns:
+        Tuple[bool, str, bool, str]: (成功したか, 応答テキストまたはエラーメッセージ,
+                                      失敗が一時的なもので別モデルへのフェイルオーバーで解決しうるか,
+                                      応答したモデル（ヘッジのバックアップが採用された場合はそのモデル）)
+        
+    Raises:
+        CallCancelled: リトライの待機中に実行中のジョブがキャンセルされた場合
+    """
+    # プロバイダーごとのプール済みセッション（keep-alive接続を再利用）
+    http_client = get_client_registry()
+    
+    # リトライ方針（エラー分類・バックオフ・リトライ予算）
+    retry_policy = get_retry_policy()
+    retry_policy.record_call()
+    
+    try:
+        req = build_provider_request(model_choice, user_prompt, max_tokens, temperature)
+    except ValueError as e:
+        # APIキー未設定などの設定エラーはリトライしない（プロバイダーの健全性とは無関係）
+        breaker.release()
+        logger.error(f"API呼び出しエラー ({model_choice}): {e}")
+        return False, f"API呼び出し中にエラー: {str(e)}", False, model_choice
+    provider = req['provider']
+    adapter = req['adapter']
+    estimator = get_token_estimator()
+    prompt_tokens = estimator.estimate(user_prompt, adapter.name)
+    
+    attempt = 0
+    while True:
+        call_start = time.time()
+        post_start = call_start
+        usage = None
+        cached_tokens = 0
+        try:
+            logger.info(f"{provider} API呼び出し: モデル={req['model_id']}, 推定入力トークン={prompt_tokens}, max_tokens={max_tokens}")
+            answered_by = model_choice
+            if hedge:
+                # 使用量の記録・予約の精算・コスト台帳への記録はヘッジの1本ごとに _collect_stream が行う
+                hedged = _hedged_request(model_choice, req, user_prompt, max_tokens, temperature)
+                result, answered_by = hedged['text'], hedged['model_choice']
+            else:
+                # レート制限の枠が空くまで待ってから、プロバイダーの同時実行数の枠内で呼び出す
+                with span('provider.rate_limit_wait'):
+                    reserved = _wait_for_capacity(req)
+                adapter.acquire()
+                post_start = time.time()
+                try:
+                    with span('provider.http', 'client', provider=adapter.name, model=req['model_id'],
+                              attempt=attempt) as http_span:
+                        resp = http_client.post(req['endpoint'], headers=traceparent_headers(req['headers']),
+                                                json=req['data'])
+                        http_span.set_attribute('http.status_code', resp.status_code)
+                except Exception:
+                    observe_provider_call(adapter.name, req['model_id'], 'error', time.time() - post_start)
+                    raise
+                finally:
+                    adapter.release()
+                observe_provider_call(adapter.name, req['model_id'], resp.status_code, time.time() - post_start)
+                if req['limiter'] is not None:
+                    req['limiter'].update_from_headers(resp.headers, resp.status_code)
+                if resp.status_code != 200:
+                    raise ProviderHTTPError(resp.status_code, resp.text, resp.headers)
+                with span('provider.parse'):
+                    payload = resp.json()
+                    result = adapter.parse_text(payload)
+                    # 実際のトークン数で文字数/トークン比を補正する
+                    usage = adapter.parse_usage(payload)
+                    cached_tokens = adapter.parse_cached_tokens(payload)
+                if usage:
+                    estimator.record_usage(adapter.name, request_prompt_chars(req), usage[0], len(result), usage[1])
+                    if req['limiter'] is not None:
+                        req['limiter'].settle(reserved, usage[0] + usage[1])
+                    count_provider_tokens(adapter.name, req['model_id'], usage[0], usage[1], cached_tokens)
+                    logger.info(f"{provider} API使用量: 入力={usage[0]}トークン（キャッシュ={cached_tokens}）, "
+                                f"出力={usage[1]}トークン")
+                record_call_cost(req, model_choice, 'ok', post_start, user_prompt, len(result), usage, cached_tokens)
+            # 成功は実際に応答したモデルのプロバイダーに記録し、別プロバイダーが応答した場合はプライマリの枠を返す
+            answered_breaker = get_breaker(AIModels.get_provider(answered_by))
+            if answered_breaker is not breaker:
+                breaker.release()
+            answered_breaker.record_success(time.time() - call_start)
+            logger.info(f"{provider} API応答: {len(result)}文字")
+            return True, result, False, answered_by
+        
+        except ProviderHTTPError as e:
+            error_msg = f"{provider} APIエラー: ステータスコード={e.status_code}, レスポンス={e.text}"
+            logger.error(error_msg)
+            if not hedge:
+                record_call_cost(req, model_choice, str(e.status_code), post_start, user_prompt)
+            transient = retry_policy.is_retryable(status_code=e.status_code)
+            if transient:
+                breaker.record_failure(f"HTTP {e.status_code}")
+            else:
+                # リクエスト内容の問題（400など）はプロバイダー障害として数えない
+                breaker.release()
+            delay = retry_policy.next_delay(attempt, status_code=e.status_code, headers=e.headers)
+            if delay is None:
+                return False, f"エラー: {e.status_code} - {e.text}", transient, model_choice
+        
+        except RateLimitWaitExceeded as e:
+            # 自分側の送信ペースの問題のため、プロバイダー障害として数えずにフェイルオーバーに任せる
+            breaker.release()
+            logger.warning(f"API呼び出しを見送り ({model_choice}): {e}")
+            return False, f"エラー: {e}", True, model_choice
+        
         except Exception as e:
             logger.error(f"API呼び出しエラー ({model_choice}): {e}", exc_info=True)
-            if retry < max_retries - 1:
-                logger.info(f"API呼び出し: {retry + 1}回目のリトライ...")
-                time.sleep(retry_delay)
+            if not hedge:
+                record_call_cost(req, model_choice, 'error', post_start, user_prompt)
+            breaker.record_failure(type(e).__name__)
+            delay = retry_policy.next_delay(attempt, exception=e)
+            if delay is None:
+                return False, f"API呼び出し中にエラー: {str(e)}", retry_policy.is_retryable(exception=e), model_choice
+        
+        # リトライ中にブレーカーが open になった場合はフェイルオーバーに任せる
+        if breaker.state == OPEN:
+            logger.warning(f"{provider} API: サーキットブレーカーが open になったためリトライを中止")
+            return False, f"エラー: {provider} APIが一時的に利用できません", True, model_choice
+        
+        attempt += 1
+        count_provider_retry(adapter.name, req['model_id'])
+        logger.info(f"{provider} API: {attempt}回目のリトライ ({delay:.1f}秒後)...")
+        # ジョブがキャンセルされたら待機を切り上げ、リトライを送らない
+        cancel_event = _cancel_event.get()
+        if cancel_event is not None:
+            cancel_event.wait(delay)
+        else:
+            time.sleep(delay)
+        try:
+            _raise_if_cancelled()
+        except CallCancelled:
+            breaker.release()
+            raise
+
+def _collect_stream(model_choice: str, req: Dict[str, Any], user_prompt: str, cancel_event: threading.Event,
+                    first_byte: threading.Event) -> Dict[str, Any]:
+    """
+    stream=true で呼び出して全文を組み立てる（ヘッジの1本分）
+    
+    最初の差分を受け取ったら first_byte をセットし、cancel_event がセットされたら接続を閉じて中断します。
+    レート制限の予約の精算とコスト台帳への記録は、中断・失敗した場合も含めてこの1本分ごとに行います。
+    
+    Args:
+        model_choice: このリクエストのモデル
+        req: build_provider_request の戻り値
+        user_prompt: AIに送信するプロンプト
+        cancel_event: 中断要求
+        first_byte: 最初の応答の通知先
+        
+    Returns:
+        Dict[str, Any]: model_choice, req, text, usage, cached_tokens を含む辞書
+        
+    Raises:
+        ProviderHTTPError: APIがエラーステータスを返した場合
+        HedgeCancelled: 中断された場合
+    """
+    adapter = req['adapter']
+    limiter = req['limiter']
+    estimator = get_token_estimator()
+    data = adapter.stream_payload(req['data'])
+    with span('provider.rate_limit_wait'):
+        reserved = _wait_for_capacity(req)
+    adapter.acquire()
+    post_start = time.time()
+    try:
+        with span('provider.http', 'client', provider=adapter.name, model=req['model_id'], stream=True) as http_span:
+            resp = get_client_registry().post(req['endpoint'], headers=traceparent_headers(req['headers']),
+                                              json=data, stream=True)
+            http_span.set_attribute('http.status_code', resp.status_code)
+    except Exception:
+        observe_provider_call(adapter.name, req['model_id'], 'error', time.time() - post_start)
+        record_call_cost(req, model_choice, 'error', post_start, user_prompt)
+        adapter.release()
+        raise
+    observe_provider_call(adapter.name, req['model_id'], resp.status_code, time.time() - post_start)
+    chunks = []
+    usage_fields: Dict[str, Any] = {}
+    try:
+        if limiter is not None:
+            limiter.update_from_headers(resp.headers, resp.status_code)
+        if resp.status_code != 200:
+            record_call_cost(req, model_choice, str(resp.status_code), post_start, user_prompt)
+            raise ProviderHTTPError(resp.status_code, resp.text, resp.headers)
+        for event in _iter_stream_events(resp):
+            if cancel_event.is_set():
+                raise HedgeCancelled()
+            delta = adapter.parse_stream_delta(event)
+            if delta:
+                first_byte.set()
+                chunks.append(delta)
+            usage_fields.update(adapter.parse_stream_usage(event) or {})
+    except HedgeCancelled:
+        # 負けた側も中断までに生成された分は課金されるため、受け取った文字数から見積もって記録する
+        received = sum(len(chunk) for chunk in chunks)
+        if limiter is not None:
+            completion_tokens = math.ceil(received / estimator.ratio(adapter.name, 'completion'))
+            limiter.settle(reserved, reserved - req['data'].get('max_tokens', 0) + completion_tokens)
+        record_call_cost(req, model_choice, 'cancelled', post_start, user_prompt, received)
+        raise
+    except ProviderHTTPError:
+        raise
+    except Exception:
+        record_call_cost(req, model_choice, 'error', post_start, user_prompt)
+        raise
+    finally:
+        # 負けた側はここで接続を閉じ、以降の生成分を受け取らない
+        resp.close()
+        adapter.release()
+    
+    text = ''.join(chunks)
+    usage = adapter.parse_usage({'usage': usage_fields})
+    cached_tokens = adapter.parse_cached_tokens({'usage': usage_fields})
+    if usage:
+        estimator.record_usage(adapter.name, request_prompt_chars(req), usage[0], len(text), usage[1])
+        if limiter is not None:
+            limiter.settle(reserved, usage[0] + usage[1])
+        count_provider_tokens(adapter.name, req['model_id'], usage[0], usage[1], cached_tokens)
+        logger.info(f"{req['provider']} API使用量: 入力={usage[0]}トークン（キャッシュ={cached_tokens}）, "
+                    f"出力={usage[1]}トークン")
+    elif limiter is not None:
+        # usage が返らない場合は、出力を文字数から見積もって予約分を精算する
+        completion_tokens = math.ceil(len(text) / estimator.ratio(adapter.name, 'completion'))
+        limiter.settle(reserved, reserved - req['data'].get('max_tokens', 0) + completion_tokens)
+    record_call_cost(req, model_choice, 'ok', post_start, user_prompt, len(text), usage, cached_tokens)
+    return {'model_choice': model_choice, 'req': req, 'text': text, 'usage': usage, 'cached_tokens': cached_tokens}
+
+def _hedged_request(model_choice: str, req: Dict[str, Any], user_prompt: str, max_tokens: int,
+                    temperature: Optional[float] = None) -> Dict[str, Any]:
+    """
+    ヘッジ付きで1回分の試行を行う
+    
+    プライマリが学習済みのp95以内に最初の応答を返さなければ、Config.HEDGE_TARGET に従って
+    同じモデル、またはフォールバック先の最初の健全なモデルへバックアップを1本送ります。
+    
+    Args:
+        model_choice: 使用するAIモデル
+        req: プライマリのリクエスト
+        user_prompt: AIに送信するプロンプト
+        max_tokens: 生成する最大トークン数
+        temperature: 温度（Noneの場合は各モデルの既定値）
+        
+    Returns:
+        Dict[str, Any]: 先に完了した方の _collect_stream の戻り値（model_choice は実際に応答したモデル）
+    """
+    backup_model, backup_req = model_choice, req
+    if Config.HEDGE_TARGET == 'fallback':
+        for alternate in AIModels.get_fallback_chain(model_choice):
+            if alternate == model_choice or get_breaker(AIModels.get_provider(alternate)).state != CLOSED:
+                continue
+            try:
+                backup_model, backup_req = alternate, build_provider_request(alternate, user_prompt, max_tokens,
+                                                                             temperature)
+                break
+            except ValueError:
                 continue
-            return f"API呼び出し中にエラー: {str(e)}"
     
-    # すべてのリトライが失敗した場合
-    return "APIサービスに接続できませんでした。後でもう一度お試しください。"
+    result, used_backup = get_hedger().call(
+        AIModels.get_provider(model_choice),
+        lambda cancel, first_byte: _collect_stream(model_choice, req, user_prompt, cancel, first_byte),
+        lambda cancel, first_byte: _collect_stream(backup_model, backup_req, user_prompt, cancel, first_byte)
+    )
+    if used_backup:
+        logger.info(f"ヘッジ: バックアップ ({backup_req['provider']} {backup_req['model_id']}) の応答を採用")
+    return result
+
+def stream_api_for_novel(model_choice: str, user_prompt: str, max_tokens: int = 2000) -> Iterator[str]:
+    """
+    stream=true でAIサービスのAPIを呼び出し、生成テキストを差分ごとに返すジェネレーター
+    
+    Args:
+        model_choice: 使用するAIモデルの種類
+        user_prompt: AIに送信するプロンプト
+        max_tokens: 生成する最大トークン数
+        
+    Yields:
+        str: 到着した差分テキスト
+        
+    Raises:
+        RuntimeError: APIがエラーステータスを返した場合、またはレート制限の待ち時間が長すぎる場合
+        ValueError: モデルのプロバイダーがストリーミングに対応していない場合
+    """
+    model_choice = _normalize_model_choice(model_choice)
+    req = build_provider_request(model_choice, user_prompt, max_tokens)
+    provider = req['provider']
+    adapter = req['adapter']
+    if not adapter.supports_streaming:
+        raise ValueError(f"{provider} はストリーミングに対応していません")
+    req['data']['stream'] = True
+    
+    breaker = get_breaker(adapter.name)
+    if not breaker.allow_request():
+        raise RuntimeError(f"エラー: {AIModels.get_display_name(model_choice)} は一時的に利用できません。しばらくしてから再試行してください。")
+    
+    logger.info(f"{provider} APIストリーミング呼び出し: モデル={req['model_id']}, max_tokens={max_tokens}")
+    try:
+        reserved = _wait_for_capacity(req)
+    except RateLimitWaitExceeded as e:
+        breaker.release()
+        raise RuntimeError(f"エラー: {e}")
+    call_start = time.time()
+    adapter.acquire()
+    try:
+        with span('provider.http', 'client', provider=adapter.name, model=req['model_id'], stream=True) as http_span:
+            resp = get_client_registry().post(req['endpoint'], headers=traceparent_headers(req['headers']),
+                                              json=req['data'], stream=True)
+            http_span.set_attribute('http.status_code', resp.status_code)
+    except Exception as e:
+        observe_provider_call(adapter.name, req['model_id'], 'error', time.time() - call_start)
+        adapter.release()
+        breaker.record_failure(type(e).__name__)
+        raise
+    observe_provider_call(adapter.name, req['model_id'], resp.status_code, time.time() - call_start)
+    total_chars = 0
+    try:
+        if req['limiter'] is not None:
+            req['limiter'].update_from_headers(resp.headers, resp.status_code)
+        if resp.status_code != 200:
+            error_msg = f"{provider} APIエラー: ステータスコード={resp.status_code}, レスポンス={resp.text}"
+            logger.error(error_msg)
+            record_call_cost(req, model_choice, str(resp.status_code), call_start, user_prompt)
+            if get_retry_policy().is_retryable(status_code=resp.status_code):
+                breaker.record_failure(f"HTTP {resp.status_code}")
+            else:
+                breaker.release()
+            raise RuntimeError(f"エラー: {resp.status_code} - {resp.text}")
+        # ストリーミングではヘッダー到着までの時間で健全性を判定する
+        breaker.record_success(time.time() - call_start)
+        
+        for event in _iter_stream_events(resp):
+            delta = adapter.parse_stream_delta(event)
+            if delta:
+                total_chars += len(delta)
+                yield delta
+        
+        logger.info(f"{provider} APIストリーミング応答: {total_chars}文字")
+        # usage が返らないため、出力は文字数から見積もって予約分を精算する
+        if req['limiter'] is not None:
+            completion_tokens = math.ceil(total_chars / get_token_estimator().ratio(adapter.name, 'completion'))
+            req['limiter'].settle(reserved, reserved - max_tokens + completion_tokens)
+    finally:
+        resp.close()
+        adapter.release()
+        # 途中で切断された場合も、受け取った分までを記録する
+        if resp.status_code == 200:
+            record_call_cost(req, model_choice, 'ok', call_start, user_prompt, total_chars)
 
-def get_episode_summary(episode_text: str, model_choice: str, max_length: int = 300) -> str:
+def get_episode_summary(episode_text: str, model_choice: str, max_length: int = 300,
+                        use_cache: bool = True) -> str:
     """
     エピソードテキストのサマリーを生成する
     
@@ -215,9 +638,13 @@ def get_episode_summary(episode_text: str, model_choice: str, max_length: int =
         episode_text: 要約するエピソードのテキスト
         model_choice: 使用するAIモデル
         max_length: 要約の最大長さ
+        use_cache: 同じテキストの要約をレスポンスキャッシュから返すか
         
     Returns:
         str: エピソードのサマリー
+        
+    Raises:
+        ProviderCallError: 要約の生成に失敗した場合（失敗したまま要約として保存されないよう例外にする）
     """
     # テキストが短い場合は要約せずにそのまま返す
     if len(episode_text) <= max_length:
@@ -240,10 +667,12 @@ def get_episode_summary(episode_text: str, model_choice: str, max_length: int =
     
     # API呼び出し
     try:
-        summary = call_api_for_novel(model_choice, summary_prompt, max_tokens=400)
-        logger.info(f"エピソード要約を生成しました: {len(summary)}文字")
-        return summary
-    except Exception as e:
+        with call_tags(purpose='episode_summary'):
+            summary = generate_text(model_choice, summary_prompt,
+                                    max_tokens=max_tokens_for_chars(model_choice, max_length),
+                                    use_cache=use_cache)
+    except ProviderCallError as e:
         logger.error(f"要約生成エラー: {e}")
-        # エラー時は元テキストの先頭部分を返す
-        return episode_text[:max_length] + "..."
\ No newline at end of file
+        raise
+    logger.info(f"エピソード要約を生成しました: {len(summary)}文字")
+    return summary
\ No newline at end of file
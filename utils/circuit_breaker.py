@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Circuit breaker utilities for the novel generator application.
+Tracks provider health and short-circuits calls to degraded providers.
+"""
+
+import time
+import threading
+import logging
+from typing import Dict, Any, Optional
+
+from config import Config
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """プロバイダー単位のサーキットブレーカー
+
+    - closed: 通常どおり呼び出す。連続失敗（または閾値超えの遅延）が続くと open へ
+    - open: 呼び出しを即座に拒否する。open_seconds 経過後に half_open へ
+    - half_open: 少数の試験呼び出しだけを通し、成功すれば closed、失敗すれば open に戻す
+    """
+
+    def __init__(self, name: str,
+                 failure_threshold: int = Config.CIRCUIT_FAILURE_THRESHOLD,
+                 latency_threshold: float = Config.CIRCUIT_LATENCY_THRESHOLD,
+                 open_seconds: float = Config.CIRCUIT_OPEN_SECONDS,
+                 half_open_max_calls: int = Config.CIRCUIT_HALF_OPEN_MAX_CALLS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self._state = CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._half_open_in_flight = 0
+        self._last_failure: Optional[str] = None
+        self._counts = {'successes': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'opened': 0}
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """現在の状態（open の期限切れは half_open として返す）"""
+        with self._lock:
+            self._refresh()
+            return self._state
+
+    def _refresh(self) -> None:
+        """open の待機時間が過ぎていれば half_open に移行する（ロック取得済みで呼ぶこと）"""
+        if self._state == OPEN and time.time() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._half_open_in_flight = 0
+            logger.info(f"サーキットブレーカー[{self.name}]: half_open に移行")
+
+    def allow_request(self) -> bool:
+        """
+        呼び出しを許可するかどうかを判定する
+
+        half_open で許可された場合は、結果を必ず record_success / record_failure / release で返すこと。
+
+        Returns:
+            bool: 呼び出してよい場合はTrue
+        """
+        with self._lock:
+            self._refresh()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._half_open_in_flight < self.half_open_max_calls:
+                self._half_open_in_flight += 1
+                return True
+            self._counts['rejected'] += 1
+            return False
+
+    def _trip(self) -> None:
+        """open に移行する（ロック取得済みで呼ぶこと）"""
+        if self._state != OPEN:
+            self._counts['opened'] += 1
+            logger.warning(f"サーキットブレーカー[{self.name}]: open に移行 ({self._last_failure})")
+        self._state = OPEN
+        self._opened_at = time.time()
+        self._half_open_in_flight = 0
+
+    def record_success(self, latency: float) -> None:
+        """
+        成功した呼び出しを記録する（遅延が閾値を超えた場合は失敗として扱う）
+
+        Args:
+            latency: 呼び出しにかかった秒数
+        """
+        if self.latency_threshold and latency > self.latency_threshold:
+            with self._lock:
+                self._counts['slow_calls'] += 1
+            self.record_failure(f"遅延 {latency:.1f}秒 > {self.latency_threshold}秒")
+            return
+
+        with self._lock:
+            self._counts['successes'] += 1
+            self._consecutive_failures = 0
+            if self._state == HALF_OPEN:
+                logger.info(f"サーキットブレーカー[{self.name}]: closed に復帰")
+            self._state = CLOSED
+            self._half_open_in_flight = 0
+
+    def record_failure(self, reason: str) -> None:
+        """
+        失敗した呼び出しを記録する
+
+        Args:
+            reason: 失敗理由（ステータス表示用）
+        """
+        with self._lock:
+            self._counts['failures'] += 1
+            self._consecutive_failures += 1
+            self._last_failure = reason
+            if self._state == HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+                self._trip()
+
+    def release(self) -> None:
+        """健全性に関係しない結果（設定エラーなど）で終わった呼び出しの枠を返す"""
+        with self._lock:
+            if self._state == HALF_OPEN and self._half_open_in_flight > 0:
+                self._half_open_in_flight -= 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """状態をステータス表示用の辞書で返す"""
+        with self._lock:
+            self._refresh()
+            retry_in = 0.0
+            if self._state == OPEN:
+                retry_in = max(self.open_seconds - (time.time() - self._opened_at), 0.0)
+            return {
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                'last_failure': self._last_failure,
+                'half_open_in_flight': self._half_open_in_flight,
+                'retry_in_seconds': round(retry_in, 1),
+                **self._counts,
+            }
+
+
+# プロバイダー名 -> ブレーカー
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    """
+    プロバイダーのサーキットブレーカーを取得（なければ作成）する
+
+    Args:
+        provider: プロバイダー名（'xai', 'openai' など）
+
+    Returns:
+        CircuitBreaker: プロバイダーのブレーカー
+    """
+    breaker = _breakers.get(provider)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(provider)
+            if breaker is None:
+                breaker = CircuitBreaker(provider)
+                _breakers[provider] = breaker
+    return breaker
+
+
+def get_breaker_states() -> Dict[str, Dict[str, Any]]:
+    """すべてのブレーカーの状態を取得する"""
+    with _breakers_lock:
+        breakers = list(_breakers.items())
+    return {name: breaker.snapshot() for name, breaker in breakers}
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cost ledger utilities for the novel generator application.
+Records tokens, latency and estimated cost of every provider call in an append-only SQLite table.
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import contextvars
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Tuple, Iterator
+
+from config import Config, AIModels
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# 集計に使える列
+GROUP_COLUMNS = ('route', 'purpose', 'session_id', 'novel_id', 'provider', 'model', 'model_id', 'status')
+
+# プロンプトのセクション内訳を保持する件数（組み立てから呼び出しまでの受け渡し用）
+PROMPT_SECTIONS_SIZE = 256
+
+# 呼び出しに付けるタグ（route, purpose, session_id, novel_id）
+_call_tags: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar('novel_call_tags', default={})
+
+# プロンプトのハッシュ → [(セクション名, 推定トークン数)]
+_prompt_sections: 'OrderedDict[str, List[Tuple[str, int]]]' = OrderedDict()
+_prompt_sections_lock = threading.Lock()
+
+
+def current_call_tags() -> Dict[str, str]:
+    """現在の呼び出しタグ"""
+    return dict(_call_tags.get())
+
+
+@contextmanager
+def call_tags(**tags: Optional[str]) -> Iterator[None]:
+    """
+    この中で行うプロバイダー呼び出しにタグを付ける（外側のタグに上書きで追加する）
+
+    Args:
+        **tags: route / purpose / session_id / novel_id（Noneは無視する）
+    """
+    merged = dict(_call_tags.get())
+    merged.update({k: v for k, v in tags.items() if v is not None})
+    token = _call_tags.set(merged)
+    try:
+        yield
+    finally:
+        _call_tags.reset(token)
+
+
+def update_call_tags(**tags: Optional[str]) -> None:
+    """現在のコンテキスト（リクエスト）のタグを更新する（新しい作品IDを発行した場合など）"""
+    merged = dict(_call_tags.get())
+    merged.update({k: v for k, v in tags.items() if v is not None})
+    _call_tags.set(merged)
+
+
+def _prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+def section_label(text: str) -> str:
+    """セクションの見出し（話数などの数字は 'N' にまとめる）"""
+    title = text.strip().partition('\n')[0].strip()
+    if not title.startswith('#'):
+        return '(前文)'
+    return re.sub(r'\d+', 'N', title.lstrip('#').strip().rstrip(':：'))
+
+
+def register_prompt_sections(prompt: str, sections: List[Tuple[str, int]]) -> None:
+    """
+    組み立てたプロンプトのセクションごとの推定トークン数を記録する（台帳の内訳に使う）
+
+    Args:
+        prompt: 連結したプロンプト
+        sections: (セクション文字列, 推定トークン数) のリスト（空のセクションは除く）
+    """
+    breakdown: Dict[str, int] = {}
+    for text, tokens in sections:
+        if text and tokens:
+            label = section_label(text)
+            breakdown[label] = breakdown.get(label, 0) + tokens
+    digest = _prompt_hash(prompt)
+    with _prompt_sections_lock:
+        _prompt_sections[digest] = list(breakdown.items())
+        _prompt_sections.move_to_end(digest)
+        while len(_prompt_sections) > PROMPT_SECTIONS_SIZE:
+            _prompt_sections.popitem(last=False)
+
+
+def _sections_for(prompt: str) -> Optional[List[Tuple[str, int]]]:
+    with _prompt_sections_lock:
+        return _prompt_sections.get(_prompt_hash(prompt))
+
+
+def model_prices(model_choice: str) -> Tuple[float, float]:
+    """モデルの100万トークンあたりの価格（USD, (入力, 出力)）。不明な場合は (0, 0)"""
+    prices = Config.MODEL_PRICE_OVERRIDES.get(model_choice) or AIModels.MODEL_PRICES.get(model_choice)
+    if not prices:
+        return 0.0, 0.0
+    return float(prices[0]), float(prices[1])
+
+
+class CostLedger:
+    """プロバイダー呼び出しの台帳
+
+    1回の呼び出し（リトライの各試行を含む）ごとに1行を追記します。行の更新・削除はトリガーで禁止しています。
+    usage が返らない呼び出し（ストリーミングなど）は文字数からの推定値を記録し、usage_estimated=1 にします。
+    """
+
+    def __init__(self, path: str = Config.COST_LEDGER_PATH):
+        self.path = path
+        self._ready = False
+        self._lock = threading.Lock()
+        self._stats = {'recorded': 0, 'write_errors': 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        """SQLiteに接続する（初回はテーブルを作成）"""
+        if not self._ready:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._ready:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS llm_calls (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    route TEXT NOT NULL,
+                    purpose TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    novel_id TEXT NOT NULL,
+                    trace_id TEXT NOT NULL,
+                    provider TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    model_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    usage_estimated INTEGER NOT NULL,
+                    latency_ms REAL NOT NULL,
+                    prompt_cost_usd REAL NOT NULL,
+                    completion_cost_usd REAL NOT NULL,
+                    prompt_sections TEXT,
+                    cached_tokens INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            # cached_tokens 列のない以前の台帳には列を追加する
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(llm_calls)')}
+            if 'cached_tokens' not in columns:
+                conn.execute('ALTER TABLE llm_calls ADD COLUMN cached_tokens INTEGER NOT NULL DEFAULT 0')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_calls_created ON llm_calls (created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_calls_novel ON llm_calls (novel_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_calls_session ON llm_calls (session_id)')
+            for action in ('UPDATE', 'DELETE'):
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS llm_calls_no_{action.lower()} BEFORE {action} ON llm_calls
+                    BEGIN SELECT RAISE(ABORT, 'llm_calls is append-only'); END
+                ''')
+            conn.commit()
+            self._ready = True
+        return conn
+
+    def record(self, provider: str, model_choice: str, model_id: str, status: str,
+               prompt_tokens: int, completion_tokens: int, latency: float,
+               usage_estimated: bool = False, prompt: Optional[str] = None,
+               trace_id: Optional[str] = None, cached_tokens: int = 0) -> None:
+        """
+        呼び出し1回を記録する（書き込みに失敗しても呼び出し元には例外を出さない）
+
+        Args:
+            provider: プロバイダー名
+            model_choice: AIModels のモデル識別子（価格の参照に使う）
+            model_id: API上のモデル名
+            status: 'ok'、'cancelled'、HTTPステータス、または 'error'
+            prompt_tokens: 入力トークン数
+            completion_tokens: 出力トークン数
+            latency: 呼び出しにかかった秒数
+            usage_estimated: トークン数が推定値か
+            prompt: 送信したプロンプト（fit_prompt で組み立てた場合はセクション内訳を記録する）
+            trace_id: トレースID
+            cached_tokens: 入力のうちプロンプトキャッシュから読まれたトークン数（キャッシュ価格で計算する）
+        """
+        if not Config.COST_LEDGER_ENABLED:
+            return
+        tags = _call_tags.get()
+        input_price, output_price = model_prices(model_choice)
+        cached_tokens = min(int(cached_tokens), int(prompt_tokens))
+        cached_price = input_price * AIModels.CACHED_INPUT_PRICE_RATIO.get(provider, 1.0)
+        sections = _sections_for(prompt) if prompt else None
+        row = (
+            time.time(), tags.get('route', ''), tags.get('purpose') or tags.get('route', ''),
+            tags.get('session_id', ''), tags.get('novel_id', ''), trace_id or '',
+            provider, model_choice, model_id, str(status),
+            int(prompt_tokens), int(completion_tokens), int(bool(usage_estimated)), round(latency * 1000, 1),
+            ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price) / 1e6,
+            completion_tokens * output_price / 1e6,
+            json.dumps(sections, ensure_ascii=False) if sections else None, cached_tokens,
+        )
+        try:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    'INSERT INTO llm_calls (created_at, route, purpose, session_id, novel_id, trace_id, provider, '
+                    'model, model_id, status, prompt_tokens, completion_tokens, usage_estimated, latency_ms, '
+                    'prompt_cost_usd, completion_cost_usd, prompt_sections, cached_tokens) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row
+                )
+                conn.commit()
+            finally:
+                conn.close()
+            with self._lock:
+                self._stats['recorded'] += 1
+        except sqlite3.Error as e:
+            logger.warning(f"コスト台帳書き込みエラー: {e}")
+            with self._lock:
+                self._stats['write_errors'] += 1
+
+    def _where(self, since: Optional[float], until: Optional[float],
+               filters: Optional[Dict[str, str]]) -> Tuple[str, List[Any]]:
+        clauses, params = [], []
+        if since is not None:
+            clauses.append('created_at >= ?')
+            params.append(since)
+        if until is not None:
+            clauses.append('created_at < ?')
+            params.append(until)
+        for column, value in (filters or {}).items():
+            if column in GROUP_COLUMNS:
+                clauses.append(f'{column} = ?')
+                params.append(value)
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def summary(self, group_by: str = 'model', since: Optional[float] = None, until: Optional[float] = None,
+                filters: Optional[Dict[str, str]] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        列ごとに件数・トークン数・コスト・平均レイテンシを集計する（コストの大きい順）
+
+        Args:
+            group_by: GROUP_COLUMNS のいずれか
+            since: この時刻（UNIX秒）以降の呼び出しに限る
+            until: この時刻より前の呼び出しに限る
+            filters: 列 → 値 の絞り込み
+            limit: 返す行数
+
+        Returns:
+            List[Dict[str, Any]]: 集計結果
+
+        Raises:
+            ValueError: group_by が集計できない列の場合
+        """
+        if group_by not in GROUP_COLUMNS:
+            raise ValueError(f"集計できない列です: {group_by}")
+        where, params = self._where(since, until, filters)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f'SELECT {group_by}, COUNT(*), SUM(status = \'ok\'), SUM(prompt_tokens), SUM(completion_tokens), '
+                f'SUM(cached_tokens), SUM(usage_estimated), SUM(prompt_cost_usd), SUM(completion_cost_usd), '
+                f'AVG(latency_ms) '
+                f'FROM llm_calls{where} GROUP BY {group_by} '
+                f'ORDER BY SUM(prompt_cost_usd + completion_cost_usd) DESC, COUNT(*) DESC LIMIT ?',
+                params + [limit]
+            ).fetchall()
+        finally:
+            conn.close()
+        return [{
+            group_by: key,
+            'calls': calls,
+            'succeeded': ok or 0,
+            'prompt_tokens': prompt_tokens or 0,
+            'completion_tokens': completion_tokens or 0,
+            'cached_tokens': cached or 0,
+            'cache_hit_ratio': round((cached or 0) / prompt_tokens, 3) if prompt_tokens else 0.0,
+            'estimated_calls': estimated or 0,
+            'prompt_cost_usd': round(prompt_cost or 0.0, 6),
+            'completion_cost_usd': round(completion_cost or 0.0, 6),
+            'cost_usd': round((prompt_cost or 0.0) + (completion_cost or 0.0), 6),
+            'avg_latency_ms': round(latency or 0.0, 1),
+        } for key, calls, ok, prompt_tokens, completion_tokens, cached, estimated, prompt_cost, completion_cost,
+            latency in rows]
+
+    def section_costs(self, since: Optional[float] = None, until: Optional[float] = None,
+                      filters: Optional[Dict[str, str]] = None) -> List[Dict[str, Any]]:
+        """
+        プロンプトのセクションごとの入力コストを集計する（コストの大きい順）
+
+        各呼び出しの入力コストを、セクション内訳の推定トークン数の比で按分します。
+        内訳のない呼び出し（fit_prompt を使わないプロンプト）は purpose ごとに1セクションとして数えます。
+
+        Returns:
+            List[Dict[str, Any]]: セクション名、呼び出し数、按分した入力トークン数とコスト
+        """
+        where, params = self._where(since, until, filters)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f'SELECT purpose, prompt_tokens, prompt_cost_usd, prompt_sections FROM llm_calls{where}', params
+            ).fetchall()
+        finally:
+            conn.close()
+        totals: Dict[str, Dict[str, Any]] = {}
+        for purpose, prompt_tokens, prompt_cost, sections_json in rows:
+            sections = json.loads(sections_json) if sections_json else [[f'({purpose or "不明"})', prompt_tokens]]
+            estimated_total = sum(tokens for _, tokens in sections) or 1
+            for label, tokens in sections:
+                share = tokens / estimated_total
+                entry = totals.setdefault(label, {'section': label, 'calls': 0, 'prompt_tokens': 0.0, 'cost_usd': 0.0})
+                entry['calls'] += 1
+                entry['prompt_tokens'] += prompt_tokens * share
+                entry['cost_usd'] += prompt_cost * share
+        result = sorted(totals.values(), key=lambda e: (-e['cost_usd'], -e['prompt_tokens']))
+        for entry in result:
+            entry['prompt_tokens'] = int(round(entry['prompt_tokens']))
+            entry['cost_usd'] = round(entry['cost_usd'], 6)
+        return result
+
+    def recent(self, limit: int = 50, filters: Optional[Dict[str, str]] = None) -> List[Dict[str, Any]]:
+        """最近の呼び出しを新しい順に返す"""
+        where, params = self._where(None, None, filters)
+        conn = self._connect()
+        try:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(f'SELECT * FROM llm_calls{where} ORDER BY id DESC LIMIT ?', params + [limit]).fetchall()
+        finally:
+            conn.close()
+        records = []
+        for row in rows:
+            record = dict(row)
+            record['prompt_sections'] = json.loads(record['prompt_sections']) if record['prompt_sections'] else None
+            records.append(record)
+        return records
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'enabled': Config.COST_LEDGER_ENABLED, 'path': self.path, **self._stats}
+
+
+# プロセス全体で共有する台帳
+_ledger: Optional[CostLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_cost_ledger() -> CostLedger:
+    """
+    プロセス共有のコスト台帳を取得する
+
+    Returns:
+        CostLedger: 共有台帳
+    """
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = CostLedger()
+    return _ledger
+
+
+def init_app(app: Any) -> None:
+    """
+    リクエスト中のプロバイダー呼び出しに route / session_id / novel_id のタグを付ける
+
+    Args:
+        app: Flaskアプリケーション
+    """
+    from flask import request, session, g
+
+    @app.before_request
+    def _tag_calls() -> None:
+        route = request.url_rule.rule if request.url_rule is not None else request.path
+        g._call_tags_token = _call_tags.set({
+            'route': route,
+            'session_id': session.get('client_id', ''),
+            'novel_id': session.get('novel_id', ''),
+        })
+
+    @app.teardown_request
+    def _untag_calls(exc: Optional[BaseException]) -> None:
+        token = g.pop('_call_tags_token', None)
+        if token is not None:
+            try:
+                _call_tags.reset(token)
+            except ValueError:
+                # 別のコンテキストで作られたトークン（リクエスト外で teardown が呼ばれた場合）
+                pass
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Request hedging utilities for the novel generator application.
+Fires a backup provider request when the primary is slower than the learned p95.
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict, Any, Callable, Optional, Tuple, TypeVar
+
+from config import Config
+from .retry_policy import RetryBudget
+from .tracing import in_current_context
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+T = TypeVar('T')
+
+
+
+class FirstByteEvent(threading.Event):
+    """最初の応答を受け取った時刻を記録するイベント"""
+
+    def __init__(self):
+        super().__init__()
+        self.at: Optional[float] = None
+
+    def set(self) -> None:
+        if self.at is None:
+            self.at = time.time()
+        super().set()
+
+
+# (cancel_event, first_byte_event) を受け取り結果を返す呼び出し
+HedgeCall = Callable[[threading.Event, FirstByteEvent], T]
+
+
+class LatencyTracker:
+    """プロバイダーごとの最初の応答（first byte）までの時間を記録し、パーセンタイルを求める"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, seconds: float) -> None:
+        """最初の応答までの秒数を記録する"""
+        with self._lock:
+            samples = self._samples.setdefault(provider, deque(maxlen=self.window))
+            samples.append(seconds)
+
+    def percentile(self, provider: str, q: float) -> Optional[float]:
+        """
+        記録済みサンプルのパーセンタイルを返す
+
+        Args:
+            provider: プロバイダー名
+            q: 0〜1のパーセンタイル
+
+        Returns:
+            Optional[float]: 秒数（サンプル不足の場合はNone）
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(provider, ()))
+        if len(samples) < Config.HEDGE_MIN_SAMPLES:
+            return None
+        index = min(int(q * len(samples)), len(samples) - 1)
+        return samples[index]
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """プロバイダーごとのサンプル数とp50/p95を返す"""
+        with self._lock:
+            providers = list(self._samples.keys())
+        result = {}
+        for provider in providers:
+            with self._lock:
+                count = len(self._samples[provider])
+            result[provider] = {
+                'samples': count,
+                'p50': self.percentile(provider, 0.5),
+                'p95': self.percentile(provider, 0.95),
+            }
+        return result
+
+
+class Hedger:
+    """ヘッジ付き呼び出しの実行器
+
+    プライマリ呼び出しが学習済みのp95（サンプル不足時は既定値）以内に最初の応答を返さなければ、
+    バックアップ呼び出しを1本だけ追加し、先に成功した方を採用して残りをキャンセルします。
+    ヘッジの比率は HEDGE_MAX_RATE で上限を設け、コストが倍増しないようにします。
+    """
+
+    def __init__(self, max_workers: int = Config.HEDGE_MAX_WORKERS):
+        self.latency = LatencyTracker()
+        self.budget = RetryBudget(Config.HEDGE_MAX_RATE, 0)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+        self._stats = {'calls': 0, 'hedged': 0, 'hedge_wins': 0, 'budget_denied': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] += 1
+
+    def threshold(self, provider: str) -> float:
+        """バックアップを出すまでの待機秒数"""
+        learned = self.latency.percentile(provider, Config.HEDGE_PERCENTILE)
+        if learned is None:
+            return Config.HEDGE_DEFAULT_DELAY
+        return max(learned, Config.HEDGE_MIN_DELAY)
+
+    def call(self, provider: str, primary: HedgeCall, backup: HedgeCall) -> Tuple[Any, bool]:
+        """
+        ヘッジ付きで呼び出す
+
+        Args:
+            provider: プライマリのプロバイダー名（閾値の学習キー）
+            primary: プライマリ呼び出し
+            backup: バックアップ呼び出し
+
+        Returns:
+            Tuple[Any, bool]: (採用した結果, バックアップが採用されたか)
+
+        Raises:
+            Exception: すべての呼び出しが失敗した場合はプライマリの例外
+        """
+        self._count('calls')
+        self.budget.record_request()
+
+        start = time.time()
+        primary_cancel, primary_first_byte = threading.Event(), FirstByteEvent()
+        primary_future = self._executor.submit(in_current_context(primary), primary_cancel, primary_first_byte)
+
+        def record_primary_latency() -> None:
+            # 最初の応答が来ないまま終わった場合も、経過時間を下限値として記録してp95を過小評価しない
+            if primary_first_byte.at is not None:
+                self.latency.record(provider, primary_first_byte.at - start)
+            else:
+                self.latency.record(provider, time.time() - start)
+
+        delay = self.threshold(provider)
+        if primary_first_byte.wait(delay) or primary_future.done():
+            try:
+                return primary_future.result(), False
+            finally:
+                record_primary_latency()
+
+        if not self.budget.try_acquire():
+            self._count('budget_denied')
+            try:
+                return primary_future.result(), False
+            finally:
+                record_primary_latency()
+
+        logger.info(f"ヘッジ発動: {provider} が{delay:.1f}秒以内に応答しないためバックアップを送信")
+        self._count('hedged')
+        backup_cancel, backup_first_byte = threading.Event(), FirstByteEvent()
+        backup_future = self._executor.submit(in_current_context(backup), backup_cancel, backup_first_byte)
+
+        futures: Dict[Future, str] = {primary_future: 'primary', backup_future: 'backup'}
+        cancels = {'primary': primary_cancel, 'backup': backup_cancel}
+        pending = set(futures)
+        errors: Dict[str, BaseException] = {}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                error = future.exception()
+                if error is not None:
+                    errors[name] = error
+                    continue
+                # 勝者が決まったら残りをキャンセル（次のチャンク受信時に接続を閉じる）
+                for other in pending:
+                    cancels[futures[other]].set()
+                    other.cancel()
+                record_primary_latency()
+                if name == 'backup':
+                    self._count('hedge_wins')
+                return future.result(), name == 'backup'
+
+        record_primary_latency()
+        raise errors.get('primary') or errors['backup']
+
+    def get_stats(self) -> Dict[str, Any]:
+        """ヘッジ統計を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['latency'] = self.latency.snapshot()
+        stats['budget'] = self.budget.snapshot()
+        return stats
+
+
+# プロセス全体で共有するヘッジ実行器
+_hedger: Optional[Hedger] = None
+_hedger_lock = threading.Lock()
+
+
+def get_hedger() -> Hedger:
+    """
+    プロセス共有のヘッジ実行器を取得する
+
+    Returns:
+        Hedger: 共有ヘッジ実行器
+    """
+    global _hedger
+    if _hedger is None:
+        with _hedger_lock:
+            if _hedger is None:
+                _hedger = Hedger()
+    return _hedger
+
+
+def get_hedge_stats() -> Dict[str, Any]:
+    """共有ヘッジ実行器の統計を取得する"""
+    return get_hedger().get_stats()
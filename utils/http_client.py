@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+HTTP client utilities for the novel generator application.
+Keeps long-lived, pooled keep-alive sessions for each AI provider.
+"""
+
+import threading
+import logging
+from typing import Dict, Any, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Config
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# プールサイズはワーカー（スレッド）数に合わせる
+DEFAULT_POOL_MAXSIZE = Config.HTTP_POOL_MAXSIZE
+DEFAULT_TIMEOUT = Config.HTTP_TIMEOUT
+
+
+def _base_url(url: str) -> str:
+    """URLからスキーム+ホスト部分（プールのキー）を取り出す"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class ProviderClientRegistry:
+    """プロバイダーのベースURLごとに1つのプール済みセッションを保持するレジストリ
+
+    requests.Session はコネクションプールを共有するため、同じプロバイダーへの
+    連続した呼び出し（要約→本文など）でTCP/TLSハンドシェイクを再利用できます。
+    """
+
+    def __init__(self, pool_maxsize: int = DEFAULT_POOL_MAXSIZE, timeout: float = DEFAULT_TIMEOUT):
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self._sessions: Dict[str, requests.Session] = {}
+        self._request_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, url: str) -> requests.Session:
+        """
+        URLのベースに対応するセッションを取得（なければ作成）する
+
+        Args:
+            url: 呼び出し先のURL（ベースURLでもエンドポイントでも可）
+
+        Returns:
+            requests.Session: プール済みのセッション
+        """
+        key = _base_url(url)
+        session = self._sessions.get(key)
+        if session is not None:
+            return session
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, pool_block=False)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[key] = session
+                self._request_counts[key] = 0
+                logger.info(f"HTTPセッション作成: {key}, pool_maxsize={self.pool_maxsize}")
+        return session
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        """
+        プール済みセッションでPOSTリクエストを送信する
+
+        Args:
+            url: エンドポイントURL
+            **kwargs: requests.Session.post に渡す引数
+
+        Returns:
+            requests.Response: レスポンス
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.get_session(url)
+        with self._lock:
+            key = _base_url(url)
+            self._request_counts[key] = self._request_counts.get(key, 0) + 1
+        return session.post(url, **kwargs)
+
+    def get_pool_stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        ベースURLごとのプール統計を取得する
+
+        Returns:
+            Dict[str, Dict[str, Any]]: ベースURL -> 統計情報
+        """
+        stats = {}
+        with self._lock:
+            items = list(self._sessions.items())
+            counts = dict(self._request_counts)
+
+        for key, session in items:
+            adapter = session.get_adapter(key)
+            connections = 0
+            pooled_requests = 0
+            idle = 0
+            for pool_key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(pool_key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+                # キュー内の接続のうち実際に確立済みのものがアイドル接続
+                idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            stats[key] = {
+                'requests': counts.get(key, 0),
+                'connections_opened': connections,
+                'idle_connections': idle,
+                'pool_maxsize': self.pool_maxsize,
+                'reused_requests': max(pooled_requests - connections, 0),
+            }
+        return stats
+
+    def close(self) -> None:
+        """すべてのセッションを閉じる"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._request_counts.clear()
+
+
+# プロセス全体で共有するレジストリ
+_registry: Optional[ProviderClientRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_client_registry() -> ProviderClientRegistry:
+    """
+    プロセス共有のプロバイダークライアントレジストリを取得する
+
+    Returns:
+        ProviderClientRegistry: 共有レジストリ
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = ProviderClientRegistry()
+    return _registry
+
+
+def get_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """共有レジストリのプール統計を取得する"""
+    return get_client_registry().get_pool_stats()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Metrics utilities for the novel generator application.
+In-process counters, gauges and histograms rendered in the Prometheus text exposition format.
+"""
+
+import time
+import threading
+import logging
+from typing import Dict, Any, List, Optional, Tuple, Callable, Iterable
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# HTTPリクエストの処理時間のバケット（秒）
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# プロバイダー呼び出しの時間のバケット（秒）
+PROVIDER_BUCKETS = (0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 300)
+# セッションの読み書きの時間のバケット（秒）
+SESSION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    """ラベルごとの値を持つメトリクスの基本クラス"""
+
+    kind = ''
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """増えるだけの値"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}' for key, value in items]
+
+
+class Histogram(_Metric):
+    """値の分布（累積バケット・合計・件数）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = HTTP_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # ラベル → [各バケットの件数..., 合計, 件数]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def totals(self, **labels: Any) -> Tuple[float, int]:
+        """(合計, 件数)"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return (state[-2], state[-1]) if state else (0.0, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state):
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, le)} {count}')
+            inf = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, inf)} {state[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(round(state[-2], 6))}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {state[-1]}')
+        return lines
+
+
+# スクレイプ時に値を集める関数（(名前, 種類, 説明, [(ラベル辞書, 値)]) のリストを返す）
+Collector = Callable[[], List[Tuple[str, str, str, List[Tuple[Dict[str, Any], float]]]]]
+
+
+class MetricsRegistry:
+    """メトリクスとスクレイプ時の収集関数を保持し、Prometheusのテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Collector] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = HTTP_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def register_collector(self, collector: Collector) -> None:
+        """スクレイプ時に他モジュールの統計（キャッシュ・キューなど）をゲージとして出力する関数を登録する"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        すべてのメトリクスをテキスト形式にする
+
+        Returns:
+            str: Prometheus text exposition format (version 0.0.4)
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+            collectors = list(self._collectors)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.warning(f"メトリクス収集エラー: {e}")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labels.keys(), labels.values())} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# プロセス全体で共有するレジストリと主なメトリクス
+_registry = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = _registry.histogram(
+    'novel_http_request_duration_seconds', 'HTTPリクエストの処理時間', ('blueprint', 'route', 'method', 'status'))
+PROVIDER_REQUEST_SECONDS = _registry.histogram(
+    'novel_provider_request_duration_seconds', 'プロバイダー呼び出し1回の時間（ストリーミングは応答ヘッダーまで）',
+    ('provider', 'model', 'status'), PROVIDER_BUCKETS)
+PROVIDER_RETRIES = _registry.counter(
+    'novel_provider_retries_total', 'プロバイダー呼び出しのリトライ回数', ('provider', 'model'))
+PROVIDER_TOKENS = _registry.counter(
+    'novel_provider_tokens_total', 'usage で報告されたトークン数', ('provider', 'model', 'direction'))
+SESSION_STORE_SECONDS = _registry.histogram(
+    'novel_session_store_duration_seconds', 'セッションの読み込み/保存の時間', ('operation',), SESSION_BUCKETS)
+SESSION_STORE_BYTES = _registry.counter(
+    'novel_session_store_bytes_total', 'セッションストアで読み書きしたバイト数', ('operation',))
+
+
+def get_registry() -> MetricsRegistry:
+    """プロセス共有のレジストリを取得する"""
+    return _registry
+
+
+def observe_provider_call(provider: str, model: str, status: Any, seconds: float) -> None:
+    """
+    プロバイダー呼び出し1回を記録する
+
+    Args:
+        provider: プロバイダー名
+        model: API上のモデル名
+        status: HTTPステータス、または応答前の失敗の場合は 'error' / 'timeout'
+        seconds: 呼び出しにかかった秒数
+    """
+    PROVIDER_REQUEST_SECONDS.observe(seconds, provider=provider, model=model, status=status)
+
+
+def count_provider_tokens(provider: str, model: str, prompt_tokens: int, completion_tokens: int,
+                          cached_tokens: int = 0) -> None:
+    """usage のトークン数を記録する（cached は入力のうちプロンプトキャッシュから読まれた分）"""
+    PROVIDER_TOKENS.inc(prompt_tokens, provider=provider, model=model, direction='prompt')
+    PROVIDER_TOKENS.inc(completion_tokens, provider=provider, model=model, direction='completion')
+    PROVIDER_TOKENS.inc(cached_tokens, provider=provider, model=model, direction='cached')
+
+
+def count_provider_retry(provider: str, model: str) -> None:
+    """リトライ1回を記録する"""
+    PROVIDER_RETRIES.inc(provider=provider, model=model)
+
+
+def instrument_session_interface(interface: Any) -> None:
+    """
+    セッションインターフェースを包み、読み込み/保存の時間とバイト数を記録する
+
+    バイト数はセッションストアが使うシリアライザーの入出力で数えるため、計測のために改めて
+    シリアライズすることはありません。flask_session の filesystem バックエンドは cachelib の
+    serializer.dump/load でファイルに読み書きし、その他のバックエンドは serializer.encode/decode を使います。
+
+    Args:
+        interface: app.session_interface
+    """
+    if getattr(interface, '_metrics_instrumented', False):
+        return
+    original_open, original_save = interface.open_session, interface.save_session
+
+    def open_session(app: Any, request: Any) -> Any:
+        start = time.perf_counter()
+        try:
+            return original_open(app, request)
+        finally:
+            SESSION_STORE_SECONDS.observe(time.perf_counter() - start, operation='read')
+
+    def save_session(app: Any, session: Any, response: Any) -> None:
+        start = time.perf_counter()
+        try:
+            original_save(app, session, response)
+        finally:
+            SESSION_STORE_SECONDS.observe(time.perf_counter() - start, operation='write')
+
+    interface.open_session = open_session
+    interface.save_session = save_session
+
+    serializer = getattr(interface, 'serializer', None)
+    if serializer is not None and hasattr(serializer, 'encode') and hasattr(serializer, 'decode'):
+        original_encode, original_decode = serializer.encode, serializer.decode
+
+        def encode(session: Any) -> Any:
+            data = original_encode(session)
+            SESSION_STORE_BYTES.inc(len(data), operation='write')
+            return data
+
+        def decode(data: Any) -> Any:
+            SESSION_STORE_BYTES.inc(len(data), operation='read')
+            return original_decode(data)
+
+        serializer.encode = encode
+        serializer.decode = decode
+
+    file_serializer = getattr(getattr(interface, 'cache', None), 'serializer', None)
+    if file_serializer is not None and hasattr(file_serializer, 'dump') and hasattr(file_serializer, 'load'):
+        original_dump, original_load = file_serializer.dump, file_serializer.load
+
+        def dump(value: Any, f: Any, *args: Any, **kwargs: Any) -> None:
+            start = f.tell()
+            original_dump(value, f, *args, **kwargs)
+            SESSION_STORE_BYTES.inc(f.tell() - start, operation='write')
+
+        def load(f: Any, *args: Any, **kwargs: Any) -> Any:
+            start = f.tell()
+            value = original_load(f, *args, **kwargs)
+            SESSION_STORE_BYTES.inc(f.tell() - start, operation='read')
+            return value
+
+        file_serializer.dump = dump
+        file_serializer.load = load
+    interface._metrics_instrumented = True
+
+
+def stats_collector(prefix: str, help_text: str, get_stats: Callable[[], Dict[str, Any]],
+                    kinds: Optional[Dict[str, str]] = None) -> Collector:
+    """
+    get_*_stats() の数値をゲージ（kinds で指定した項目はカウンター）として出力する収集関数を作る
+
+    Args:
+        prefix: メトリクス名の接頭辞
+        help_text: 説明
+        get_stats: 統計を返す関数（数値以外とネストした辞書は1段だけ展開し、それ以外は無視する）
+        kinds: 項目ごとの種類の指定（'counter' または 'gauge'）
+
+    Returns:
+        Collector: 収集関数
+    """
+    kinds = kinds or {}
+
+    def collect() -> List[Tuple[str, str, str, List[Tuple[Dict[str, Any], float]]]]:
+        families = []
+        for key, value in get_stats().items():
+            if isinstance(value, dict):
+                samples = [({'key': k}, v) for k, v in value.items()
+                           if isinstance(v, (int, float)) and not isinstance(v, bool)]
+                if samples:
+                    families.append((f'{prefix}_{key}', kinds.get(key, 'gauge'), f'{help_text} ({key})', samples))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                families.append((f'{prefix}_{key}', kinds.get(key, 'gauge'), f'{help_text} ({key})', [({}, value)]))
+        return families
+
+    return collect
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Provider adapter registry for the novel generator application.
+Declares how each AI provider is called and parsed, driven by config.AIModels.
+"""
+
+import os
+import math
+import time
+import threading
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from config import Config, AIModels
+from .rate_limiter import RateLimiter, get_rate_limiter
+from .token_budget import get_token_estimator, split_cached_prefix
+from .tracing import current_trace_id
+from .cost_ledger import get_cost_ledger
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+
+class ProviderAdapter:
+    """AIプロバイダーAPIのアダプター
+
+    エンドポイント・認証・ペイロードの組み立て・応答（本文/usage/ストリーミング差分）の解析と、
+    プロバイダー単位の同時実行数・レート制限を宣言します。
+    モデル識別子とプロバイダーの対応、API上のモデル名、温度は AIModels から取得します。
+    """
+
+    # AIModels.MODEL_PROVIDERS の値
+    name = ''
+    # ログ・エラーメッセージ用の表示名
+    display_name = ''
+    # APIキーの環境変数名
+    api_key_env = ''
+    # ベースURLの環境変数名と既定値
+    base_url_env = ''
+    default_base_url = ''
+    # ベースURLからのパス
+    path = '/chat/completions'
+    supports_streaming = True
+
+    def __init__(self):
+        self.max_concurrency = Config.PROVIDER_MAX_CONCURRENCY.get(self.name, 0)
+        self.requests_per_minute = Config.PROVIDER_RPM_LIMITS.get(self.name, 0)
+        self.tokens_per_minute = Config.PROVIDER_TPM_LIMITS.get(self.name, 0)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency) if self.max_concurrency > 0 else None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def api_key(self) -> str:
+        return os.getenv(self.api_key_env, '')
+
+    @property
+    def endpoint(self) -> str:
+        base_url = os.getenv(self.base_url_env, self.default_base_url) if self.base_url_env else self.default_base_url
+        return f"{base_url.rstrip('/')}{self.path}"
+
+    def headers(self, api_key: str) -> Dict[str, str]:
+        """認証ヘッダー"""
+        return {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+
+    def build_messages(self, prompt: str) -> List[Dict[str, str]]:
+        """
+        プロンプトをメッセージ列にする
+
+        固定部分（PROMPT_CACHE_BREAK より前）はシステムメッセージにして、毎回同じ先頭部分として送ります
+        （OpenAI・xAI は先頭が一致するリクエストを自動でキャッシュします）。
+        """
+        static, dynamic = split_cached_prefix(prompt)
+        if not static:
+            return [{"role": "user", "content": dynamic}]
+        return [{"role": "system", "content": ''.join(static)}, {"role": "user", "content": dynamic}]
+
+    def build_payload(self, model_id: str, prompt: str, max_tokens: int, temperature: float) -> Dict[str, Any]:
+        """リクエストボディ"""
+        return {
+            "model": model_id,
+            "messages": self.build_messages(prompt),
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+
+    def parse_text(self, payload: Dict[str, Any]) -> str:
+        """レスポンスJSONから生成テキストを取り出す"""
+        return payload.get("choices", [{}])[0].get("message", {}).get("content", "テキスト取得失敗")
+
+    def parse_usage(self, payload: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+        """レスポンスJSONの usage から (入力トークン数, 出力トークン数) を取り出す（ない場合はNone）"""
+        usage = payload.get("usage") or {}
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+        if not prompt_tokens or not completion_tokens:
+            return None
+        return prompt_tokens, completion_tokens
+
+    def parse_cached_tokens(self, payload: Dict[str, Any]) -> int:
+        """usage から入力のうちプロンプトキャッシュから読まれたトークン数を取り出す（報告がない場合は0）"""
+        usage = payload.get("usage") or {}
+        return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+    def parse_stream_delta(self, event: Dict[str, Any]) -> Optional[str]:
+        """ストリーミングのイベントJSONから差分テキストを取り出す"""
+        choices = event.get("choices") or [{}]
+        return choices[0].get("delta", {}).get("content")
+
+    def stream_payload(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """stream=true のリクエストボディ（最後のイベントで usage を返すよう要求する）"""
+        return dict(data, stream=True, stream_options={"include_usage": True})
+
+    def parse_stream_usage(self, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        ストリーミングのイベントJSONから usage の項目を取り出す（ない場合はNone）
+
+        複数のイベントに分かれて届く場合があるため、呼び出し側で順に上書きして
+        {"usage": ...} として parse_usage / parse_cached_tokens に渡します。
+        """
+        return event.get("usage") or None
+
+    def build_request(self, model_choice: str, prompt: str, max_tokens: int,
+                      temperature: Optional[float] = None) -> Dict[str, Any]:
+        """
+        1回分のAPIリクエストを組み立てる
+
+        Args:
+            model_choice: AIModels のモデル識別子
+            prompt: AIに送信するプロンプト
+            max_tokens: 生成する最大トークン数
+            temperature: 温度（Noneの場合はモデルの既定値）
+
+        Returns:
+            Dict[str, Any]: provider, model_id, endpoint, headers, data, adapter, limiter を含む辞書
+                （limiter はレート制限が無効な場合None）
+
+        Raises:
+            ValueError: APIキーが設定されていない場合
+        """
+        api_key = self.api_key
+        if not api_key:
+            raise ValueError(f"{self.display_name} APIキーが設定されていません")
+        if temperature is None:
+            temperature = AIModels.get_temperature(model_choice)
+        model_id = AIModels.get_api_id(model_choice)
+        return {
+            'provider': self.display_name,
+            'model_id': model_id,
+            'endpoint': self.endpoint,
+            'headers': self.headers(api_key),
+            'data': self.build_payload(model_id, prompt, max_tokens, temperature),
+            'adapter': self,
+            'limiter': self.rate_limiter(api_key) if Config.RATE_LIMIT_ENABLED else None
+        }
+
+    def rate_limiter(self, api_key: str) -> RateLimiter:
+        """APIキーごとのレート制限（上限の初期値はこのアダプターの RPM/TPM）"""
+        return get_rate_limiter(self.name, api_key, self.requests_per_minute, self.tokens_per_minute)
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        同時実行の枠を1つ確保する（max_concurrency が0なら常に成功）
+
+        Args:
+            timeout: 待機する最大秒数（Noneの場合は空くまで待つ、0の場合は待たない）
+
+        Returns:
+            bool: 確保できた場合はTrue
+        """
+        if self._slots is not None:
+            if timeout == 0:
+                acquired = self._slots.acquire(blocking=False)
+            else:
+                acquired = self._slots.acquire(timeout=timeout if timeout is not None else -1)
+            if not acquired:
+                return False
+        with self._lock:
+            self._in_flight += 1
+        return True
+
+    def release(self) -> None:
+        """acquire で確保した枠を返す"""
+        with self._lock:
+            self._in_flight -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """宣言内容と実行中の呼び出し数"""
+        return {
+            'display_name': self.display_name,
+            'endpoint': self.endpoint,
+            'configured': bool(self.api_key),
+            'supports_streaming': self.supports_streaming,
+            'max_concurrency': self.max_concurrency,
+            'requests_per_minute': self.requests_per_minute,
+            'tokens_per_minute': self.tokens_per_minute,
+            'in_flight': self._in_flight,
+        }
+
+
+class XAIAdapter(ProviderAdapter):
+    """xAI (Grok) API"""
+
+    name = 'xai'
+    display_name = 'xAI'
+    api_key_env = 'XAI_API_KEY'
+    base_url_env = 'XAI_API_BASE'
+    default_base_url = 'https://api.x.ai/v1'
+
+
+class OpenAIAdapter(ProviderAdapter):
+    """OpenAI API"""
+
+    name = 'openai'
+    display_name = 'OpenAI'
+    api_key_env = 'OPENAI_API_KEY'
+    base_url_env = 'OPENAI_API_BASE'
+    default_base_url = 'https://api.openai.com/v1'
+
+
+class DeepSeekAdapter(ProviderAdapter):
+    """DeepSeek API（OpenAI互換。システムプロンプトで日付を伝える）"""
+
+    name = 'deepseek'
+    display_name = 'DeepSeek'
+    api_key_env = 'DEEPSEEK_API_KEY'
+    base_url_env = 'DEEPSEEK_API_BASE'
+    default_base_url = 'https://api.deepseek.com/v1'
+
+    def build_messages(self, prompt: str) -> List[Dict[str, str]]:
+        # 現在の日付をシステムプロンプトに追加（固定部分はその後ろに続け、先頭一致のキャッシュに載せる）
+        today = datetime.now().strftime("%m月%d日")
+        static, dynamic = split_cached_prefix(prompt)
+        system = f"该助手为DeepSeek Chat，由深度求索公司创造。今天是{today}。"
+        if static:
+            system = f"{system}\n\n{''.join(static)}"
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": dynamic}
+        ]
+
+    def parse_cached_tokens(self, payload: Dict[str, Any]) -> int:
+        usage = payload.get("usage") or {}
+        return usage.get("prompt_cache_hit_tokens") or 0
+
+
+class AnthropicAdapter(ProviderAdapter):
+    """Anthropic Messages API"""
+
+    name = 'anthropic'
+    display_name = 'Anthropic'
+    api_key_env = 'ANTHROPIC_API_KEY'
+    base_url_env = 'ANTHROPIC_API_BASE'
+    default_base_url = 'https://api.anthropic.com/v1'
+    path = '/messages'
+
+    def headers(self, api_key: str) -> Dict[str, str]:
+        return {
+            "x-api-key": api_key,
+            "anthropic-version": "2023-06-01",
+            "Content-Type": "application/json"
+        }
+
+    def build_payload(self, model_id: str, prompt: str, max_tokens: int, temperature: float) -> Dict[str, Any]:
+        """固定部分は区切りごとのブロックにして system に置き、各ブロックの末尾をキャッシュのブレークポイントにする"""
+        static, dynamic = split_cached_prefix(prompt)
+        payload = super().build_payload(model_id, dynamic, max_tokens, temperature)
+        if static:
+            # ブレークポイントは4つまでのため、それより前の区切りは1つのブロックにまとめる
+            blocks = [''.join(static[:-3])] + static[-3:] if len(static) > 4 else static
+            payload["system"] = [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+                                 for text in blocks]
+        return payload
+
+    def parse_text(self, payload: Dict[str, Any]) -> str:
+        return payload.get("content", [{}])[0].get("text", "テキスト取得失敗")
+
+    def parse_usage(self, payload: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+        # input_tokens はキャッシュの読み書き分を含まないため合算する
+        usage = payload.get("usage") or {}
+        prompt_tokens, completion_tokens = usage.get("input_tokens"), usage.get("output_tokens")
+        if not prompt_tokens or not completion_tokens:
+            return None
+        prompt_tokens += (usage.get("cache_read_input_tokens") or 0) + (usage.get("cache_creation_input_tokens") or 0)
+        return prompt_tokens, completion_tokens
+
+    def parse_cached_tokens(self, payload: Dict[str, Any]) -> int:
+        usage = payload.get("usage") or {}
+        return usage.get("cache_read_input_tokens") or 0
+
+    def parse_stream_delta(self, event: Dict[str, Any]) -> Optional[str]:
+        if event.get("type") == "content_block_delta":
+            return event.get("delta", {}).get("text")
+        return None
+
+    def stream_payload(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        # usage は message_start（入力）と message_delta（出力）で常に返る
+        return dict(data, stream=True)
+
+    def parse_stream_usage(self, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if event.get("type") == "message_start":
+            return event.get("message", {}).get("usage") or None
+        if event.get("type") == "message_delta":
+            return event.get("usage") or None
+        return None
+
+
+# プロバイダー名 → アダプター
+_adapters: Dict[str, ProviderAdapter] = {}
+_adapters_lock = threading.Lock()
+
+
+def register_adapter(adapter: ProviderAdapter) -> None:
+    """
+    アダプターを登録する（同じプロバイダー名の登録は置き換える）
+
+    Args:
+        adapter: 登録するアダプター
+    """
+    with _adapters_lock:
+        _adapters[adapter.name] = adapter
+
+
+def get_adapter(provider: str) -> ProviderAdapter:
+    """
+    プロバイダー名からアダプターを取得する
+
+    Raises:
+        ValueError: 登録されていないプロバイダーの場合
+    """
+    adapter = _adapters.get(provider)
+    if adapter is None:
+        raise ValueError(f"未知のプロバイダー: {provider}")
+    return adapter
+
+
+def get_adapter_for_model(model_choice: str) -> ProviderAdapter:
+    """
+    モデル識別子からアダプターを取得する
+
+    Raises:
+        ValueError: 未知のモデルの場合
+    """
+    if not AIModels.is_known(model_choice):
+        raise ValueError(f"未知のモデル: {model_choice}")
+    return get_adapter(AIModels.get_provider(model_choice))
+
+
+def build_provider_request(model_choice: str, prompt: str, max_tokens: int,
+                           temperature: Optional[float] = None) -> Dict[str, Any]:
+    """
+    モデル選択に応じたAPIリクエスト（エンドポイント・ヘッダー・ペイロード）を組み立てる
+
+    Args:
+        model_choice: AIModels のモデル識別子
+        prompt: AIに送信するプロンプト
+        max_tokens: 生成する最大トークン数
+        temperature: 温度（Noneの場合はモデルの既定値）
+
+    Returns:
+        Dict[str, Any]: provider, model_id, endpoint, headers, data, adapter, limiter を含む辞書
+
+    Raises:
+        ValueError: APIキーが設定されていない、または未知のモデルの場合
+    """
+    return get_adapter_for_model(model_choice).build_request(model_choice, prompt, max_tokens, temperature)
+
+
+def request_prompt_chars(req: Dict[str, Any]) -> int:
+    """リクエストで送るメッセージ（システムプロンプトを含む）の文字数"""
+    data = req['data']
+    chars = sum(len(message.get("content", "")) for message in data.get("messages", []))
+    return chars + sum(len(block.get("text", "")) for block in data.get("system", []))
+
+
+def request_token_cost(req: Dict[str, Any]) -> int:
+    """レート制限で予約するトークン数（入力の見積もり + max_tokens）"""
+    ratio = get_token_estimator().ratio(req['adapter'].name)
+    return math.ceil(request_prompt_chars(req) / ratio) + req['data'].get('max_tokens', 0)
+
+
+def record_call_cost(req: Dict[str, Any], model_choice: str, status: str, started: float, prompt: str,
+                     result_chars: int = 0, usage: Optional[Tuple[int, int]] = None, cached_tokens: int = 0) -> None:
+    """
+    コスト台帳に呼び出し1回を記録する
+    
+    usage がない成功（ストリーミング）と中断は受け取った文字数からトークン数を推定し、失敗はトークン数0で記録します。
+    
+    Args:
+        req: build_provider_request の戻り値
+        model_choice: 呼び出したモデル（フェイルオーバー先を含む）
+        status: 'ok'、'cancelled'（ヘッジで負けて中断）、HTTPステータス、'timeout' または 'error'
+        started: 送信した時刻
+        prompt: 送信したプロンプト
+        result_chars: 応答の文字数
+        usage: (入力トークン数, 出力トークン数)
+        cached_tokens: 入力のうちプロンプトキャッシュから読まれたトークン数
+    """
+    adapter = req['adapter']
+    if usage:
+        prompt_tokens, completion_tokens, estimated = usage[0], usage[1], False
+    elif status in ('ok', 'cancelled'):
+        estimator = get_token_estimator()
+        prompt_tokens = estimator.estimate(prompt, adapter.name)
+        completion_tokens = math.ceil(result_chars / estimator.ratio(adapter.name, 'completion'))
+        estimated = True
+    else:
+        prompt_tokens, completion_tokens, estimated = 0, 0, False
+    get_cost_ledger().record(adapter.name, model_choice, req['model_id'], status, prompt_tokens, completion_tokens,
+                             time.time() - started, estimated, prompt, current_trace_id(), cached_tokens)
+
+
+def get_provider_stats() -> Dict[str, Any]:
+    """登録済みアダプターの宣言内容と実行中の呼び出し数を取得する"""
+    return {name: adapter.snapshot() for name, adapter in sorted(_adapters.items())}
+
+
+for _adapter_class in (XAIAdapter, OpenAIAdapter, DeepSeekAdapter, AnthropicAdapter):
+    register_adapter(_adapter_class())
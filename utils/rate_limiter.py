@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Rate limiter utilities for the novel generator application.
+Paces provider calls with per-provider, per-API-key token buckets for requests and tokens per minute.
+"""
+
+import time
+import hashlib
+import threading
+import logging
+from typing import Dict, Any, Optional, Mapping
+
+from config import Config
+from .retry_policy import parse_reset_seconds
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# レート制限ヘッダー（制限値, 残り, リセットまでの時間）。OpenAI互換（xAI/DeepSeek含む）と Anthropic の形式
+RATE_LIMIT_HEADERS = {
+    'requests': [
+        ('x-ratelimit-limit-requests', 'x-ratelimit-remaining-requests', 'x-ratelimit-reset-requests'),
+        ('anthropic-ratelimit-requests-limit', 'anthropic-ratelimit-requests-remaining', 'anthropic-ratelimit-requests-reset'),
+    ],
+    'tokens': [
+        ('x-ratelimit-limit-tokens', 'x-ratelimit-remaining-tokens', 'x-ratelimit-reset-tokens'),
+        ('anthropic-ratelimit-tokens-limit', 'anthropic-ratelimit-tokens-remaining', 'anthropic-ratelimit-tokens-reset'),
+    ],
+}
+
+
+class RateLimitWaitExceeded(Exception):
+    """レート制限の待ち時間が RATE_LIMIT_MAX_WAIT を超えるため送信しなかったことを表す例外"""
+
+
+class TokenBucket:
+    """1分あたりの上限から補充されるトークンバケット
+
+    残量は負の値まで予約でき、負の分は先に並んでいる呼び出しの待ち行列を表します。
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        """1秒あたりの補充量"""
+        return self.capacity / 60.0
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """
+        残量を予約し、予約分が補充されるまでの待ち時間を返す
+
+        Args:
+            amount: 予約量（容量を超える分は容量として扱う）
+            now: time.monotonic() の現在値
+
+        Returns:
+            float: 送信までに待つ秒数
+        """
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return max(-self.level / self.rate, 0.0)
+
+    def refund(self, amount: float, now: float) -> None:
+        """予約分を返す（負の値の場合は追加で差し引く）"""
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+    def sync(self, limit: Optional[int], remaining: Optional[int], reset: Optional[float], now: float) -> None:
+        """
+        レスポンスヘッダーの値に合わせる
+
+        Args:
+            limit: 1分あたりの上限（ヘッダーの値を優先する）
+            remaining: プロバイダー側の残り
+            reset: 上限まで回復するまでの秒数
+            now: time.monotonic() の現在値
+        """
+        self._refill(now)
+        if limit:
+            self.level += limit - self.capacity
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+        if reset is not None:
+            self.level = min(self.level, self.capacity - reset * self.rate)
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.level
+
+
+class RateLimiter:
+    """1つのプロバイダー・APIキーの組に対するリクエスト数/トークン数のレート制限
+
+    送信前に reserve/acquire で枠を予約し、空くまで待ってから送信します。
+    上限は Config の RPM/TPM（0は無制限）を初期値とし、レスポンスの x-ratelimit-* ヘッダーで補正します。
+    設定が無制限でも、ヘッダーで上限が分かればそれに従います。
+    """
+
+    def __init__(self, name: str, requests_per_minute: int = 0, tokens_per_minute: int = 0,
+                 max_wait: float = Config.RATE_LIMIT_MAX_WAIT):
+        self.name = name
+        self.max_wait = max_wait
+        self._buckets: Dict[str, Optional[TokenBucket]] = {
+            'requests': TokenBucket(requests_per_minute) if requests_per_minute > 0 else None,
+            'tokens': TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None,
+        }
+        self._lock = threading.Lock()
+        self._stats = {
+            'reservations': 0,
+            'waited': 0,
+            'wait_seconds_total': 0.0,
+            'max_wait_seconds': 0.0,
+            'last_wait_seconds': 0.0,
+            'refused': 0,
+            'header_updates': 0,
+            'rejected_by_provider': 0,
+        }
+
+    def reserve(self, tokens: int = 0) -> float:
+        """
+        リクエスト1件とトークンの枠を予約し、送信までに待つ秒数を返す（待機はしない）
+
+        Args:
+            tokens: 推定トークン数（入力の見積もり + max_tokens）
+
+        Returns:
+            float: 送信までに待つ秒数
+
+        Raises:
+            RateLimitWaitExceeded: 待ち時間が max_wait を超える場合（予約は取り消す）
+        """
+        amounts = {'requests': 1, 'tokens': tokens}
+        with self._lock:
+            now = time.monotonic()
+            wait = 0.0
+            for kind, bucket in self._buckets.items():
+                if bucket is not None:
+                    wait = max(wait, bucket.reserve(amounts[kind], now))
+            self._stats['reservations'] += 1
+            if wait > self.max_wait:
+                for kind, bucket in self._buckets.items():
+                    if bucket is not None:
+                        bucket.refund(amounts[kind], now)
+                self._stats['refused'] += 1
+                raise RateLimitWaitExceeded(
+                    f"{self.name} のレート制限により {wait:.0f}秒 の待機が必要なため送信しませんでした"
+                )
+            if wait > 0:
+                self._stats['waited'] += 1
+                self._stats['wait_seconds_total'] += wait
+                self._stats['max_wait_seconds'] = max(self._stats['max_wait_seconds'], wait)
+            self._stats['last_wait_seconds'] = wait
+        if wait > 0:
+            logger.info(f"レート制限待ち: {self.name}, {wait:.2f}秒")
+        return wait
+
+    def acquire(self, tokens: int = 0) -> float:
+        """
+        枠を予約し、空くまで待つ
+
+        Args:
+            tokens: 推定トークン数
+
+        Returns:
+            float: 待った秒数
+
+        Raises:
+            RateLimitWaitExceeded: 待ち時間が max_wait を超える場合
+        """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def settle(self, reserved_tokens: int, actual_tokens: int) -> None:
+        """予約したトークン数と usage の実トークン数の差を精算する"""
+        bucket = self._buckets['tokens']
+        if bucket is None:
+            return
+        with self._lock:
+            bucket.refund(reserved_tokens - actual_tokens, time.monotonic())
+
+    def update_from_headers(self, headers: Optional[Mapping[str, str]], status_code: Optional[int] = None) -> None:
+        """
+        レスポンスのレート制限ヘッダーで上限と残量を補正する
+
+        Args:
+            headers: レスポンスヘッダー
+            status_code: HTTPステータス（429の場合はプロバイダーに拒否された件数として数える）
+        """
+        if status_code == 429:
+            with self._lock:
+                self._stats['rejected_by_provider'] += 1
+        if not headers:
+            return
+        lowered = {k.lower(): v for k, v in headers.items()}
+        updated = False
+        with self._lock:
+            now = time.monotonic()
+            for kind, variants in RATE_LIMIT_HEADERS.items():
+                for limit_name, remaining_name, reset_name in variants:
+                    if not any(name in lowered for name in (limit_name, remaining_name, reset_name)):
+                        continue
+                    limit = _parse_int(lowered.get(limit_name))
+                    remaining = _parse_int(lowered.get(remaining_name))
+                    reset = parse_reset_seconds(lowered[reset_name]) if lowered.get(reset_name) else None
+                    bucket = self._buckets[kind]
+                    if bucket is None:
+                        if not limit:
+                            continue
+                        bucket = self._buckets[kind] = TokenBucket(limit)
+                        logger.info(f"レート制限ヘッダーから上限を設定: {self.name}, {kind}={limit}/分")
+                    bucket.sync(limit, remaining, reset, now)
+                    updated = True
+                    break
+            if updated:
+                self._stats['header_updates'] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """上限・現在の残量と待ち時間の統計を返す"""
+        with self._lock:
+            now = time.monotonic()
+            snapshot: Dict[str, Any] = dict(self._stats)
+            for kind, bucket in self._buckets.items():
+                snapshot[f'{kind}_per_minute'] = int(bucket.capacity) if bucket else 0
+                snapshot[f'{kind}_available'] = round(bucket.available(now), 1) if bucket else None
+        snapshot['wait_seconds_total'] = round(snapshot['wait_seconds_total'], 3)
+        snapshot['max_wait_seconds'] = round(snapshot['max_wait_seconds'], 3)
+        snapshot['last_wait_seconds'] = round(snapshot['last_wait_seconds'], 3)
+        return snapshot
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return int(float(value.strip()))
+    except ValueError:
+        return None
+
+
+# (プロバイダー名, APIキーの指紋) → レート制限
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str, api_key: str, requests_per_minute: int = 0,
+                     tokens_per_minute: int = 0) -> RateLimiter:
+    """
+    プロバイダーとAPIキーの組に対するプロセス共有のレート制限を取得する
+
+    上限はAPIキーごとに課されるため、同じプロバイダーでもキーが異なれば別の枠として扱います。
+
+    Args:
+        provider: プロバイダー名
+        api_key: APIキー（統計には指紋のみを出す）
+        requests_per_minute: 初回作成時の1分あたりのリクエスト数上限（0は無制限）
+        tokens_per_minute: 初回作成時の1分あたりのトークン数上限（0は無制限）
+
+    Returns:
+        RateLimiter: 共有レート制限
+    """
+    name = f"{provider}:{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:8]}"
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                limiter = RateLimiter(name, requests_per_minute, tokens_per_minute)
+                _limiters[name] = limiter
+    return limiter
+
+
+def get_rate_limit_stats() -> Dict[str, Any]:
+    """すべてのレート制限の上限・残量・待ち時間を取得する"""
+    with _limiters_lock:
+        limiters = sorted(_limiters.items())
+    return {
+        'enabled': Config.RATE_LIMIT_ENABLED,
+        'limiters': {name: limiter.snapshot() for name, limiter in limiters},
+    }
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Response cache utilities for the novel generator application.
+Caches deterministic LLM responses in an in-memory LRU backed by SQLite.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from config import Config
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    キャッシュキー用にプロンプトを正規化する
+
+    Unicode正規化（NFC）と、行末の空白・前後の空行・連続する空行の除去を行います。
+    インデントや本文の文字は変えません。
+
+    Args:
+        prompt: プロンプト
+
+    Returns:
+        str: 正規化したプロンプト
+    """
+    lines = [line.rstrip() for line in unicodedata.normalize('NFC', prompt).strip().splitlines()]
+    normalized = []
+    for line in lines:
+        if not line and normalized and not normalized[-1]:
+            continue
+        normalized.append(line)
+    return '\n'.join(normalized)
+
+
+def make_cache_key(model: str, prompt: str, max_tokens: int, temperature: Optional[float]) -> str:
+    """
+    (モデル, 正規化プロンプト, max_tokens, temperature) からキャッシュキーを作る
+
+    Args:
+        model: プロバイダー側のモデル識別子
+        prompt: プロンプト
+        max_tokens: 最大トークン数
+        temperature: 温度
+
+    Returns:
+        str: SHA-256の16進文字列
+    """
+    material = json.dumps([model, normalize_prompt(prompt), max_tokens, temperature], ensure_ascii=False)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """2層のレスポンスキャッシュ
+
+    - メモリ層: プロセス内のLRU（memory_entries 件まで）
+    - ディスク層: SQLite（複数プロセスで共有。max_disk_bytes を超えたら最終アクセスが古い順に削除）
+    どちらの層も ttl 秒で期限切れになります。
+    """
+
+    def __init__(self, path: str = Config.RESPONSE_CACHE_PATH,
+                 ttl: float = Config.RESPONSE_CACHE_TTL,
+                 memory_entries: int = Config.RESPONSE_CACHE_MEMORY_ENTRIES,
+                 max_disk_bytes: int = Config.RESPONSE_CACHE_MAX_DISK_MB * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+        self._stats = {'hits_memory': 0, 'hits_disk': 0, 'misses': 0, 'stores': 0,
+                       'evictions_memory': 0, 'evictions_disk': 0, 'disk_errors': 0}
+        self._lock = threading.Lock()
+        self._disk_ready = False
+
+    def _count(self, key: str, n: int = 1) -> None:
+        with self._lock:
+            self._stats[key] += n
+
+    def _connect(self) -> sqlite3.Connection:
+        """SQLiteに接続する（初回はテーブルを作成）"""
+        if not self._disk_ready:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=5)
+        if not self._disk_ready:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_access ON response_cache (last_access)')
+            conn.commit()
+            self._disk_ready = True
+        return conn
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        """メモリ層に格納し、上限を超えたら最も古いものを捨てる"""
+        with self._lock:
+            self._memory[key] = (value, expires_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+                self._stats['evictions_memory'] += 1
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        キャッシュから値を取得する
+
+        Args:
+            key: make_cache_key で作ったキー
+
+        Returns:
+            Optional[str]: キャッシュされた応答（ない場合はNone）
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                    self._stats['hits_memory'] += 1
+                    return entry[0]
+                del self._memory[key]
+
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute(
+                    'SELECT value, expires_at FROM response_cache WHERE key = ? AND expires_at > ?',
+                    (key, now)
+                ).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE response_cache SET last_access = ? WHERE key = ?', (now, key))
+                    conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"レスポンスキャッシュ読み込みエラー: {e}")
+            self._count('disk_errors')
+            row = None
+
+        if row is None:
+            self._count('misses')
+            return None
+
+        self._count('hits_disk')
+        self._remember(key, row[0], row[1])
+        return row[0]
+
+    def set(self, key: str, value: str, model: str = '', ttl: Optional[float] = None) -> None:
+        """
+        値をキャッシュに保存する
+
+        Args:
+            key: make_cache_key で作ったキー
+            value: 応答テキスト
+            model: モデル識別子（集計用）
+            ttl: 有効秒数（Noneの場合は既定値）
+        """
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        self._remember(key, value, expires_at)
+        self._count('stores')
+
+        try:
+            conn = self._connect()
+            try:
+                conn.execute(
+                    'INSERT OR REPLACE INTO response_cache '
+                    '(key, model, value, size, created_at, expires_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (key, model, value, len(value.encode('utf-8')), now, expires_at, now)
+                )
+                self._evict_disk(conn, now)
+                conn.commit()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"レスポンスキャッシュ書き込みエラー: {e}")
+            self._count('disk_errors')
+
+    def _evict_disk(self, conn: sqlite3.Connection, now: float) -> None:
+        """期限切れの行と、容量上限を超えた分の古い行を削除する"""
+        evicted = conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (now,)).rowcount
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+        if total > self.max_disk_bytes:
+            # 上限の9割まで、最終アクセスが古い順に削除する
+            excess = total - int(self.max_disk_bytes * 0.9)
+            freed = 0
+            victims = []
+            for key, size in conn.execute('SELECT key, size FROM response_cache ORDER BY last_access'):
+                if freed >= excess:
+                    break
+                victims.append((key,))
+                freed += size
+            conn.executemany('DELETE FROM response_cache WHERE key = ?', victims)
+            evicted += len(victims)
+        if evicted:
+            self._count('evictions_disk', evicted)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """ヒット/ミス数と各層の使用状況を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+        lookups = stats['hits_memory'] + stats['hits_disk'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits_memory'] + stats['hits_disk']) / lookups, 3) if lookups else 0.0
+        try:
+            conn = self._connect()
+            try:
+                count, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache').fetchone()
+            finally:
+                conn.close()
+            stats['disk_entries'] = count
+            stats['disk_bytes'] = size
+        except sqlite3.Error:
+            pass
+        return stats
+
+
+# プロセス全体で共有するレスポンスキャッシュ
+_cache: Optional[ResponseCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """
+    プロセス共有のレスポンスキャッシュを取得する
+
+    Returns:
+        ResponseCache: 共有キャッシュ
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
+
+
+def get_cache_stats() -> Dict[str, Any]:
+    """共有レスポンスキャッシュの統計を取得する"""
+    return get_response_cache().get_stats()
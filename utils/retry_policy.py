@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Retry policy utilities for the novel generator application.
+Classifies provider errors, computes backoff delays and enforces a retry budget.
+"""
+
+import re
+import time
+import random
+import threading
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Any, Optional, Mapping, Sequence
+
+import requests
+
+from config import Config
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# リトライ対象とするHTTPステータス（429/タイムアウト/サーバー側エラー）
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+# 待機時間のヒントを返すヘッダー（優先順。429 の応答でのみ使う）
+RETRY_HINT_HEADERS = [
+    'retry-after-ms',
+    'retry-after',
+    'x-ratelimit-reset',
+    'x-ratelimit-reset-requests',
+    'x-ratelimit-reset-tokens',
+    'anthropic-ratelimit-requests-reset',
+    'anthropic-ratelimit-tokens-reset',
+]
+
+# 503 の応答で使うヘッダー（x-ratelimit-reset 系は通常の応答にも付き、過負荷の回復時刻ではないため使わない）
+RETRY_AFTER_HEADERS = ['retry-after-ms', 'retry-after']
+
+_DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """'1s', '6m0s', '20ms' 形式の期間を秒数に変換する"""
+    matches = _DURATION_PATTERN.findall(value)
+    if not matches or ''.join(n + u for n, u in matches) != value:
+        return None
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return sum(float(n) * units[u] for n, u in matches)
+
+
+def parse_retry_hint(headers: Optional[Mapping[str, str]],
+                     names: Sequence[str] = tuple(RETRY_HINT_HEADERS)) -> Optional[float]:
+    """
+    Retry-After / x-ratelimit-reset 系ヘッダーから待機秒数を求める
+
+    Args:
+        headers: レスポンスヘッダー
+        names: 参照するヘッダー名（優先順）
+
+    Returns:
+        Optional[float]: 待機秒数（ヒントがない場合はNone）
+    """
+    if not headers:
+        return None
+
+    lowered = {k.lower(): v for k, v in headers.items()}
+    for name in names:
+        value = lowered.get(name)
+        if not value:
+            continue
+        if name == 'retry-after-ms':
+            try:
+                return max(float(value.strip()) / 1000.0, 0.0)
+            except ValueError:
+                continue
+        seconds = parse_reset_seconds(value)
+        if seconds is not None:
+            return seconds
+    return None
+
+
+def parse_reset_seconds(value: str) -> Optional[float]:
+    """
+    リセットまでの時間を表すヘッダー値を秒数に変換する
+
+    秒数、'6m0s' 形式の期間、UNIXエポック秒、HTTP-date、RFC3339 形式の日時に対応します。
+
+    Args:
+        value: ヘッダー値
+
+    Returns:
+        Optional[float]: 秒数（解釈できない場合はNone）
+    """
+    value = value.strip()
+    now = time.time()
+    try:
+        number = float(value)
+        # 大きな数値はUNIXエポック秒とみなす
+        if number > 1e9:
+            return max(number - now, 0.0)
+        return max(number, 0.0)
+    except ValueError:
+        pass
+    duration = _parse_duration(value)
+    if duration is not None:
+        return duration
+    # HTTP-date または RFC3339 形式の日時
+    try:
+        reset_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        try:
+            reset_at = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if reset_at.tzinfo is None:
+        reset_at = reset_at.replace(tzinfo=timezone.utc)
+    return max(reset_at.timestamp() - now, 0.0)
+
+
+class RetryBudget:
+    """プロセス単位のリトライ予算
+
+    直近 window 秒のリクエスト数に対してリトライが ratio の割合を超えないよう制限します。
+    トラフィックが少ないときのために、window あたり min_retries 回までは常に許可します。
+    """
+
+    def __init__(self, ratio: float, min_retries: int, window: float = 60.0):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._requests: deque = deque()
+        self._retries: deque = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float) -> None:
+        """ウィンドウ外の記録を捨てる（ロック取得済みで呼ぶこと）"""
+        for history in (self._requests, self._retries):
+            while history and now - history[0] > self.window:
+                history.popleft()
+
+    def record_request(self) -> None:
+        """新しい（リトライではない）リクエストを記録する"""
+        now = time.time()
+        with self._lock:
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_acquire(self) -> bool:
+        """
+        リトライ1回分の予算を確保する
+
+        Returns:
+            bool: リトライしてよい場合はTrue
+        """
+        now = time.time()
+        with self._lock:
+            self._trim(now)
+            allowed = max(self.min_retries, int(len(self._requests) * self.ratio))
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(now)
+            return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        """現在のウィンドウ内の使用状況を返す"""
+        with self._lock:
+            self._trim(time.time())
+            return {
+                'window_seconds': self.window,
+                'ratio': self.ratio,
+                'requests': len(self._requests),
+                'retries': len(self._retries),
+            }
+
+
+class RetryPolicy:
+    """プロバイダー呼び出しのリトライ方針
+
+    - エラーをリトライ可能/不可能に分類する（400系の多くは即時失敗）
+    - 指数バックオフ + フルジッターで待機時間を決める
+    - Retry-After / x-ratelimit-reset ヘッダーがあればそれを優先する
+    - RetryBudget でプロセス全体のリトライ比率を制限する
+    """
+
+    def __init__(self, max_attempts: int = Config.RETRY_MAX_ATTEMPTS,
+                 base_delay: float = Config.RETRY_BASE_DELAY,
+                 max_delay: float = Config.RETRY_MAX_DELAY,
+                 budget: Optional[RetryBudget] = None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget(Config.RETRY_BUDGET_RATIO, Config.RETRY_BUDGET_MIN_RETRIES)
+        self._stats: Dict[str, int] = {
+            'calls': 0,
+            'retries': 0,
+            'retries_429': 0,
+            'retries_5xx': 0,
+            'retries_network': 0,
+            'non_retryable': 0,
+            'budget_exhausted': 0,
+            'hint_too_long': 0,
+            'attempts_exhausted': 0,
+        }
+        self._lock = threading.Lock()
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._stats[key] = self._stats.get(key, 0) + 1
+
+    def record_call(self) -> None:
+        """論理的な呼び出し（リトライを含まない）を記録する"""
+        self._count('calls')
+        self.budget.record_request()
+
+    @staticmethod
+    def is_retryable(status_code: Optional[int] = None, exception: Optional[BaseException] = None) -> bool:
+        """
+        エラーがリトライ可能かどうかを判定する
+
+        Args:
+            status_code: HTTPステータスコード
+            exception: 発生した例外
+
+        Returns:
+            bool: リトライ可能ならTrue
+        """
+        if status_code is not None:
+            return status_code in RETRYABLE_STATUS_CODES
+        # 接続エラーやタイムアウトは一時的な障害とみなす。設定ミス（ValueError）などは再試行しない
+        return isinstance(exception, (requests.ConnectionError, requests.Timeout))
+
+    def backoff_delay(self, attempt: int) -> float:
+        """指数バックオフ + フルジッターの待機秒数を返す（attempt は0始まり）"""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def next_delay(self, attempt: int, status_code: Optional[int] = None,
+                   exception: Optional[BaseException] = None,
+                   headers: Optional[Mapping[str, str]] = None) -> Optional[float]:
+        """
+        失敗した試行の後、リトライするなら待機秒数を、しないならNoneを返す
+
+        Args:
+            attempt: 失敗した試行の番号（0始まり）
+            status_code: HTTPステータスコード（HTTPエラーの場合）
+            exception: 発生した例外（通信エラーなどの場合）
+            headers: レスポンスヘッダー
+
+        Returns:
+            Optional[float]: 待機秒数、リトライしない場合はNone
+        """
+        if not self.is_retryable(status_code, exception):
+            self._count('non_retryable')
+            return None
+        if attempt + 1 >= self.max_attempts:
+            self._count('attempts_exhausted')
+            return None
+
+        # ヒントはレート制限(429)と過負荷(503)の応答にだけ従い、その他の 5xx は指数バックオフで待つ
+        # （x-ratelimit-reset 系は毎回の応答に付くため、トークン枠の回復時刻でリトライを諦めないようにする）
+        if status_code == 429:
+            hint = parse_retry_hint(headers)
+        elif status_code == 503:
+            hint = parse_retry_hint(headers, RETRY_AFTER_HEADERS)
+        else:
+            hint = None
+        if hint is not None and hint > self.max_delay:
+            # 長時間待たせるよりも即座に失敗を返す
+            logger.warning(f"リトライ待機時間のヒントが上限を超えています: {hint:.1f}秒 > {self.max_delay}秒")
+            self._count('hint_too_long')
+            return None
+
+        if not self.budget.try_acquire():
+            logger.warning("リトライ予算を使い切ったため再試行しません")
+            self._count('budget_exhausted')
+            return None
+
+        self._count('retries')
+        if status_code == 429:
+            self._count('retries_429')
+        elif status_code is not None and status_code >= 500:
+            self._count('retries_5xx')
+        elif exception is not None:
+            self._count('retries_network')
+
+        return hint if hint is not None else self.backoff_delay(attempt)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """リトライ統計を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['budget'] = self.budget.snapshot()
+        return stats
+
+
+# プロセス全体で共有するリトライ方針
+_policy: Optional[RetryPolicy] = None
+_policy_lock = threading.Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """
+    プロセス共有のリトライ方針を取得する
+
+    Returns:
+        RetryPolicy: 共有リトライ方針
+    """
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = RetryPolicy()
+    return _policy
+
+
+def get_retry_stats() -> Dict[str, Any]:
+    """共有リトライ方針の統計を取得する"""
+    return get_retry_policy().get_stats()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Single-flight utilities for the novel generator application.
+Coalesces identical in-flight provider calls across threads and, optionally, processes.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import logging
+from typing import Dict, Any, Callable, Optional, Tuple
+
+from config import Config
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+
+class _Flight:
+    """実行中の呼び出し1件（同じキーの後続の呼び出し元はこの完了を待つ）"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """同じキーの呼び出しを1本にまとめる
+
+    同じキーの呼び出しが実行中であれば、後から来た呼び出し元は新たに実行せず、
+    実行中の呼び出しの完了を待って同じ結果（または同じ例外）を受け取ります。
+    shared_path を指定すると、SQLiteのテーブルをロックとして使い、
+    複数のワーカープロセス間でも同じキーの呼び出しをまとめます（結果はJSONで受け渡す）。
+    """
+
+    def __init__(self, shared_path: Optional[str] = None,
+                 lock_ttl: float = Config.SINGLE_FLIGHT_LOCK_TTL,
+                 poll_interval: float = Config.SINGLE_FLIGHT_POLL_INTERVAL,
+                 result_ttl: float = Config.SINGLE_FLIGHT_RESULT_TTL):
+        self.shared_path = shared_path
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self.result_ttl = result_ttl
+        self._owner = f"{os.getpid()}:{uuid.uuid4().hex}"
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._db_ready = False
+        self._stats = {'calls': 0, 'executed': 0, 'coalesced': 0, 'coalesced_cross_process': 0}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        キーごとに1本だけ fn を実行し、結果を共有する
+
+        Args:
+            key: リクエストの指紋
+            fn: 実際の呼び出し
+
+        Returns:
+            Tuple[Any, bool]: (結果, 他の呼び出しの結果を受け取ったか)
+        """
+        with self._lock:
+            self._stats['calls'] += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            if self.shared_path:
+                flight.result, shared = self._do_shared(key, fn)
+            else:
+                flight.result, shared = self._execute(fn), False
+            return flight.result, shared
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _execute(self, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            self._stats['executed'] += 1
+        return fn()
+
+    def _connect(self) -> sqlite3.Connection:
+        """SQLiteに接続する（初回はテーブルを作成）"""
+        if not self._db_ready:
+            os.makedirs(os.path.dirname(self.shared_path), exist_ok=True)
+        conn = sqlite3.connect(self.shared_path, timeout=5, isolation_level=None)
+        if not self._db_ready:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS single_flight (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    result TEXT,
+                    finished_at REAL
+                )
+            ''')
+            self._db_ready = True
+        return conn
+
+    def _do_shared(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        プロセス間で同じキーの呼び出しをまとめる
+
+        キーの行がなければ自分が実行して結果を書き込み、他のプロセスが実行中であれば
+        結果が書き込まれるまで poll_interval 秒ごとに確認します。
+        実行中のプロセスが lock_ttl 秒以内に終わらない（異常終了など）場合は自分が実行します。
+        """
+        while True:
+            now = time.time()
+            try:
+                conn = self._connect()
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.execute(
+                        'DELETE FROM single_flight WHERE (result IS NULL AND expires_at <= ?) OR finished_at <= ?',
+                        (now, now - self.result_ttl)
+                    )
+                    row = conn.execute('SELECT result FROM single_flight WHERE key = ?', (key,)).fetchone()
+                    if row is None:
+                        conn.execute('INSERT INTO single_flight (key, owner, expires_at) VALUES (?, ?, ?)',
+                                     (key, self._owner, now + self.lock_ttl))
+                    conn.execute('COMMIT')
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                # ロック用DBが使えない場合はプロセス内のまとめだけで実行する
+                logger.warning(f"シングルフライトのロック取得エラー: {e}")
+                return self._execute(fn), False
+
+            if row is None:
+                break
+            if row[0] is not None:
+                with self._lock:
+                    self._stats['coalesced_cross_process'] += 1
+                return json.loads(row[0]), True
+            time.sleep(self.poll_interval)
+
+        try:
+            result = self._execute(fn)
+        except BaseException:
+            self._finish(key, None)
+            raise
+        self._finish(key, json.dumps(result, ensure_ascii=False))
+        return result, False
+
+    def _finish(self, key: str, result: Optional[str]) -> None:
+        """結果を書き込む（失敗した場合は行を消して、待っているプロセスに実行を任せる）"""
+        try:
+            conn = self._connect()
+            try:
+                if result is None:
+                    conn.execute('DELETE FROM single_flight WHERE key = ? AND owner = ?', (key, self._owner))
+                else:
+                    conn.execute('UPDATE single_flight SET result = ?, finished_at = ? WHERE key = ? AND owner = ?',
+                                 (result, time.time(), key, self._owner))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"シングルフライトの結果書き込みエラー: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """まとめた呼び出しの件数を返す"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._flights)
+        stats['cross_process'] = bool(self.shared_path)
+        return stats
+
+
+# プロセス全体で共有するシングルフライト
+_single_flight: Optional[SingleFlight] = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight() -> SingleFlight:
+    """
+    プロセス共有のシングルフライトを取得する
+
+    Returns:
+        SingleFlight: 共有シングルフライト（SINGLE_FLIGHT_SHARED が有効ならプロセス間でもまとめる）
+    """
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                shared_path = Config.SINGLE_FLIGHT_DB_PATH if Config.SINGLE_FLIGHT_SHARED else None
+                _single_flight = SingleFlight(shared_path)
+    return _single_flight
+
+
+def get_single_flight_stats() -> Dict[str, Any]:
+    """共有シングルフライトの統計を取得する"""
+    return get_single_flight().get_stats()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Token budget utilities for the novel generator application.
+Estimates token counts per provider and sizes max_tokens and prompts to a budget.
+"""
+
+import math
+import threading
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+from config import Config, AIModels
+from .cost_ledger import register_prompt_sections
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# 日本語テキストの文字数/トークン比の初期値（プロバイダーの usage で補正される）
+DEFAULT_CHARS_PER_TOKEN = {
+    'xai': 1.0,
+    'openai': 1.2,
+    'anthropic': 0.8,
+    'deepseek': 1.3,
+}
+# 不明なプロバイダーでは多めに見積もる
+FALLBACK_CHARS_PER_TOKEN = 0.8
+
+# 補正値が極端にならないようにする範囲
+MIN_CHARS_PER_TOKEN = 0.3
+MAX_CHARS_PER_TOKEN = 4.0
+
+# max_tokens を丸める単位（レスポンスキャッシュのキーが補正のたびに変わらないようにする）
+MAX_TOKENS_STEP = 64
+
+# これより短くなる場合はセクションを切り詰めずに省く
+MIN_SECTION_TOKENS = 64
+
+# プロンプトの固定部分（システムメッセージ）と可変部分（ユーザーメッセージ）の区切り
+PROMPT_CACHE_BREAK = '\n<!-- prompt-cache-break -->\n'
+
+
+class TokenEstimator:
+    """プロバイダーごとの文字数/トークン比を保持し、usage から補正する
+
+    比は入力（prompt）と出力（completion）で別々に持ちます。
+    同じ日本語でもプロバイダーのトークナイザーによって比が大きく異なるため、
+    応答の usage（実トークン数）と文字数から指数移動平均で学習します。
+    """
+
+    def __init__(self, alpha: float = Config.TOKEN_CALIBRATION_ALPHA):
+        self.alpha = alpha
+        self._ratios: Dict[str, Dict[str, float]] = {}
+        self._samples: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def ratio(self, provider: Optional[str], kind: str = 'prompt') -> float:
+        """
+        文字数/トークン比を取得する
+
+        Args:
+            provider: プロバイダー名（'openai' など、Noneの場合は控えめな既定値）
+            kind: 'prompt' または 'completion'
+
+        Returns:
+            float: 1トークンあたりの文字数
+        """
+        with self._lock:
+            learned = self._ratios.get(provider, {}).get(kind)
+        if learned is not None:
+            return learned
+        return DEFAULT_CHARS_PER_TOKEN.get(provider, FALLBACK_CHARS_PER_TOKEN)
+
+    def estimate(self, text: str, provider: Optional[str], kind: str = 'prompt') -> int:
+        """テキストのおおよそのトークン数"""
+        return math.ceil(len(text) / self.ratio(provider, kind))
+
+    def _update(self, provider: str, kind: str, chars: int, tokens: int) -> None:
+        """1件の観測で比を更新する（ロック取得済みで呼ぶこと）"""
+        if chars <= 0 or tokens <= 0:
+            return
+        observed = min(max(chars / tokens, MIN_CHARS_PER_TOKEN), MAX_CHARS_PER_TOKEN)
+        ratios = self._ratios.setdefault(provider, {})
+        current = ratios.get(kind, DEFAULT_CHARS_PER_TOKEN.get(provider, FALLBACK_CHARS_PER_TOKEN))
+        ratios[kind] = current * (1 - self.alpha) + observed * self.alpha
+
+    def record_usage(self, provider: str, prompt_chars: int, prompt_tokens: int,
+                     completion_chars: int, completion_tokens: int) -> None:
+        """
+        応答の usage から比を補正する
+
+        Args:
+            provider: プロバイダー名
+            prompt_chars: 送信したメッセージの文字数
+            prompt_tokens: usage の入力トークン数
+            completion_chars: 応答テキストの文字数
+            completion_tokens: usage の出力トークン数
+        """
+        with self._lock:
+            self._update(provider, 'prompt', prompt_chars, prompt_tokens)
+            self._update(provider, 'completion', completion_chars, completion_tokens)
+            self._samples[provider] = self._samples.get(provider, 0) + 1
+
+    def max_tokens_for(self, provider: Optional[str], target_chars: int,
+                       headroom: float = Config.MAX_TOKENS_HEADROOM) -> int:
+        """
+        目標文字数の出力に必要な max_tokens を求める
+
+        Args:
+            provider: プロバイダー名
+            target_chars: 出力してほしい文字数（「800〜1000文字」なら1000）
+            headroom: 目標を少し超える出力で途中で切れないための余裕
+
+        Returns:
+            int: MAX_TOKENS_STEP 単位に切り上げ、上下限に収めた max_tokens
+        """
+        tokens = target_chars / self.ratio(provider, 'completion') * headroom
+        tokens = math.ceil(tokens / MAX_TOKENS_STEP) * MAX_TOKENS_STEP
+        return int(min(max(tokens, Config.MIN_OUTPUT_TOKENS), Config.MAX_OUTPUT_TOKENS))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """プロバイダーごとの現在の比とサンプル数を返す"""
+        providers = set(DEFAULT_CHARS_PER_TOKEN) | set(self._ratios)
+        return {
+            provider: {
+                'prompt_chars_per_token': round(self.ratio(provider, 'prompt'), 3),
+                'completion_chars_per_token': round(self.ratio(provider, 'completion'), 3),
+                'samples': self._samples.get(provider, 0),
+            }
+            for provider in sorted(providers)
+        }
+
+
+def _provider_of(model_choice: Optional[str]) -> Optional[str]:
+    return AIModels.get_provider(model_choice) if model_choice else None
+
+
+def estimate_tokens(text: str, model_choice: Optional[str] = None, kind: str = 'prompt') -> int:
+    """
+    モデルのプロバイダーに合わせてテキストのトークン数を見積もる
+
+    Args:
+        text: 対象のテキスト
+        model_choice: 使用するAIモデル（Noneの場合は控えめな既定値）
+        kind: 'prompt' または 'completion'
+
+    Returns:
+        int: おおよそのトークン数
+    """
+    return get_token_estimator().estimate(text, _provider_of(model_choice), kind)
+
+
+def max_tokens_for_chars(model_choice: str, target_chars: int) -> int:
+    """
+    目標文字数から max_tokens を求める
+
+    Args:
+        model_choice: 使用するAIモデル
+        target_chars: 出力してほしい文字数
+
+    Returns:
+        int: max_tokens
+    """
+    return get_token_estimator().max_tokens_for(_provider_of(model_choice), target_chars)
+
+
+def _truncate_section(section: str, keep_chars: int) -> str:
+    """見出し行（「###」で始まる1行目）を残してセクションの本文を切り詰める"""
+    header = ''
+    if section.startswith('###'):
+        header, _, section = section.partition('\n')
+        header += '\n'
+    return f"{header}{section[:keep_chars].rstrip()}…\n\n"
+
+
+def fit_prompt(sections: List[Tuple[str, int]], model_choice: Optional[str] = None,
+               max_tokens: int = Config.PROMPT_TOKEN_BUDGET) -> str:
+    """
+    プロンプトのセクションを予算内に収めて連結する
+
+    予算を超える場合、優先度の値が大きい任意セクションから順に本文を切り詰め、
+    切り詰めても短くなりすぎる場合は省きます。必須セクション（優先度0）はそのまま残します。
+
+    Args:
+        sections: (セクション文字列, 優先度) のリスト
+        model_choice: 使用するAIモデル
+        max_tokens: プロンプトのトークン予算
+
+    Returns:
+        str: 連結したプロンプト
+    """
+    estimator = get_token_estimator()
+    provider = _provider_of(model_choice)
+    texts = [text for text, _ in sections]
+    sizes = [estimator.estimate(text, provider) for text in texts]
+    excess = sum(sizes) - max_tokens
+    if excess <= 0:
+        return _joined(texts, sizes)
+
+    order = sorted((i for i, (_, priority) in enumerate(sections) if priority > 0),
+                   key=lambda i: (-sections[i][1], -i))
+    for index in order:
+        if excess <= 0:
+            break
+        title = texts[index].partition('\n')[0]
+        keep = sizes[index] - excess
+        if keep >= MIN_SECTION_TOKENS:
+            texts[index] = _truncate_section(texts[index], int(keep * estimator.ratio(provider)))
+            logger.info(f"プロンプト予算超過のためセクションを切り詰め: {title}")
+        else:
+            texts[index] = ''
+            logger.info(f"プロンプト予算超過のためセクションを省略: {title}")
+        new_size = estimator.estimate(texts[index], provider)
+        excess -= sizes[index] - new_size
+        sizes[index] = new_size
+
+    if excess > 0:
+        logger.warning(f"必須セクションだけでプロンプト予算を超えています: 超過={excess}トークン")
+    return _joined(texts, sizes)
+
+
+def _joined(texts: List[str], sizes: List[int]) -> str:
+    """セクションを連結し、セクションごとのトークン数をコスト台帳の内訳用に記録する"""
+    prompt = ''.join(texts)
+    register_prompt_sections(prompt, [(text, size) for text, size in zip(texts, sizes) if text != PROMPT_CACHE_BREAK])
+    return prompt
+
+
+def cache_break() -> Tuple[str, int]:
+    """
+    fit_prompt に渡す区切りセクション
+
+    最後の区切りより前のセクションは変わりにくい固定部分としてシステムメッセージで送られ、
+    プロバイダーのプロンプトキャッシュ（OpenAI/xAI/DeepSeekの先頭一致の自動キャッシュ、Anthropicの cache_control）
+    の対象になります。区切りを複数置くと、Anthropic ではそれぞれの位置がキャッシュのブレークポイントになります。
+    PROMPT_CACHE_LAYOUT が無効な場合は空のセクション（1つのユーザーメッセージのまま）です。
+
+    Returns:
+        Tuple[str, int]: (区切り文字列, 優先度0)
+    """
+    return (PROMPT_CACHE_BREAK if Config.PROMPT_CACHE_LAYOUT else '', 0)
+
+
+def split_cached_prefix(prompt: str) -> Tuple[List[str], str]:
+    """
+    プロンプトを区切りで固定部分と可変部分に分ける
+
+    Args:
+        prompt: fit_prompt で組み立てたプロンプト
+
+    Returns:
+        Tuple[List[str], str]: (区切りごとの固定部分, 可変部分)。区切りがない場合は固定部分が空のリスト
+    """
+    parts = prompt.split(PROMPT_CACHE_BREAK)
+    return [part for part in parts[:-1] if part], parts[-1]
+
+
+# プロセス全体で共有する見積もり器
+_estimator: Optional[TokenEstimator] = None
+_estimator_lock = threading.Lock()
+
+
+def get_token_estimator() -> TokenEstimator:
+    """
+    プロセス共有のトークン見積もり器を取得する
+
+    Returns:
+        TokenEstimator: 共有見積もり器
+    """
+    global _estimator
+    if _estimator is None:
+        with _estimator_lock:
+            if _estimator is None:
+                _estimator = TokenEstimator()
+    return _estimator
+
+
+def get_token_stats() -> Dict[str, Any]:
+    """共有見積もり器の補正状況を取得する"""
+    return get_token_estimator().snapshot()
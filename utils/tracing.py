@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tracing utilities for the novel generator application.
+Lightweight per-request span trees exported as JSON lines or OTLP-compatible JSON files.
+"""
+
+import os
+import json
+import time
+import uuid
+import functools
+import threading
+import contextvars
+import logging
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Tuple, Callable, Iterator, Iterable
+
+from config import Config
+
+# ロギングの設定
+logger = logging.getLogger('novel_generator')
+
+# トレースIDを返すレスポンスヘッダー
+TRACE_HEADER = 'X-Trace-Id'
+
+# OTLP の SpanKind
+SPAN_KINDS = {'internal': 1, 'server': 2, 'client': 3}
+
+
+class Span:
+    """処理の1区間（開始・終了時刻、属性、親スパン）"""
+
+    __slots__ = ('name', 'kind', 'trace', 'span_id', 'parent_id', 'start', 'end', 'attributes',
+                 'error', '_perf_start')
+
+    def __init__(self, name: str, trace: 'Trace', parent_id: Optional[str] = None, kind: str = 'internal',
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.kind = kind
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.error: Optional[str] = None
+        self._perf_start = time.perf_counter()
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    @property
+    def duration(self) -> float:
+        """経過秒数（終了前は現在までの秒数）"""
+        if self.end is not None:
+            return self.end - self.start
+        return time.perf_counter() - self._perf_start
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+
+    def finish(self) -> None:
+        """スパンを終了してトレースに記録する（2回目以降は何もしない）"""
+        if self.end is None:
+            # 時計の調整に影響されないよう、長さは perf_counter で測る
+            self.end = self.start + (time.perf_counter() - self._perf_start)
+            self.trace.add(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start': round(self.start, 6),
+            'duration_ms': round(self.duration * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class _NoopSpan:
+    """トレース外・トレース無効時に返す何もしないスパン"""
+
+    trace_id = None
+    span_id = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def record_error(self, error: BaseException) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """1つのリクエスト（またはジョブ）のスパンの集まり"""
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.root: Optional[Span] = None
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            if len(self.spans) >= Config.TRACE_MAX_SPANS:
+                self.dropped += 1
+                return
+            self.spans.append(span)
+
+    @property
+    def sampled(self) -> bool:
+        """トレースIDから決まる標本判定（同じトレースは複数プロセスでも同じ判定になる）"""
+        return int(self.trace_id[-8:], 16) / 0xFFFFFFFF < Config.TRACE_SAMPLE_RATE
+
+    def tree(self) -> Dict[str, Any]:
+        """スパンを親子の入れ子にした辞書（遅いトレースのダンプ用）"""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        nodes = {s.span_id: dict(s.to_dict(), children=[]) for s in spans}
+        roots = []
+        for span in spans:
+            node = nodes[span.span_id]
+            for key in ('trace_id', 'kind'):
+                node.pop(key)
+            parent = nodes.get(span.parent_id)
+            (parent['children'] if parent is not None else roots).append(node)
+        return {'trace_id': self.trace_id, 'dropped_spans': self.dropped, 'spans': roots}
+
+
+# 現在のスパン（スレッド・非同期タスクごと）
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar('novel_current_span', default=None)
+
+
+def current_span() -> Any:
+    """現在のスパン（トレース外の場合は NOOP_SPAN）"""
+    return _current_span.get() or NOOP_SPAN
+
+
+def current_trace_id() -> Optional[str]:
+    """現在のトレースID（トレース外の場合はNone）"""
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
+
+
+@contextmanager
+def span(name: str, kind: str = 'internal', **attributes: Any) -> Iterator[Any]:
+    """
+    現在のスパンの子スパンで処理を囲む（トレース外では何も記録しない）
+
+    Args:
+        name: スパン名（'provider.http' など）
+        kind: 'internal' / 'client' / 'server'
+        **attributes: スパンの属性
+
+    Yields:
+        Span: 作成したスパン（トレース外の場合は NOOP_SPAN）
+    """
+    parent = _current_span.get()
+    if parent is None or not Config.TRACING_ENABLED:
+        yield NOOP_SPAN
+        return
+    child = Span(name, parent.trace, parent.span_id, kind, attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.finish()
+
+
+@contextmanager
+def trace(name: str, kind: str = 'internal', **attributes: Any) -> Iterator[Any]:
+    """
+    新しいトレースのルートスパンで処理を囲む（既にトレース中の場合は子スパンになる）
+
+    ジョブやバックグラウンド処理など、リクエストの外で動く処理に使います。
+
+    Args:
+        name: ルートスパン名
+        kind: 'internal' / 'client' / 'server'
+        **attributes: スパンの属性
+
+    Yields:
+        Span: ルートスパン（トレース無効時は NOOP_SPAN）
+    """
+    if _current_span.get() is not None:
+        with span(name, kind, **attributes) as child:
+            yield child
+        return
+    if not Config.TRACING_ENABLED:
+        yield NOOP_SPAN
+        return
+    root = start_trace(name, kind, **attributes)
+    token = _current_span.set(root)
+    try:
+        yield root
+    except BaseException as e:
+        root.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        finish_trace(root)
+
+
+def traced(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """関数全体を子スパンで囲むデコレーター"""
+    def decorator(fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_trace(name: str, kind: str = 'internal', trace_id: Optional[str] = None,
+                parent_id: Optional[str] = None, **attributes: Any) -> Span:
+    """新しいトレースとルートスパンを作成する（現在のスパンには設定しない）"""
+    new_trace = Trace(trace_id)
+    root = Span(name, new_trace, parent_id, kind, attributes)
+    new_trace.root = root
+    return root
+
+
+def finish_trace(root: Span) -> None:
+    """ルートスパンを終了し、トレースをエクスポートする"""
+    if root.end is not None:
+        return
+    root.finish()
+    get_trace_exporter().export(root.trace)
+
+
+def in_current_context(fn: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    現在のコンテキスト（スパンを含む）で fn を実行する関数を返す
+
+    ThreadPoolExecutor に渡す関数を包み、ワーカースレッドのスパンを呼び出し元の子にします。
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        return context.run(fn, *args, **kwargs)
+    return wrapper
+
+
+def traceparent_headers(headers: Dict[str, str]) -> Dict[str, str]:
+    """
+    トレース中であれば W3C traceparent ヘッダーを追加したヘッダーを返す（元の辞書は変更しない）
+
+    Args:
+        headers: プロバイダーへのリクエストヘッダー
+
+    Returns:
+        Dict[str, str]: 送信するヘッダー
+    """
+    current = _current_span.get()
+    if current is None:
+        return headers
+    return dict(headers, traceparent=f'00-{current.trace_id}-{current.span_id}-01')
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[Tuple[str, str]]:
+    """
+    W3C traceparent ヘッダーを解析する
+
+    Returns:
+        Optional[Tuple[str, str]]: (トレースID, 親スパンID)。形式が不正な場合はNone
+    """
+    if not value:
+        return None
+    parts = value.strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+        return None
+    return parts[1].lower(), parts[2].lower()
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_span(span: Span) -> Dict[str, Any]:
+    record = {
+        'traceId': span.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': SPAN_KINDS.get(span.kind, 1),
+        'startTimeUnixNano': str(int(span.start * 1e9)),
+        'endTimeUnixNano': str(int((span.start + span.duration) * 1e9)),
+        'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in span.attributes.items()],
+        'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+    }
+    if span.parent_id:
+        record['parentSpanId'] = span.parent_id
+    return record
+
+
+class TraceExporter:
+    """完了したトレースをファイルに書き出す
+
+    TRACE_SAMPLE_RATE の割合のトレースを TRACE_EXPORT_FORMAT の形式で出力します。
+    - jsonl: 1スパン1行
+    - otlp: 1トレース1行の OTLP/JSON（ExportTraceServiceRequest。OpenTelemetry Collector の
+      otlpjsonfile レシーバーなどで取り込めます）
+    ルートスパンが TRACE_SLOW_THRESHOLD 秒以上かかったトレースは、標本に関わらず
+    スパンの木全体を TRACE_SLOW_PATH に出力し、内訳をログに残します。
+    """
+
+    def __init__(self, export_format: str = Config.TRACE_EXPORT_FORMAT, path: str = Config.TRACE_EXPORT_PATH,
+                 slow_threshold: float = Config.TRACE_SLOW_THRESHOLD, slow_path: str = Config.TRACE_SLOW_PATH):
+        self.export_format = export_format
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self.slow_path = slow_path
+        self._lock = threading.Lock()
+        self._recent_slow: deque = deque(maxlen=20)
+        self._stats = {'traces': 0, 'exported': 0, 'slow': 0, 'spans': 0, 'dropped_spans': 0, 'write_errors': 0}
+
+    def _append(self, path: str, lines: Iterable[str]) -> None:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with self._lock, open(path, 'a', encoding='utf-8') as f:
+                for line in lines:
+                    f.write(line + '\n')
+        except OSError as e:
+            with self._lock:
+                self._stats['write_errors'] += 1
+            logger.warning(f"トレースの書き込みエラー: {path}: {e}")
+
+    def export(self, finished: Trace) -> None:
+        """
+        トレースを出力する
+
+        Args:
+            finished: ルートスパンが終了したトレース
+        """
+        root = finished.root
+        with finished._lock:
+            spans = list(finished.spans)
+        with self._lock:
+            self._stats['traces'] += 1
+            self._stats['spans'] += len(spans)
+            self._stats['dropped_spans'] += finished.dropped
+
+        if finished.sampled and self.export_format in ('jsonl', 'otlp'):
+            if self.export_format == 'jsonl':
+                lines = [json.dumps(s.to_dict(), ensure_ascii=False, default=str) for s in spans]
+            else:
+                lines = [json.dumps({'resourceSpans': [{
+                    'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'novel_generator'}}]},
+                    'scopeSpans': [{'scope': {'name': 'novel_generator'}, 'spans': [_otlp_span(s) for s in spans]}],
+                }]}, ensure_ascii=False, default=str)]
+            self._append(self.path, lines)
+            with self._lock:
+                self._stats['exported'] += 1
+
+        if root is not None and self.slow_threshold > 0 and root.duration >= self.slow_threshold:
+            tree = finished.tree()
+            self._append(self.slow_path, [json.dumps(tree, ensure_ascii=False, default=str)])
+            breakdown = ', '.join(f"{s.name}={s.duration:.2f}秒" for s in spans if s.parent_id == root.span_id)
+            logger.warning(f"遅いリクエスト: {root.name} {root.duration:.2f}秒 (trace_id={finished.trace_id}) "
+                           f"内訳: {breakdown or 'なし'}")
+            with self._lock:
+                self._stats['slow'] += 1
+                self._recent_slow.append({
+                    'trace_id': finished.trace_id,
+                    'name': root.name,
+                    'duration_seconds': round(root.duration, 3),
+                    'finished_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(root.start + root.duration)),
+                })
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'enabled': Config.TRACING_ENABLED,
+                'export_format': self.export_format,
+                'sample_rate': Config.TRACE_SAMPLE_RATE,
+                'slow_threshold_seconds': self.slow_threshold,
+                **self._stats,
+                'recent_slow': list(self._recent_slow),
+            }
+
+
+# プロセス全体で共有するエクスポーター
+_exporter: Optional[TraceExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def get_trace_exporter() -> TraceExporter:
+    """プロセス共有のトレースエクスポーターを取得する"""
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = TraceExporter()
+    return _exporter
+
+
+def get_trace_stats() -> Dict[str, Any]:
+    """出力したトレース数と最近の遅いトレースを取得する"""
+    return get_trace_exporter().stats()
+
+
+class _TracedBody:
+    """レスポンス本文の反復と close をリクエストのコンテキストで行い、送り終えた時点でトレースを終える
+
+    ストリーミング応答では本文の生成中にプロバイダーを呼び出すため、その間のスパンも同じトレースに入ります。
+    """
+
+    def __init__(self, body: Iterable[bytes], context: contextvars.Context, root: Span):
+        self._body = body
+        self._iterator = iter(body)
+        self._context = context
+        self._root = root
+
+    def __iter__(self) -> '_TracedBody':
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            return self._context.run(next, self._iterator)
+        except StopIteration:
+            # close を呼ばないサーバーでも、本文を送り終えた時点でトレースを終える
+            finish_trace(self._root)
+            raise
+
+    def close(self) -> None:
+        try:
+            if hasattr(self._body, 'close'):
+                self._context.run(self._body.close)
+        finally:
+            finish_trace(self._root)
+
+
+class TracingMiddleware:
+    """リクエスト全体（セッションの読み込み・保存を含む）をルートスパンで囲むWSGIミドルウェア
+
+    受信した traceparent ヘッダーがあればそのトレースを引き継ぎ、レスポンスに X-Trace-Id を付けます。
+    """
+
+    def __init__(self, wsgi_app: Callable[..., Any]):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable[..., Any]) -> Iterable[bytes]:
+        if not Config.TRACING_ENABLED:
+            return self.wsgi_app(environ, start_response)
+        context = contextvars.copy_context()
+        return context.run(self._call, context, environ, start_response)
+
+    def _call(self, context: contextvars.Context, environ: Dict[str, Any],
+              start_response: Callable[..., Any]) -> Iterable[bytes]:
+        incoming = parse_traceparent(environ.get('HTTP_TRACEPARENT'))
+        method = environ.get('REQUEST_METHOD', 'GET')
+        root = start_trace(
+            f"{method} {environ.get('PATH_INFO', '/')}", 'server',
+            trace_id=incoming[0] if incoming else None, parent_id=incoming[1] if incoming else None,
+            **{'http.method': method, 'http.target': environ.get('PATH_INFO', '/')}
+        )
+        # このコンテキストはリクエスト専用のコピーのため、reset は不要
+        _current_span.set(root)
+
+        def traced_start_response(status: str, headers: List[Tuple[str, str]], exc_info: Any = None) -> Any:
+            root.set_attribute('http.status_code', int(status.split(' ', 1)[0]))
+            return start_response(status, list(headers) + [(TRACE_HEADER, root.trace_id)], exc_info)
+
+        try:
+            body = self.wsgi_app(environ, traced_start_response)
+        except BaseException as e:
+            root.record_error(e)
+            finish_trace(root)
+            raise
+        return _TracedBody(body, context, root)
+
+
+def _trace_session_interface(interface: Any) -> None:
+    """セッションの読み込み/保存をスパンで囲む"""
+    if getattr(interface, '_tracing_instrumented', False):
+        return
+    original_open, original_save = interface.open_session, interface.save_session
+
+    def open_session(app: Any, request: Any) -> Any:
+        with span('session.read'):
+            return original_open(app, request)
+
+    def save_session(app: Any, session: Any, response: Any) -> None:
+        with span('session.write'):
+            original_save(app, session, response)
+
+    interface.open_session = open_session
+    interface.save_session = save_session
+    interface._tracing_instrumented = True
+
+
+def init_app(app: Any) -> None:
+    """
+    Flaskアプリにトレースを組み込む
+
+    - WSGIミドルウェアでリクエストごとのトレースを作成する
+    - ルートスパンの名前をURLルール（'POST /next_episode' など）にする
+    - セッションの読み込み/保存、テンプレートの描画をスパンにする
+
+    Args:
+        app: Flaskアプリケーション
+    """
+    from flask import request, before_render_template, template_rendered, g
+
+    if not Config.TRACING_ENABLED:
+        return
+    app.wsgi_app = TracingMiddleware(app.wsgi_app)
+    _trace_session_interface(app.session_interface)
+
+    @app.before_request
+    def _name_root_span() -> None:
+        current = _current_span.get()
+        if current is None or current.trace.root is not current:
+            return
+        if request.url_rule is not None:
+            current.name = f"{request.method} {request.url_rule.rule}"
+            current.set_attribute('http.route', request.url_rule.rule)
+        if request.blueprint:
+            current.set_attribute('flask.blueprint', request.blueprint)
+
+    def _start_render(sender: Any, template: Any, context: Dict[str, Any], **extra: Any) -> None:
+        parent = _current_span.get()
+        if parent is None:
+            return
+        render_span = Span('render', parent.trace, parent.span_id, attributes={'template': template.name or ''})
+        g.setdefault('_trace_renders', []).append((render_span, _current_span.set(render_span)))
+
+    def _end_render(sender: Any, template: Any, context: Dict[str, Any], **extra: Any) -> None:
+        renders = g.get('_trace_renders')
+        if renders:
+            render_span, token = renders.pop()
+            _current_span.reset(token)
+            render_span.finish()
+
+    before_render_template.connect(_start_render, app, weak=False)
+    template_rendered.connect(_end_render, app, weak=False)